@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, send_file, jsonify, make_response
+from flask import Flask, Response, request, jsonify, make_response
 import flask_restful
 import json
 import functools
 import os
 import sys
 import logging
+import threading
+import atexit
+import concurrent.futures
 import urllib.parse
 import cloudlanguagetools.constants
 import cloudlanguagetools.languages
 import cloudlanguagetools.servicemanager
 import cloudlanguagetools.errors
 import redisdb
+import catalog_cache
+import audio_cache
+import singleflight
+import result_cache as result_cache_module
+import rate_limiter as rate_limiter_module
+import posthog_queue
 import patreon_utils
 import getcheddar_utils as getcheddar_utils_module
 import convertkit
@@ -68,10 +77,74 @@ api = flask_restful.Api(app)
 manager = cloudlanguagetools.servicemanager.ServiceManager()
 manager.configure_default()
 
-redis_connection = redisdb.RedisDb()
+# api key records are cached in-process, they get looked up on every authenticated request.
+# modifications made by other processes are announced over redis pub/sub, the TTL is only a safety net
+redis_connection = redisdb.RedisDb(api_key_cache=redisdb.ApiKeyCache(ttl_seconds=600, negative_ttl_seconds=60))
+api_key_invalidation_thread = threading.Thread(target=redis_connection.listen_api_key_invalidations, name='api_key_invalidation', daemon=True)
+api_key_invalidation_thread.start()
+# analytics counters are aggregated in memory and written behind, whatever is left gets written when the worker exits
+analytics_queue_config = secrets.config.get('analytics_queue', {})
+if analytics_queue_config.get('enable', True):
+    analytics_queue = redis_connection.enable_analytics_queue(
+        flush_interval_seconds=analytics_queue_config.get('flush_interval_seconds', 5),
+        max_pending_events=analytics_queue_config.get('max_pending_events', 1000),
+        max_requeued_events=analytics_queue_config.get('max_requeued_events', 100000))
+    atexit.register(analytics_queue.stop)
+# shared pool for requests fanned out to several translation services, such as /translate_all
+translation_pool_config = secrets.config.get('translation_pool', {})
+translation_executor = concurrent.futures.ThreadPoolExecutor(max_workers=translation_pool_config.get('max_workers', 32), thread_name_prefix='translation')
+TRANSLATE_ALL_TIMEOUT_SECONDS = translation_pool_config.get('translate_all_timeout_seconds', 8)
+# calls which time out keep running in the pool, each service only gets a few threads, so that a service
+# which hangs can't take up the whole pool
+TRANSLATION_MAX_IN_FLIGHT_PER_SERVICE = translation_pool_config.get('max_in_flight_per_service', 4)
+translation_service_slots = {}
+translation_service_slots_lock = threading.Lock()
+# token lookups of /breakdown_v1 run on their own pool, and a single request only has a few of them in flight,
+# a long text can't starve /translate_all or flood the upstream services
+breakdown_executor = concurrent.futures.ThreadPoolExecutor(max_workers=translation_pool_config.get('breakdown_max_workers', 16), thread_name_prefix='breakdown')
+BREAKDOWN_MAX_IN_FLIGHT = translation_pool_config.get('breakdown_max_in_flight', 4)
+
+# posthog events are sent by a worker thread, never on the request path
+posthog_event_queue = None
+if posthog_config.get('enable', False):
+    posthog_event_queue = posthog_queue.PosthogEventQueue(posthog, redis_connection, max_size=posthog_config.get('queue_size', 10000))
+    posthog_event_queue.start()
+    atexit.register(posthog_event_queue.stop)
+language_data_cache = catalog_cache.LanguageDataCache(redis_connection)
+
+# the voice / language lists are built on a background thread at startup, then rebuilt every hour
+# (the service manager itself refreshes the underlying lists every 24 hours)
+CATALOG_REFRESH_INTERVAL_SECONDS = 3600
+language_list_catalog = catalog_cache.ManagerCatalog('language_list', manager.get_language_list)
+voice_list_catalog = catalog_cache.ManagerCatalog('voice_list', manager.get_tts_voice_list_json)
+translation_language_list_catalog = catalog_cache.ManagerCatalog('translation_language_list', manager.get_translation_language_list_json)
+transliteration_language_list_catalog = catalog_cache.ManagerCatalog('transliteration_language_list', manager.get_transliteration_language_list_json)
+catalog_cache.start_catalog_refresh([
+    language_list_catalog,
+    voice_list_catalog,
+    translation_language_list_catalog,
+    transliteration_language_list_catalog
+], CATALOG_REFRESH_INTERVAL_SECONDS)
+
 convertkit_client = convertkit.ConvertKit()
 getcheddar_utils = getcheddar_utils_module.GetCheddarUtils()
 
+# identical TTS requests are served from this cache, without calling the TTS service again
+tts_audio_cache = audio_cache.build_audio_cache(secrets.config.get('audio_cache', {}))
+# token bucket rate limits per api key and per service, see quotas.py
+rate_limiter = None
+if secrets.config.get('rate_limit', {}).get('enable', True):
+    rate_limiter = rate_limiter_module.TokenBucketRateLimiter(redis_connection.r, quotas.API_KEY_RATE_LIMIT, quotas.SERVICE_RATE_LIMITS)
+# translation, transliteration and tokenization results
+result_cache = result_cache_module.build_result_cache(secrets.config.get('result_cache', {}), redis_connection.r)
+
+# identical TTS / translation requests running at the same time share a single upstream call,
+# optionally across workers, using a short lived redis lock
+if secrets.config.get('request_coalescing', {}).get('across_workers', False):
+    request_coalescer = singleflight.RequestCoalescer(redis_client=redis_connection.r)
+else:
+    request_coalescer = singleflight.RequestCoalescer()
+
 MIGRATION_NOTICE = ('Cloud Language Tools has been retired. Please migrate to the Vocab platform: '
                     'https://www.vocab.ai/signup - questions: help@mail.vocab.ai')
 
@@ -100,6 +173,16 @@ def authenticate_get(func):
         return {'error': result['msg']}, 401
     return wrapper
 
+def check_rate_limit(api_key, service):
+    # checked before usage is tracked, rejected requests are not charged.
+    # returns None if the request can go ahead, otherwise the 429 response
+    if rate_limiter == None:
+        return None
+    retry_after = rate_limiter.check(api_key, service)
+    if retry_after == None:
+        return None
+    return {'error': f'Too many requests, retry in {retry_after:.1f}s'}, 429, {'Retry-After': rate_limiter_module.get_retry_after_header(retry_after)}
+
 def track_usage(request_type, request, func, *args, **kwargs):
     api_key = request.headers.get('api_key', None)
     if api_key != None:
@@ -118,14 +201,17 @@ def track_usage(request_type, request, func, *args, **kwargs):
                 except KeyError:
                     return {'error': f'language_code {language_code_str} not recognized'}, 400
 
+            rate_limit_response = check_rate_limit(api_key, service)
+            if rate_limit_response != None:
+                return rate_limit_response
+
             try:
-                redis_connection.track_usage(api_key, service, request_type, characters, language_code)
+                api_key_data = redis_connection.track_usage(api_key, service, request_type, characters, language_code)
             except cloudlanguagetools.errors.OverQuotaError as err:
                 return {'error': str(err)}, 429
 
-            # posthog reporting
+            # posthog reporting, the event is sent from a background thread
             try:
-                api_key_data = redis_connection.get_api_key_data(api_key)
                 user_email = api_key_data['email']
                 account_type = api_key_data['type']
                 client_ip = request.headers.get('X-Forwarded-For', None)
@@ -139,8 +225,9 @@ def track_usage(request_type, request, func, *args, **kwargs):
                 client = client_rename_map.get(client, client)
                 version = request.headers.get('client_version')
 
-                if posthog_config.get('enable', False) and redis_connection.should_send_posthog_event(api_key):
-                    posthog.capture(
+                if posthog_event_queue != None:
+                    posthog_event_queue.submit(
+                        api_key,
                         event='legacy_clt_usage_v1',
                         distinct_id=user_email,
                         properties={
@@ -198,6 +285,9 @@ def track_usage_audio_yomichan(func):
             if text != None and service_str != None:
                 service = cloudlanguagetools.constants.Service[service_str]
                 characters = len(text)
+                rate_limit_response = check_rate_limit(api_key, service)
+                if rate_limit_response != None:
+                    return rate_limit_response
                 try:
                     redis_connection.track_usage(api_key, service, cloudlanguagetools.constants.RequestType.audio, characters, cloudlanguagetools.languages.Language.ja)
                 except cloudlanguagetools.errors.OverQuotaError as err:
@@ -206,25 +296,280 @@ def track_usage_audio_yomichan(func):
     return wrapper
 
 
+# yomichan audio is deterministic for a given text/service/voice. the api_key stays part of the url, so a
+# reverse proxy or CDN keyed on the full url only ever serves a clip back to the user who requested it.
+# the api key can expire or run out of quota, so caches must revalidate after a short while: revalidation
+# goes through authentication, and the 304 doesn't generate any audio
+YOMICHAN_AUDIO_MAX_AGE_SECONDS = 300
+
+def get_yomichan_audio_etag():
+    # derived from the normalized request: voice_key key order and url encoding don't matter, the api_key
+    # doesn't either. returns None if the request is invalid, the resource reports the error
+    source_text = request.args.get('text')
+    service = request.args.get('service')
+    voice_key_urlencode_str = request.args.get('voice_key')
+    if source_text == None or service == None or voice_key_urlencode_str == None:
+        return None
+    try:
+        voice_key = json.loads(urllib.parse.unquote_plus(voice_key_urlencode_str))
+    except json.decoder.JSONDecodeError:
+        return None
+    return audio_cache.build_cache_key(source_text, service, voice_key, {})
+
+def build_yomichan_audio_url(api_key, service, voice_key, text):
+    # canonical form of a /yomichan_audio url: fixed parameter order, compact json with sorted keys.
+    # the voice_key gets url encoded twice, the resource decodes it a second time
+    voice_key_str = urllib.parse.quote_plus(json.dumps(voice_key, sort_keys=True, separators=(',', ':'), ensure_ascii=False))
+    query_str = urllib.parse.urlencode([
+        ('api_key', api_key),
+        ('service', service),
+        ('voice_key', voice_key_str),
+        ('text', text)
+    ])
+    return f'/yomichan_audio?{query_str}'
+
+def set_yomichan_audio_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = YOMICHAN_AUDIO_MAX_AGE_SECONDS
+    response.cache_control.must_revalidate = True
+    voice_key = json.loads(urllib.parse.unquote_plus(request.args.get('voice_key')))
+    response.headers['Content-Location'] = build_yomichan_audio_url(request.args.get('api_key'),
+        request.args.get('service'), voice_key, request.args.get('text'))
+    return response
+
+def yomichan_audio_not_modified(func):
+    # revalidation of a clip the client (or a cache) already has: answer with a 304 before usage tracking,
+    # no audio gets generated or delivered
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        etag = get_yomichan_audio_etag()
+        if etag != None and request.if_none_match.contains_weak(etag):
+            return set_yomichan_audio_cache_headers(Response(status=304), etag)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def read_tts_audio(text, service, voice_key, options):
+    # the service manager hands back a temporary file, read it into memory and remove it right away,
+    # so that no temporary files are left behind, even when the request times out later on
+    audio_temp_file = manager.get_tts_audio(text, service, voice_key, options)
+    try:
+        audio_temp_file.seek(0)
+        return audio_temp_file.read()
+    finally:
+        audio_temp_file.close()
+
+def get_tts_audio(text, service, voice_key, options):
+    # returns the audio data (bytes), from the cache if the same request was already processed.
+    # usage tracking happens in the decorators and is the same for cache hits
+    cache_key = audio_cache.build_cache_key(text, service, voice_key, options)
+    if tts_audio_cache != None:
+        audio_data = tts_audio_cache.get(cache_key)
+        if audio_data != None:
+            return audio_data
+
+    def generate_audio():
+        audio_data = read_tts_audio(text, service, voice_key, options)
+        if tts_audio_cache != None:
+            try:
+                tts_audio_cache.put(cache_key, audio_data)
+            except Exception as cache_exception:
+                sentry_sdk.capture_exception(cache_exception)
+        return audio_data
+
+    def lookup_audio():
+        # audio generated by another worker, found in the shared tier
+        return tts_audio_cache.get(cache_key)
+
+    # without a shared tier, audio generated by another worker (or replica) can't be picked up,
+    # waiting for it would only delay the same upstream call
+    across_workers = tts_audio_cache != None and tts_audio_cache.shared_store != None
+    return request_coalescer.do(f'audio:{cache_key}', generate_audio, lookup_audio, across_workers=across_workers)
+
+def result_cache_allowed():
+    # users can opt out of having their texts cached: through their api key (result_cache_opt_out),
+    # or per request with Cache-Control: no-store. must be called from the request thread
+    if request.cache_control.no_store:
+        return False
+    try:
+        api_key_data = redis_connection.get_api_key_data(request.headers.get('api_key'))
+    except cloudlanguagetools.errors.ApiKeyNotFoundError:
+        return False
+    return api_key_data.get('result_cache_opt_out', None) != 'true'
+
+def get_cached_result(kind, service, options, text, fn, store_result):
+    if result_cache == None:
+        return fn()
+    return result_cache.get_result(kind, service, options, text, fn, store_result=store_result)
+
+def get_translation(text, service, from_language_key, to_language_key, store_result=True):
+    request_str = json.dumps([text, service, from_language_key, to_language_key], ensure_ascii=False)
+    request_key = hashlib.sha256(request_str.encode('utf-8')).hexdigest()
+    def translate():
+        return request_coalescer.do(f'translation:{request_key}', lambda: manager.get_translation(text, service, from_language_key, to_language_key))
+    return get_cached_result('translation', service, [from_language_key, to_language_key], text, translate, store_result)
+
+def get_transliteration(text, service, transliteration_key, store_result=True):
+    return get_cached_result('transliteration', service, transliteration_key, text,
+        lambda: manager.get_transliteration(text, service, transliteration_key), store_result)
+
+def get_tokenization(text, service, tokenization_key, store_result=True):
+    return get_cached_result('tokenization', service, tokenization_key, text,
+        lambda: manager.get_tokenization(text, service, tokenization_key), store_result)
+
+def run_bounded(executor, calls, max_in_flight):
+    # calls: key -> (fn, args). runs them on executor with at most max_in_flight submitted at a time,
+    # returns key -> result. the first exception is raised
+    results = {}
+    pending = {}
+    for key, (fn, args) in calls.items():
+        if len(pending) >= max_in_flight:
+            done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+        pending[executor.submit(fn, *args)] = key
+    for future, key in pending.items():
+        results[key] = future.result()
+    return results
+
+def get_breakdown(text, tokenization_option, translation_option, transliteration_option, store_result=True):
+    # same result as manager.get_breakdown, but tokens go through the result cache. cloudlanguagetools has no
+    # batch translation API, instead each distinct lemma / token is looked up once, and those which aren't
+    # cached are translated / transliterated concurrently, a few at a time
+    tokenization_result = get_tokenization(text, tokenization_option['service'], tokenization_option['tokenization_key'], store_result)
+
+    calls = {}
+    if translation_option != None:
+        for token in tokenization_result:
+            lemma = token['lemma']
+            if token['can_translate']:
+                calls[('translation', lemma)] = (get_translation, (lemma,
+                    translation_option['service'], translation_option['source_language_id'], translation_option['target_language_id'], store_result))
+
+    if transliteration_option != None:
+        for token in tokenization_result:
+            token_text = token['token']
+            if token['can_transliterate']:
+                calls[('transliteration', token_text)] = (get_transliteration, (token_text,
+                    transliteration_option['service'], transliteration_option['transliteration_key'], store_result))
+
+    call_results = run_bounded(breakdown_executor, calls, BREAKDOWN_MAX_IN_FLIGHT)
+
+    result = []
+    for token in tokenization_result:
+        entry = {
+            'token': token['token'],
+            'lemma': token['lemma']
+        }
+        if token['can_translate'] and translation_option != None:
+            entry['translation'] = call_results[('translation', token['lemma'])]
+        if token['can_transliterate'] and transliteration_option != None:
+            entry['transliteration'] = call_results[('transliteration', token['token'])]
+        if 'pos_description' in token:
+            entry['pos_description'] = token['pos_description']
+        result.append(entry)
+
+    return result
+
+def write_request_analytics(analytics):
+    # runs after the response was sent, nothing left to report the error to but sentry
+    try:
+        analytics.write()
+    except Exception as e:
+        logging.exception('could not write request analytics')
+        sentry_sdk.capture_exception(e)
+
+def get_translation_service_slot(service_name):
+    with translation_service_slots_lock:
+        if service_name not in translation_service_slots:
+            translation_service_slots[service_name] = threading.BoundedSemaphore(TRANSLATION_MAX_IN_FLIGHT_PER_SERVICE)
+        return translation_service_slots[service_name]
+
+def run_in_service_slot(slot, fn, *args):
+    try:
+        return fn(*args)
+    finally:
+        slot.release()
+
+def get_all_translations(text, from_language, to_language, timeout_seconds, store_result=True):
+    # same as manager.get_all_translations, but all services are queried concurrently, and we wait for them
+    # at most timeout_seconds. returns the translations, and the list of services which timed out. a service
+    # which already has TRANSLATION_MAX_IN_FLIGHT_PER_SERVICE calls running is skipped, and reported as timed out
+    translation_language_list = translation_language_list_catalog.get().data
+    # (service, language_code) -> language ids
+    language_ids = {}
+    for entry in translation_language_list:
+        language_ids.setdefault((entry['service'], entry['language_code']), []).append(entry['language_id'])
+
+    futures = {}
+    saturated_services = []
+    for service_name in sorted(set([entry['service'] for entry in translation_language_list])):
+        from_language_ids = language_ids.get((service_name, from_language), [])
+        to_language_ids = language_ids.get((service_name, to_language), [])
+        if len(from_language_ids) == 1 and len(to_language_ids) == 1:
+            slot = get_translation_service_slot(service_name)
+            if not slot.acquire(blocking=False):
+                saturated_services.append(service_name)
+                continue
+            try:
+                futures[service_name] = translation_executor.submit(run_in_service_slot, slot, get_translation, text, service_name, from_language_ids[0], to_language_ids[0], store_result)
+            except:
+                slot.release()
+                raise
+
+    done, not_done = concurrent.futures.wait(futures.values(), timeout=timeout_seconds)
+
+    result = {}
+    timed_out_services = []
+    for service_name, future in futures.items():
+        if future in not_done:
+            # a translation which is already running can't be interrupted, it completes in the background
+            if future.cancel():
+                # it never started, its slot is free again
+                get_translation_service_slot(service_name).release()
+            timed_out_services.append(service_name)
+            continue
+        try:
+            result[service_name] = future.result()
+        except cloudlanguagetools.errors.RequestError:
+            pass # don't do anything
+        except Exception:
+            logging.exception(f'could not retrieve translation for service {service_name}, text: {text}')
+    if len(timed_out_services) > 0:
+        logging.warning(f'get_all_translations: timed out after {timeout_seconds}s: {timed_out_services}')
+    if len(saturated_services) > 0:
+        logging.warning(f'get_all_translations: skipped services with {TRANSLATION_MAX_IN_FLIGHT_PER_SERVICE} calls in flight: {saturated_services}')
+    return result, sorted(timed_out_services + saturated_services)
+
+def send_audio(audio_data, etag=None):
+    # audio is served from memory, with a Content-Length and support for range requests
+    response = Response(audio_data, mimetype='audio/mpeg')
+    if etag != None:
+        # before make_conditional, so that If-Range works
+        response.set_etag(etag)
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(audio_data))
+
+
 class LanguageList(flask_restful.Resource):
     def get(self):
-        return manager.get_language_list()
+        return language_list_catalog.get().make_response(request)
 
 class VoiceList(flask_restful.Resource):
     def get(self):
-        return manager.get_tts_voice_list_json()
+        return voice_list_catalog.get().make_response(request)
 
 class TranslationLanguageList(flask_restful.Resource):
     def get(self):
-        return manager.get_translation_language_list_json()
+        return translation_language_list_catalog.get().make_response(request)
 
 class TransliterationLanguageList(flask_restful.Resource):
     def get(self):
-        return manager.get_transliteration_language_list_json()
+        return transliteration_language_list_catalog.get().make_response(request)
 
 class LanguageDataV1(flask_restful.Resource):
     def get(self):
-        return redis_connection.get_language_data()
+        return language_data_cache.get().make_response(request)
 
 class Translate(flask_restful.Resource):
     method_decorators = [track_usage_translation, authenticate]
@@ -233,7 +578,7 @@ class Translate(flask_restful.Resource):
             data = request.json
             # add sentry service tag
             sentry_sdk.set_tag("clt.service", data['service'])
-            return {'translated_text': manager.get_translation(data['text'], data['service'], data['from_language_key'], data['to_language_key'])}
+            return {'translated_text': get_translation(data['text'], data['service'], data['from_language_key'], data['to_language_key'], result_cache_allowed())}
         except cloudlanguagetools.errors.RequestError as err:
             sentry_sdk.capture_exception(err)
             return {'error': str(err)}, 400
@@ -243,7 +588,12 @@ class TranslateAll(flask_restful.Resource):
     def post(self):
         try:
             data = request.json
-            return manager.get_all_translations(data['text'], data['from_language'], data['to_language'])
+            result, timed_out_services = get_all_translations(data['text'], data['from_language'], data['to_language'], TRANSLATE_ALL_TIMEOUT_SECONDS, result_cache_allowed())
+            # the body keeps its format (service -> translation), services which didn't answer in time are listed in a header
+            headers = {}
+            if len(timed_out_services) > 0:
+                headers['X-Timed-Out-Services'] = ','.join(timed_out_services)
+            return result, 200, headers
         except cloudlanguagetools.errors.RequestError as err:
             sentry_sdk.capture_exception(err)
             return {'error': str(err)}, 400
@@ -255,7 +605,7 @@ class Transliterate(flask_restful.Resource):
             data = request.json
             # add sentry service tag
             sentry_sdk.set_tag("clt.service", data['service'])
-            return {'transliterated_text': manager.get_transliteration(data['text'], data['service'], data['transliteration_key'])}
+            return {'transliterated_text': get_transliteration(data['text'], data['service'], data['transliteration_key'], result_cache_allowed())}
         except cloudlanguagetools.errors.RequestError as err:
             sentry_sdk.capture_exception(err)
             return {'error': str(err)}, 400    
@@ -268,7 +618,7 @@ class TokenizeV1(flask_restful.Resource):
             data = request.json
             # add sentry service tag
             sentry_sdk.set_tag("clt.service", data['service'])
-            return {'tokenization': manager.get_tokenization(data['text'], data['service'], data['tokenization_key'])}
+            return {'tokenization': get_tokenization(data['text'], data['service'], data['tokenization_key'], result_cache_allowed())}
         except cloudlanguagetools.errors.RequestError as err:
             sentry_sdk.capture_exception(err)
             return {'error': str(err)}, 400    
@@ -282,10 +632,11 @@ class BreakdownV1(flask_restful.Resource):
             max_len = 1000
             if len(text) > max_len:
                 raise cloudlanguagetools.errors.RequestError(f'text exceeds max length of {max_len} characters')
-            result = manager.get_breakdown(text, 
-                                           data['tokenization_option'], 
-                                           data.get('translation_option', None), 
-                                           data.get('transliteration_option', None))
+            result = get_breakdown(text, 
+                                   data['tokenization_option'], 
+                                   data.get('translation_option', None), 
+                                   data.get('transliteration_option', None),
+                                   result_cache_allowed())
             return {'breakdown': result}
         except cloudlanguagetools.errors.RequestError as err:
             sentry_sdk.capture_exception(err)
@@ -304,8 +655,8 @@ class Audio(flask_restful.Resource):
     def post(self):
         try:
             data = request.json
-            audio_temp_file = manager.get_tts_audio(data['text'], data['service'], data['voice_key'], data['options'])
-            return send_file(audio_temp_file.name, mimetype='audio/mpeg')
+            audio_data = get_tts_audio(data['text'], data['service'], data['voice_key'], data['options'])
+            return send_audio(audio_data)
         except cloudlanguagetools.errors.NotFoundError as err:
             return {'error': str(err)}, 404
         except cloudlanguagetools.errors.RequestError as err:
@@ -340,25 +691,22 @@ class AudioV2(flask_restful.Resource):
             if transaction != None:
                 transaction.name = f'audio_v2_{service_str}'
 
-            audio_temp_file = manager.get_tts_audio(text, service.name, voice_key, options)
+            audio_data = get_tts_audio(text, service.name, voice_key, options)
 
-            # track client
+            # track client, request mode, service and audio language
             api_key = request.headers.get('api_key')
             client = request.headers.get('client')
             version = request.headers.get('client_version')
-            redis_connection.track_client(api_key, client, version)
-
-            # track request mode
-            redis_connection.track_request_mode(api_key, request_mode)
-
-            # track service
-            redis_connection.track_service(api_key, service)
-
-            # track audio language
-            redis_connection.track_audio_language(api_key, language_code)
-
-            # return data
-            return send_file(audio_temp_file.name, mimetype='audio/mpeg')
+            analytics = redis_connection.request_analytics(api_key)
+            analytics.track_client(client, version)
+            analytics.track_request_mode(request_mode)
+            analytics.track_service(service)
+            analytics.track_audio_language(language_code)
+
+            # return data, analytics get written once the response is sent
+            response = send_audio(audio_data)
+            response.call_on_close(functools.partial(write_request_analytics, analytics))
+            return response
         except cloudlanguagetools.errors.NotFoundError as err:
             return {'error': str(err)}, 404
         except cloudlanguagetools.errors.RequestError as err:
@@ -366,7 +714,7 @@ class AudioV2(flask_restful.Resource):
             return {'error': str(err)}, 400            
 
 class YomichanAudio(flask_restful.Resource):
-    method_decorators = [track_usage_audio_yomichan, authenticate_get]
+    method_decorators = [track_usage_audio_yomichan, yomichan_audio_not_modified, authenticate_get]
     def get(self):
         try:
             source_text = request.args.get('text')
@@ -377,8 +725,9 @@ class YomichanAudio(flask_restful.Resource):
             voice_key_json_str = urllib.parse.unquote_plus(voice_key_urlencode_str)
             voice_key = json.loads(voice_key_json_str)
             options = {}
-            audio_temp_file = manager.get_tts_audio(source_text, service, voice_key, options)
-            return send_file(audio_temp_file.name, mimetype='audio/mpeg')
+            audio_data = get_tts_audio(source_text, service, voice_key, options)
+            etag = get_yomichan_audio_etag()
+            return set_yomichan_audio_cache_headers(send_audio(audio_data, etag), etag)
         except cloudlanguagetools.errors.RequestError as err:
             sentry_sdk.capture_exception(err)
             return {'error': str(err)}, 400        
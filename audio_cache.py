@@ -0,0 +1,196 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'clt_audio_cache')
+# enforced by each worker, gunicorn workers sharing the directory can use up to workers * max_size_mb
+DEFAULT_MAX_SIZE_MB = 64
+
+def build_cache_key(text, service, voice_key, options):
+    # voice_key and options are dicts, key order must not matter
+    request_str = json.dumps({
+        'text': text,
+        'service': service,
+        'voice_key': voice_key,
+        'options': options
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(request_str.encode('utf-8')).hexdigest()
+
+class LocalAudioCache():
+    # audio files on local disk, the least recently used ones get removed once max_size_bytes is exceeded.
+    # the size is tracked per process, gunicorn workers sharing a directory each enforce their own bound.
+    def __init__(self, directory, max_size_bytes):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self.lock = threading.Lock()
+        # cache_key -> file size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.total_size = 0
+        self.load_entries()
+
+    def load_entries(self):
+        # pick up files written by a previous run, oldest first
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, cache_key, size in sorted(files):
+            self.entries[cache_key] = size
+            self.total_size += size
+        logger.info(f'audio cache {self.directory}: {len(self.entries)} files, {self.total_size} bytes')
+        self.evict()
+
+    def get_file_path(self, cache_key):
+        return os.path.join(self.directory, cache_key)
+
+    def get(self, cache_key):
+        with self.lock:
+            if cache_key not in self.entries:
+                return None
+            self.entries.move_to_end(cache_key)
+        try:
+            with open(self.get_file_path(cache_key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # removed by another worker
+            with self.lock:
+                size = self.entries.pop(cache_key, None)
+                if size != None:
+                    self.total_size -= size
+            return None
+
+    def put(self, cache_key, audio_data):
+        # write to a temporary file first, readers must never see a partial file
+        fd, temp_file_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(audio_data)
+        os.replace(temp_file_path, self.get_file_path(cache_key))
+        with self.lock:
+            previous_size = self.entries.pop(cache_key, None)
+            if previous_size != None:
+                self.total_size -= previous_size
+            self.entries[cache_key] = len(audio_data)
+            self.total_size += len(audio_data)
+        self.evict()
+
+    def evict(self):
+        removed_keys = []
+        with self.lock:
+            while self.total_size > self.max_size_bytes and len(self.entries) > 0:
+                cache_key, size = self.entries.popitem(last=False)
+                self.total_size -= size
+                removed_keys.append(cache_key)
+        for cache_key in removed_keys:
+            try:
+                os.remove(self.get_file_path(cache_key))
+            except FileNotFoundError:
+                pass
+
+class DirectoryAudioStore():
+    # shared tier backed by a directory, for example a volume mounted on all replicas
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, cache_key):
+        try:
+            with open(os.path.join(self.directory, cache_key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, cache_key, audio_data):
+        fd, temp_file_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(audio_data)
+        os.replace(temp_file_path, os.path.join(self.directory, cache_key))
+
+class S3AudioStore():
+    # shared tier backed by an S3 compatible bucket (digitalocean spaces, wasabi, minio)
+    def __init__(self, endpoint_url, access_key, secret_key, bucket_name, prefix='audio_cache/'):
+        import boto3
+        import botocore.exceptions
+        session = boto3.session.Session()
+        self.client = session.client('s3',
+                                endpoint_url=endpoint_url,
+                                aws_access_key_id=access_key,
+                                aws_secret_access_key=secret_key)
+        self.client_error = botocore.exceptions.ClientError
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def get(self, cache_key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=self.prefix + cache_key)
+            return response['Body'].read()
+        except self.client_error as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                return None
+            raise
+
+    def put(self, cache_key, audio_data):
+        self.client.put_object(Body=audio_data, Bucket=self.bucket_name, Key=self.prefix + cache_key)
+
+class AudioCache():
+    # content addressed TTS audio cache: a local disk tier, optionally backed by a shared tier.
+    # failures of the shared tier are logged, they never fail the request
+    def __init__(self, local_cache, shared_store=None):
+        self.local_cache = local_cache
+        self.shared_store = shared_store
+
+    def get(self, cache_key):
+        audio_data = self.local_cache.get(cache_key)
+        if audio_data != None:
+            return audio_data
+        if self.shared_store == None:
+            return None
+        try:
+            audio_data = self.shared_store.get(cache_key)
+        except Exception:
+            logger.exception(f'could not retrieve {cache_key} from shared audio cache')
+            return None
+        if audio_data != None:
+            try:
+                self.local_cache.put(cache_key, audio_data)
+            except Exception:
+                logger.exception(f'could not store {cache_key} in local audio cache')
+        return audio_data
+
+    def put(self, cache_key, audio_data):
+        self.local_cache.put(cache_key, audio_data)
+        if self.shared_store != None:
+            try:
+                self.shared_store.put(cache_key, audio_data)
+            except Exception:
+                logger.exception(f'could not store {cache_key} in shared audio cache')
+
+def build_audio_cache(config):
+    # config is the 'audio_cache' section of the secrets config, returns None unless enabled
+    if not config.get('enable', False):
+        return None
+
+    local_cache = LocalAudioCache(config.get('directory', DEFAULT_CACHE_DIRECTORY),
+                                  config.get('max_size_mb', DEFAULT_MAX_SIZE_MB) * 1024 * 1024)
+
+    shared_store = None
+    shared_config = config.get('shared', None)
+    if shared_config != None:
+        if shared_config['type'] == 'directory':
+            shared_store = DirectoryAudioStore(shared_config['directory'])
+        elif shared_config['type'] == 's3':
+            shared_store = S3AudioStore(shared_config['endpoint_url'],
+                                        shared_config['access_key'],
+                                        shared_config['secret_key'],
+                                        shared_config['bucket_name'])
+        else:
+            raise Exception(f"""unsupported shared audio cache type: {shared_config['type']}""")
+
+    return AudioCache(local_cache, shared_store)
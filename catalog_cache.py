@@ -0,0 +1,151 @@
+import gzip
+import json
+import hashlib
+import time
+import threading
+import logging
+import brotli
+import flask
+
+# compressed representations, in order of preference when the client accepts several with the same quality
+CONTENT_ENCODINGS = ['br', 'gzip']
+
+class CatalogResponse():
+    # a catalog document (language data, voice list, ...) serialized, hashed and compressed once,
+    # so that it can be served repeatedly without any json encoding. data is the document itself, when known
+    def __init__(self, body, data=None):
+        self.body = body
+        self.data = data
+        self.etag = hashlib.sha256(body).hexdigest()
+        self.encoded_bodies = {
+            'br': brotli.compress(body),
+            'gzip': gzip.compress(body)
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(json.dumps(data).encode('utf-8'), data)
+
+    def select_encoding(self, request):
+        # returns the preferred encoding accepted by the client, None for the uncompressed body
+        selected_encoding = None
+        selected_quality = 0
+        for encoding in CONTENT_ENCODINGS:
+            quality = request.accept_encodings.quality(encoding)
+            if quality > selected_quality:
+                selected_encoding = encoding
+                selected_quality = quality
+        return selected_encoding
+
+    def get_etag(self, encoding):
+        # each representation gets its own strong etag
+        if encoding == None:
+            return self.etag
+        return f'{self.etag}-{encoding}'
+
+    def make_response(self, request):
+        encoding = self.select_encoding(request)
+
+        # the client already has this version of the catalog
+        all_etags = [self.get_etag(x) for x in [None] + CONTENT_ENCODINGS]
+        if any([request.if_none_match.contains_weak(etag) for etag in all_etags]):
+            response = flask.Response(status=304)
+        elif encoding == None:
+            response = flask.Response(self.body, mimetype='application/json')
+        else:
+            response = flask.Response(self.encoded_bodies[encoding], mimetype='application/json')
+            response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(self.get_etag(encoding))
+        response.headers['Vary'] = 'Accept-Encoding'
+        # clients may keep the catalog, but should check whether it changed
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+class ManagerCatalog():
+    # a catalog built from the service manager. it's built once, then rebuilt periodically on a
+    # background thread (see start_catalog_refresh), requests are always served from the last build
+    def __init__(self, name, build_fn):
+        self.name = name
+        self.build_fn = build_fn
+        self.lock = threading.Lock()
+        self.catalog_response = None
+
+    def build(self):
+        start_time = time.time()
+        catalog_response = CatalogResponse.from_data(self.build_fn())
+        logging.info(f'built {self.name} catalog ({len(catalog_response.body)} bytes) in {time.time() - start_time:.1f}s')
+        return catalog_response
+
+    def get(self):
+        catalog_response = self.catalog_response
+        if catalog_response != None:
+            return catalog_response
+        # not built yet, only one thread builds it, the others wait
+        with self.lock:
+            if self.catalog_response == None:
+                self.catalog_response = self.build()
+            return self.catalog_response
+
+    def refresh(self):
+        # the previous version keeps being served while the new one is built
+        catalog_response = self.build()
+        self.catalog_response = catalog_response
+
+def start_catalog_refresh(catalog_list, interval_seconds):
+    def refresh_catalogs():
+        # initial build, through get() so that requests arriving in the meantime wait for it
+        for catalog in catalog_list:
+            try:
+                catalog.get()
+            except Exception:
+                logging.exception(f'could not build {catalog.name} catalog')
+        while True:
+            time.sleep(interval_seconds)
+            for catalog in catalog_list:
+                try:
+                    catalog.refresh()
+                except Exception:
+                    logging.exception(f'could not refresh {catalog.name} catalog')
+
+    thread = threading.Thread(target=refresh_catalogs, name='catalog_refresh', daemon=True)
+    thread.start()
+    return thread
+
+class LanguageDataCache():
+    # keeps the language data served by /language_data_v1 in memory, only re-fetching it
+    # from redis when the version stored alongside it changes. data stored without a version
+    # is re-fetched every unversioned_ttl_seconds, and only recompressed if its content changed
+    def __init__(self, redis_connection, unversioned_ttl_seconds=60):
+        self.redis_connection = redis_connection
+        self.unversioned_ttl_seconds = unversioned_ttl_seconds
+        self.lock = threading.Lock()
+        # (version, CatalogResponse, load time)
+        self.entry = (None, None, 0)
+
+    def entry_valid(self, version):
+        cached_version, catalog_response, load_time = self.entry
+        if catalog_response == None:
+            return False
+        if version != None:
+            return version == cached_version
+        return cached_version == None and time.time() - load_time < self.unversioned_ttl_seconds
+
+    def get(self):
+        version = self.redis_connection.get_language_data_version()
+        if self.entry_valid(version):
+            return self.entry[1]
+
+        with self.lock:
+            # another thread may have refreshed the data while we were waiting
+            if self.entry_valid(version):
+                return self.entry[1]
+
+            version, language_data_str = self.redis_connection.get_language_data_str_versioned()
+            body = language_data_str.encode('utf-8')
+            catalog_response = self.entry[1]
+            if catalog_response == None or hashlib.sha256(body).hexdigest() != catalog_response.etag:
+                catalog_response = CatalogResponse(body)
+                logging.info(f'loaded language data version {version}')
+            self.entry = (version, catalog_response, time.time())
+            return catalog_response
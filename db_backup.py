@@ -0,0 +1,134 @@
+import io
+import gzip
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# S3 requires every part but the last one to be at least 5MB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+class MultipartUploadWriter(io.RawIOBase):
+    # file-like object uploading what gets written to an S3 object, one part whenever part_size bytes
+    # are buffered. complete() stores the object, close() without complete() discards the upload, so that
+    # a writer closed on an error path (or garbage collected) never stores a truncated object
+    def __init__(self, client, bucket_name, object_key, part_size=DEFAULT_PART_SIZE):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.total_size = 0
+        response = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=self.object_key)
+        self.upload_id = response['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def upload_part(self, data):
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.object_key,
+                                           UploadId=self.upload_id, PartNumber=part_number, Body=data)
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.total_size += len(data)
+
+    def complete(self):
+        # an upload needs at least one part, even if it's empty
+        if len(self.buffer) > 0 or len(self.parts) == 0:
+            self.upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.object_key,
+                                              UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        logger.info(f'uploaded {self.object_key} to {self.bucket_name}: {len(self.parts)} parts, {self.total_size} bytes')
+        super().close()
+
+    def close(self):
+        self.abort()
+
+    def abort(self):
+        if self.closed:
+            return
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id)
+            logger.warning(f'aborted upload of {self.object_key} to {self.bucket_name}')
+        finally:
+            # even if the abort failed, the writer is done, the upload must not be completed later on
+            self.buffer.clear()
+            super().close()
+
+class TeeWriter(io.RawIOBase):
+    # writes everything to several file-like objects, so that one compressed stream feeds all backup targets
+    def __init__(self, writers):
+        self.writers = writers
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        for writer in self.writers:
+            writer.write(data)
+        return len(data)
+
+def write_ndjson_dump(records, fileobj, compresslevel=6):
+    # records: (key, type, value) tuples, see RedisDb.iter_db_dump. one json object per line, gzip compressed.
+    # returns the number of records written
+    record_count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=compresslevel) as gzip_file:
+        for key, key_type, value in records:
+            line = json.dumps({'key': key, 'type': key_type, 'value': value}, ensure_ascii=False) + '\n'
+            gzip_file.write(line.encode('utf-8'))
+            record_count += 1
+    return record_count
+
+def read_ndjson_dump(fileobj):
+    # yields the (key, type, value) tuples written by write_ndjson_dump
+    with gzip.GzipFile(fileobj=fileobj, mode='rb') as gzip_file:
+        for line in gzip_file:
+            if len(line.strip()) == 0:
+                continue
+            record = json.loads(line)
+            yield record['key'], record['type'], record['value']
+
+def upload_ndjson_dump(records, targets, part_size=DEFAULT_PART_SIZE):
+    # targets: (s3 client, bucket name, object key) tuples. the dump is compressed once, and streamed to all
+    # targets at the same time. uploads are only completed once the whole dump is written, if anything fails
+    # the uploads which aren't completed yet are aborted (a target completed before the failure keeps its
+    # object). returns the number of records
+    writers = []
+    try:
+        for client, bucket_name, object_key in targets:
+            writers.append(MultipartUploadWriter(client, bucket_name, object_key, part_size=part_size))
+        record_count = write_ndjson_dump(records, TeeWriter(writers))
+        for writer in writers:
+            writer.complete()
+        return record_count
+    except:
+        for writer in writers:
+            try:
+                writer.abort()
+            except Exception:
+                logger.exception(f'could not abort upload of {writer.object_key}')
+        raise
+
+def prune_backups(client, bucket_name, prefix, keep_count):
+    # backups are stored as <prefix><backup id>/..., with sortable backup ids. deletes all objects of
+    # the oldest backups, keeping the keep_count most recent ones
+    paginator = client.get_paginator('list_objects_v2')
+    backup_prefixes = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        backup_prefixes.extend([entry['Prefix'] for entry in page.get('CommonPrefixes', [])])
+    backup_prefixes = sorted(backup_prefixes)
+    for backup_prefix in backup_prefixes[:-keep_count] if keep_count > 0 else backup_prefixes:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=backup_prefix):
+            objects = [{'Key': entry['Key']} for entry in page.get('Contents', [])]
+            if len(objects) > 0:
+                client.delete_objects(Bucket=bucket_name, Delete={'Objects': objects})
+        logger.info(f'deleted backup {backup_prefix} from {bucket_name}')
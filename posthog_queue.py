@@ -0,0 +1,62 @@
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class PosthogEventQueue():
+    # posthog events are sent from a worker thread, off the request path. the queue is bounded: when it's
+    # full, events are dropped (and counted) rather than making the request wait. the daily per user limit
+    # (should_send_posthog_event) is checked on the worker thread as well
+    def __init__(self, posthog_client, redis_connection, max_size=10000):
+        self.posthog_client = posthog_client
+        self.redis_connection = redis_connection
+        self.queue = queue.Queue(maxsize=max_size)
+        self.lock = threading.Lock()
+        self.dropped_events = 0
+        self.failed_events = 0
+        self.thread = None
+
+    def submit(self, api_key, event, distinct_id, properties):
+        # never blocks, returns False if the event was dropped
+        try:
+            self.queue.put_nowait((api_key, event, distinct_id, properties))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped_events += 1
+                dropped_events = self.dropped_events
+            if dropped_events == 1 or dropped_events % 1000 == 0:
+                logger.warning(f'posthog event queue full, {dropped_events} events dropped so far')
+            return False
+
+    def process_event(self, api_key, event, distinct_id, properties):
+        if self.redis_connection.should_send_posthog_event(api_key):
+            self.posthog_client.capture(event=event, distinct_id=distinct_id, properties=properties)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item == None:
+                    return
+                self.process_event(*item)
+            except Exception:
+                with self.lock:
+                    self.failed_events += 1
+                logger.exception('could not send posthog event')
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='posthog_event_queue', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout_seconds=5):
+        # send the events which are still queued, then stop the worker
+        try:
+            self.queue.put(None, timeout=timeout_seconds)
+        except queue.Full:
+            return
+        if self.thread != None:
+            self.thread.join(timeout_seconds)
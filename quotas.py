@@ -12,6 +12,14 @@ EASYPRONUNCIATION_USER_DAILY_MAX_CHARACTERS = 136000
 
 FORVO_USER_DAILY_MAX_REQUESTS = 7000
 
+# rate limits (token buckets), as (requests per second, burst): per api key, across all services,
+# and per api key for services which are sensitive to bursts
+API_KEY_RATE_LIMIT = (20, 100)
+SERVICE_RATE_LIMITS = {
+    cloudlanguagetools.constants.Service.ElevenLabs: (4, 20),
+    cloudlanguagetools.constants.Service.Forvo: (4, 20),
+}
+
 GETCHEDDAR_CHAR_MULTIPLIER = 1000.0
 # no plan is greater than 2m/month
 GETCHEDDAR_MONTHLY_MAX_CHAR = 2000000
@@ -105,40 +113,98 @@ COST_TABLE = [
 
 ]
 
+# character cost per (service name, request type name), for usage reports
+CHARACTER_COSTS = {(entry['service'], entry['request_type']): entry['character_cost'] for entry in COST_TABLE}
+
+def get_character_cost(service_name: str, request_type_name: str) -> float:
+    # nan when the cost isn't known, it's left out of sums
+    return CHARACTER_COSTS.get((service_name, request_type_name), float('nan'))
+
+# the quota rules below are built once, at import time
+# ====================================================
+
+AZURE_DOUBLE_COUNT_LANGUAGES = frozenset([
+    cloudlanguagetools.languages.Language.ja,
+    cloudlanguagetools.languages.Language.ko,
+    cloudlanguagetools.languages.Language.yue,
+    cloudlanguagetools.languages.Language.zh_cn,
+    cloudlanguagetools.languages.Language.zh_tw
+])
+
+# character multipliers per (service, request_type, language), take precedence over the ones below
+LANGUAGE_CHARACTER_MULTIPLIERS = {
+    (cloudlanguagetools.constants.Service.Azure, cloudlanguagetools.constants.RequestType.audio, language): AZURE_CJK_CHAR_MULTIPLIER
+    for language in AZURE_DOUBLE_COUNT_LANGUAGES
+}
+
+# character multipliers per (service, request_type)
+CHARACTER_MULTIPLIERS = {
+    (cloudlanguagetools.constants.Service.Naver, cloudlanguagetools.constants.RequestType.audio): NAVER_AUDIO_CHAR_MULTIPLIER,
+    (cloudlanguagetools.constants.Service.ElevenLabs, cloudlanguagetools.constants.RequestType.audio): ELEVENLABS_AUDIO_CHAR_MULTIPLIER,
+    (cloudlanguagetools.constants.Service.OpenAI, cloudlanguagetools.constants.RequestType.audio): OPENAI_AUDIO_CHAR_MULTIPLIER,
+}
+
+# some services have daily restrictions, for every user
+USER_DAILY_CHARACTER_LIMITS = {
+    cloudlanguagetools.constants.Service.EasyPronunciation: EASYPRONUNCIATION_USER_DAILY_MAX_CHARACTERS
+}
+USER_DAILY_REQUEST_LIMITS = {
+    cloudlanguagetools.constants.Service.Forvo: FORVO_USER_DAILY_MAX_REQUESTS
+}
+
+# fixed character limits per (api key type, usage scope, usage period)
+KEY_TYPE_CHARACTER_LIMITS = {
+    (cloudlanguagetools.constants.ApiKeyType.getcheddar, cloudlanguagetools.constants.UsageScope.User, cloudlanguagetools.constants.UsagePeriod.monthly): GETCHEDDAR_MONTHLY_MAX_CHAR,
+    (cloudlanguagetools.constants.ApiKeyType.patreon, cloudlanguagetools.constants.UsageScope.User, cloudlanguagetools.constants.UsagePeriod.patreon_monthly): PATREON_MONTHLY_CHARACTER_LIMIT,
+}
+
+# key types which only have the limits listed above (and the getcheddar recurring quota), other checks don't apply
+KEY_TYPES_WITH_OWN_LIMITS = frozenset([
+    cloudlanguagetools.constants.ApiKeyType.getcheddar,
+    cloudlanguagetools.constants.ApiKeyType.patreon
+])
+
+# user usage periods which are not tied to a date
+UNDATED_USER_PERIODS = frozenset([
+    cloudlanguagetools.constants.UsagePeriod.recurring,
+    cloudlanguagetools.constants.UsagePeriod.lifetime
+])
+
+UNDATED_PERIOD_NAMES = frozenset([usage_period.name for usage_period in UNDATED_USER_PERIODS])
+
+DATE_FORMATS = {
+    cloudlanguagetools.constants.UsagePeriod.daily: '%Y%m%d',
+    cloudlanguagetools.constants.UsagePeriod.monthly: '%Y%m',
+    cloudlanguagetools.constants.UsagePeriod.patreon_monthly: '%Y%m',
+}
+
+def build_date_suffixes(date=None):
+    # date part of the usage keys for each period, built once per request and shared by all its usage slices
+    if date == None:
+        date = datetime.datetime.today()
+    return {usage_period: date.strftime(date_format) for usage_period, date_format in DATE_FORMATS.items()}
+
+def get_usage_index_suffix(key_suffix: str) -> str:
+    # scope:period:date, or scope:period for periods which are not tied to a date
+    components = key_suffix.split(':')
+    if components[1] in UNDATED_PERIOD_NAMES:
+        return ':'.join(components[0:2])
+    return ':'.join(components[0:3])
+
 def adjust_character_count(
     service: cloudlanguagetools.constants.Service, 
     request_type: cloudlanguagetools.constants.RequestType,
     language: cloudlanguagetools.languages.Language,
     characters: int):
-    
-    azure_double_count_languages = [
-            cloudlanguagetools.languages.Language.ja,
-            cloudlanguagetools.languages.Language.ko,
-            cloudlanguagetools.languages.Language.yue,
-            cloudlanguagetools.languages.Language.zh_cn,
-            cloudlanguagetools.languages.Language.zh_tw
-        ]
 
     if request_type == cloudlanguagetools.constants.RequestType.breakdown:  
         return characters * BREAKDOWN_CHAR_MULTIPLIER
 
-    if language != None:
-        if language in azure_double_count_languages:
-            if service == cloudlanguagetools.constants.Service.Azure:
-                if request_type == cloudlanguagetools.constants.RequestType.audio:
-                    return characters * AZURE_CJK_CHAR_MULTIPLIER
-
-    if service == cloudlanguagetools.constants.Service.Naver:
-        if request_type == cloudlanguagetools.constants.RequestType.audio:
-            return characters * NAVER_AUDIO_CHAR_MULTIPLIER
-
-    if service == cloudlanguagetools.constants.Service.ElevenLabs:
-        if request_type == cloudlanguagetools.constants.RequestType.audio:
-            return characters * ELEVENLABS_AUDIO_CHAR_MULTIPLIER
-
-    if service == cloudlanguagetools.constants.Service.OpenAI:
-        if request_type == cloudlanguagetools.constants.RequestType.audio:
-            return characters * OPENAI_AUDIO_CHAR_MULTIPLIER
+    multiplier = LANGUAGE_CHARACTER_MULTIPLIERS.get((service, request_type, language), None)
+    if multiplier == None:
+        multiplier = CHARACTER_MULTIPLIERS.get((service, request_type), None)
+    if multiplier != None:
+        return characters * multiplier
 
     return characters
 
@@ -150,7 +216,8 @@ class UsageSlice():
                 service: cloudlanguagetools.constants.Service, 
                 api_key: str,
                 api_key_type: cloudlanguagetools.constants.ApiKeyType,
-                api_key_data):
+                api_key_data,
+                date_suffixes=None):
         self.request_type = request_type
         self.usage_scope = usage_scope
         self.usage_period = usage_period
@@ -158,17 +225,20 @@ class UsageSlice():
         self.api_key = api_key
         self.api_key_type = api_key_type
         self.api_key_data = api_key_data
+        # see build_date_suffixes, computed when needed if not passed in
+        self.date_suffixes = date_suffixes
 
-    def build_key_suffix(self) -> str:
-        if self.usage_scope == cloudlanguagetools.constants.UsageScope.User and self.usage_period == cloudlanguagetools.constants.UsagePeriod.recurring:
-            return f'{self.usage_scope.key_str}:{self.usage_period.name}:{self.api_key}'
+    def get_date_suffix(self) -> str:
+        date_suffixes = self.date_suffixes
+        if date_suffixes == None:
+            date_suffixes = build_date_suffixes()
+        return date_suffixes.get(self.usage_period, date_suffixes[cloudlanguagetools.constants.UsagePeriod.monthly])
 
-        if self.usage_scope == cloudlanguagetools.constants.UsageScope.User and self.usage_period == cloudlanguagetools.constants.UsagePeriod.lifetime:
+    def build_key_suffix(self) -> str:
+        if self.usage_scope == cloudlanguagetools.constants.UsageScope.User and self.usage_period in UNDATED_USER_PERIODS:
             return f'{self.usage_scope.key_str}:{self.usage_period.name}:{self.api_key}'
 
-        date_str = datetime.datetime.today().strftime('%Y%m')
-        if self.usage_period == cloudlanguagetools.constants.UsagePeriod.daily:
-            date_str = datetime.datetime.today().strftime('%Y%m%d')
+        date_str = self.get_date_suffix()
 
         api_key_suffix = ''
         if self.usage_scope == cloudlanguagetools.constants.UsageScope.User:
@@ -180,50 +250,49 @@ class UsageSlice():
         return f'{self.usage_scope.key_str}:{self.usage_period.name}:{date_str}:{self.service.name}:{self.request_type.name}{api_key_suffix}'
 
 
-    def over_quota(self, characters, requests) -> bool:
-        # some services have daily restrictions
-        if self.usage_scope == cloudlanguagetools.constants.UsageScope.User:
-            if self.usage_period == cloudlanguagetools.constants.UsagePeriod.daily:
-                if self.service == cloudlanguagetools.constants.Service.EasyPronunciation:
-                    if characters > EASYPRONUNCIATION_USER_DAILY_MAX_CHARACTERS:
-                        return True
-                if self.service == cloudlanguagetools.constants.Service.Forvo:
-                    if requests > FORVO_USER_DAILY_MAX_REQUESTS:
-                        return True
-
-        # print(f'over_quota: usage_period: {self.usage_period} api_key_type: {self.api_key_type}')
-        if self.api_key_type == cloudlanguagetools.constants.ApiKeyType.getcheddar:
-            if self.usage_scope == cloudlanguagetools.constants.UsageScope.User:
-                if self.usage_period == cloudlanguagetools.constants.UsagePeriod.monthly:
-                    if characters > GETCHEDDAR_MONTHLY_MAX_CHAR:
-                        return True
-
-            if self.usage_period == cloudlanguagetools.constants.UsagePeriod.recurring:
-                if self.api_key_data['thousand_char_overage_allowed'] == 1:
-                    # overages allowed, don't restrict
-                    return False
-                total_chars = GETCHEDDAR_CHAR_MULTIPLIER * self.api_key_data['thousand_char_used'] + characters
-                allowed_chars = GETCHEDDAR_CHAR_MULTIPLIER * self.api_key_data['thousand_char_quota']
-                # print(f'total_chars: {total_chars} allowed_chars: {allowed_chars}')
-                if total_chars > allowed_chars:
-                    return True
-            # don't run through other checks for getcheddar users
-            return False
-
-        if self.api_key_type == cloudlanguagetools.constants.ApiKeyType.patreon:
-            if self.usage_period == cloudlanguagetools.constants.UsagePeriod.patreon_monthly:
-                if characters > PATREON_MONTHLY_CHARACTER_LIMIT:
-                    return True
-            # don't run through other checks for patreon users
-            return False
+    def build_index_suffix(self) -> str:
+        # usage keys are indexed by scope, period and date (see RedisDb.build_usage_index_key)
+        return get_usage_index_suffix(self.build_key_suffix())
 
-        if self.usage_scope == cloudlanguagetools.constants.UsageScope.User:
-            if self.usage_period == cloudlanguagetools.constants.UsagePeriod.lifetime:
-                character_limit = self.api_key_data.get('character_limit', None)
-                if character_limit != None:
-                    if characters > character_limit:
-                        return True
+    def character_limit(self):
+        # maximum number of characters allowed on this slice, None if unrestricted
+        if self.usage_scope == cloudlanguagetools.constants.UsageScope.User and self.usage_period == cloudlanguagetools.constants.UsagePeriod.daily:
+            character_limit = USER_DAILY_CHARACTER_LIMITS.get(self.service, None)
+            if character_limit != None:
+                return character_limit
 
-        return False
+        character_limit = KEY_TYPE_CHARACTER_LIMITS.get((self.api_key_type, self.usage_scope, self.usage_period), None)
+        if character_limit != None:
+            return character_limit
+
+        if self.api_key_type == cloudlanguagetools.constants.ApiKeyType.getcheddar and self.usage_period == cloudlanguagetools.constants.UsagePeriod.recurring:
+            if self.api_key_data['thousand_char_overage_allowed'] == 1:
+                # overages allowed, don't restrict
+                return None
+            # characters already reported to getcheddar count against the quota
+            allowed_chars = GETCHEDDAR_CHAR_MULTIPLIER * self.api_key_data['thousand_char_quota']
+            used_chars = GETCHEDDAR_CHAR_MULTIPLIER * self.api_key_data['thousand_char_used']
+            return allowed_chars - used_chars
+
+        if self.api_key_type in KEY_TYPES_WITH_OWN_LIMITS:
+            return None
 
+        if self.usage_scope == cloudlanguagetools.constants.UsageScope.User and self.usage_period == cloudlanguagetools.constants.UsagePeriod.lifetime:
+            return self.api_key_data.get('character_limit', None)
+
+        return None
+
+    def request_limit(self):
+        # maximum number of requests allowed on this slice, None if unrestricted
+        if self.usage_scope == cloudlanguagetools.constants.UsageScope.User and self.usage_period == cloudlanguagetools.constants.UsagePeriod.daily:
+            return USER_DAILY_REQUEST_LIMITS.get(self.service, None)
+        return None
 
+    def over_quota(self, characters, requests) -> bool:
+        character_limit = self.character_limit()
+        if character_limit != None and characters > character_limit:
+            return True
+        request_limit = self.request_limit()
+        if request_limit != None and requests > request_limit:
+            return True
+        return False
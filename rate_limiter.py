@@ -0,0 +1,106 @@
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# size of the local fast path, expired entries get pruned once it's reached
+MAX_BLOCKED_ENTRIES = 10000
+
+# token buckets, stored as hashes (tokens, timestamp). a request takes one token from every bucket,
+# or from none of them if one is empty.
+# KEYS: bucket keys
+# ARGV: current time (seconds, float), then a (rate, burst) pair for every key
+# returns 0 if the request is allowed, otherwise the number of milliseconds until it would be
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+local retry_after = 0
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'timestamp')
+    local bucket_tokens = burst
+    if bucket[1] then
+        local elapsed = math.max(0, now - tonumber(bucket[2]))
+        bucket_tokens = math.min(burst, tonumber(bucket[1]) + elapsed * rate)
+    end
+    if bucket_tokens < 1 then
+        retry_after = math.max(retry_after, math.ceil((1 - bucket_tokens) / rate * 1000))
+    end
+    tokens[i] = bucket_tokens
+end
+
+if retry_after > 0 then
+    return retry_after
+end
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'timestamp', ARGV[1])
+    -- a bucket left alone for that long is full again, no need to keep it
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return 0
+"""
+
+class TokenBucketRateLimiter():
+    # smooths bursts: one bucket per api key, and one per api key and service for the services listed in
+    # service_limits. limits are (rate in requests per second, burst) pairs, see quotas.py.
+    # the buckets live in redis, shared by all workers. the local fast path remembers until when a bucket
+    # is empty, requests arriving before then are rejected without a round trip
+    def __init__(self, redis_client, api_key_limit, service_limits, key_prefix='clt:rate_limit'):
+        self.redis_client = redis_client
+        self.api_key_limit = api_key_limit
+        self.service_limits = service_limits
+        self.key_prefix = key_prefix
+        self.token_bucket_script = self.redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.lock = threading.Lock()
+        # bucket key tuple -> time.time() until which requests are rejected
+        self.blocked_until = {}
+
+    def get_buckets(self, api_key, service):
+        buckets = [(f'{self.key_prefix}:{api_key}', self.api_key_limit)]
+        service_limit = self.service_limits.get(service, None)
+        if service_limit != None:
+            buckets.append((f'{self.key_prefix}:{api_key}:{service.name}', service_limit))
+        return buckets
+
+    def check(self, api_key, service):
+        # takes a token, returns None if the request is allowed, otherwise the number of seconds to wait
+        buckets = self.get_buckets(api_key, service)
+        keys = tuple([key for key, limit in buckets])
+        now = time.time()
+
+        with self.lock:
+            blocked_until = self.blocked_until.get(keys, None)
+            if blocked_until != None:
+                if now < blocked_until:
+                    return blocked_until - now
+                del self.blocked_until[keys]
+
+        args = [now]
+        for key, (rate, burst) in buckets:
+            args.extend([rate, burst])
+        try:
+            retry_after_ms = self.token_bucket_script(keys=list(keys), args=args)
+        except Exception:
+            # rate limiting protects the upstream services, it must not take the api down with redis
+            logger.exception(f'could not check rate limit for {keys}')
+            return None
+
+        if retry_after_ms == 0:
+            return None
+        retry_after = retry_after_ms / 1000.0
+        with self.lock:
+            if len(self.blocked_until) >= MAX_BLOCKED_ENTRIES:
+                self.blocked_until = {k: v for k, v in self.blocked_until.items() if v > now}
+            self.blocked_until[keys] = now + retry_after
+        return retry_after
+
+def get_retry_after_header(retry_after):
+    # Retry-After is a whole number of seconds
+    return str(max(1, math.ceil(retry_after)))
@@ -49,6 +49,11 @@ def main():
                'show_string_key',
                'remove_key',
                'modify_key_expiration',
+               'result_cache_opt_out',
+               'result_cache_opt_in',
+               'rebuild_indexes',
+               'sweep_expired_api_keys',
+               'list_expired_api_keys',
                'backup_redis_db',
                'restore_redis_db']
     parser.add_argument('--action', choices=choices, help='Indicate what to do', required=True)
@@ -59,6 +64,7 @@ def main():
     parser.add_argument('--dbnum', help='connect to a different db number', type=int)
     parser.add_argument('--redis_key', help='redis key to operate on')
     parser.add_argument('--redis_backup_file', help='backup file')
+    parser.add_argument('--restore_workers', help='number of parallel restore workers', type=int, default=8)
 
 
     args = parser.parse_args()
@@ -120,11 +126,25 @@ def main():
         expiration = args.expiration
         redis_api_key = connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key)
         print(f'redis_api_key: {redis_api_key}')
-        connection.r.hset(redis_api_key, 'expiration', expiration)
+        connection.set_api_key_expiration(api_key, expiration)
+    elif args.action == 'result_cache_opt_out':
+        # never cache translation / transliteration / tokenization results for this api key
+        connection.set_result_cache_opt_out(args.api_key, True)
+    elif args.action == 'result_cache_opt_in':
+        connection.set_result_cache_opt_out(args.api_key, False)
+    elif args.action == 'rebuild_indexes':
+        # api keys by type / expiration, usage keys by period. run once after deploying, and after a restore
+        connection.rebuild_indexes()
+    elif args.action == 'sweep_expired_api_keys':
+        archived_count = connection.sweep_expired_api_keys()
+        print(f'archived {archived_count} expired api keys')
+    elif args.action == 'list_expired_api_keys':
+        for api_key, expiration in connection.list_expired_api_keys():
+            print(f'{api_key}: expired {datetime.datetime.fromtimestamp(expiration)}')
     elif args.action == 'restore_redis_db':
         json_file_path = args.redis_backup_file
         logging.info(f'restoring redis DB from file: {json_file_path}')
-        connection.restore_db_backup(json_file_path)
+        connection.restore_db_backup(json_file_path, workers=args.restore_workers)
     else:
         print(f'not recognized: {args.action}')
 
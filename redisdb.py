@@ -6,9 +6,16 @@ import json
 import string
 import random
 import logging
+import base64
+import hashlib
+import itertools
+import threading
+import collections
+import concurrent.futures
 import cloudlanguagetools.constants
 import cloudlanguagetools.errors
 import quotas
+import db_backup
 import clt_secrets as secrets
 
 KEY_TYPE_API_KEY = 'api_key'
@@ -23,15 +30,377 @@ KEY_TYPE_USER_SERVICE ='user_service'
 KEY_TYPE_USER_AUDIO_LANGUAGE ='user_audio_language'
 KEY_TYPE_AUDIO_LOG ='audio_log'
 KEY_TYPE_POSTHOG_DAILY = 'posthog_daily'
+# secondary indexes: api keys by type and by expiration, usage keys by scope / period / date
+KEY_TYPE_API_KEY_INDEX = 'api_key_index'
+KEY_TYPE_USAGE_INDEX = 'usage_index'
+# the usage index keys of every scope / period, so that all the dates of a period can be listed
+KEY_TYPE_USAGE_INDEX_LIST = 'usage_index_list'
+# api key hashes moved out of the hot keyspace once expired, see sweep_expired_api_keys
+KEY_TYPE_EXPIRED_API_KEY = 'expired_api_key'
 
 KEY_PREFIX = 'clt'
 
 LANGUAGE_DATA_KEY = 'language_data_v1'
+LANGUAGE_DATA_VERSION_KEY = 'language_data_v1_version'
+
+# pub/sub channel on which modified clt:api_key keys are announced to all processes
+API_KEY_INVALIDATION_CHANNEL = 'api_key_invalidation'
+# returned by load_api_key_data (and cached) for api keys moved to clt:expired_api_key
+ARCHIVED_API_KEY = 'archived'
+
+# incremental backups: set of keys modified since the last backup, and the backup state hash.
+# keys under clt:backup: are never backed up themselves
+BACKUP_KEY_PREFIX = 'backup:'
+BACKUP_DIRTY_KEYS_KEY = 'backup:dirty_keys'
+BACKUP_STATE_KEY = 'backup:state'
+
+# check every usage slice against its limits, then increment all of them, in a single atomic call.
+# KEYS: usage slice keys, then the usage index key of every slice, then the usage index list key of every
+# slice, then the backup dirty keys set (only passed when incremental backups are enabled)
+# ARGV: characters, expire time, then a (character limit, request limit) pair for every slice ('' when unrestricted)
+# returns 0 if usage was recorded, otherwise the 1-based index of the first slice over quota
+TRACK_USAGE_SCRIPT = """
+local characters = tonumber(ARGV[1])
+local expire_time_seconds = tonumber(ARGV[2])
+local slice_count = (#ARGV - 2) / 2
+
+for i = 1, slice_count do
+    local key = KEYS[i]
+    local character_limit = ARGV[1 + 2 * i]
+    local request_limit = ARGV[2 + 2 * i]
+    if character_limit ~= '' or request_limit ~= '' then
+        local usage = redis.call('HMGET', key, 'characters', 'requests')
+        local current_characters = 0
+        local current_requests = 0
+        if usage[1] then current_characters = tonumber(usage[1]) end
+        if usage[2] then current_requests = tonumber(usage[2]) end
+        if character_limit ~= '' and current_characters + characters > tonumber(character_limit) then
+            return i
+        end
+        if request_limit ~= '' and current_requests + 1 > tonumber(request_limit) then
+            return i
+        end
+    end
+end
+
+for i = 1, slice_count do
+    local key = KEYS[i]
+    redis.call('HINCRBY', key, 'characters', characters)
+    redis.call('HINCRBY', key, 'requests', 1)
+    redis.call('EXPIRE', key, expire_time_seconds)
+    local index_key = KEYS[slice_count + i]
+    redis.call('SADD', index_key, key)
+    redis.call('EXPIRE', index_key, expire_time_seconds)
+    local index_list_key = KEYS[2 * slice_count + i]
+    redis.call('SADD', index_list_key, index_key)
+    redis.call('EXPIRE', index_list_key, expire_time_seconds)
+    if #KEYS > 3 * slice_count then
+        redis.call('SADD', KEYS[3 * slice_count + 1], key)
+    end
+end
+
+return 0
+"""
+
+# moves expired api keys out of the hot keyspace. each key is checked again against the expiration index,
+# a key whose expiration was extended since it was listed is left alone, a key whose hash no longer exists
+# is only removed from the indexes.
+# KEYS[1]: expiration index, KEYS[2]: expired index, KEYS[3 .. 2 + ARGV[2]]: api key type indexes,
+# then a (clt:api_key, clt:expired_api_key) pair for every api key
+# ARGV[1]: cutoff timestamp, ARGV[2]: number of type indexes, then the api keys
+# returns the api keys which got archived
+ARCHIVE_EXPIRED_API_KEYS_SCRIPT = """
+local cutoff = tonumber(ARGV[1])
+local first = 3 + tonumber(ARGV[2])
+local archived = {}
+
+for i = first, #KEYS, 2 do
+    local api_key = ARGV[3 + (i - first) / 2]
+    local expiration = redis.call('ZSCORE', KEYS[1], api_key)
+    if expiration and tonumber(expiration) <= cutoff then
+        redis.call('ZREM', KEYS[1], api_key)
+        for j = 3, first - 1 do
+            redis.call('SREM', KEYS[j], api_key)
+        end
+        if redis.call('EXISTS', KEYS[i]) == 1 then
+            redis.call('RENAME', KEYS[i], KEYS[i + 1])
+            redis.call('ZADD', KEYS[2], expiration, api_key)
+            table.insert(archived, api_key)
+        end
+    end
+end
+return archived
+"""
+
+# swaps a rebuilt api key index in, without losing the updates made to the live index while it was being
+# rebuilt: members added (or re-scored) since the snapshot are added to the rebuilt index, members removed
+# since then are removed from it.
+# KEYS[1]: live index, KEYS[2]: snapshot of the live index taken before the keyspace was scanned,
+# KEYS[3]: rebuilt index. ARGV[1]: 'set' or 'zset'
+MERGE_REBUILT_INDEX_SCRIPT = """
+if ARGV[1] == 'set' then
+    for _, member in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+        if redis.call('SISMEMBER', KEYS[2], member) == 0 then
+            redis.call('SADD', KEYS[3], member)
+        end
+    end
+    for _, member in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+        if redis.call('SISMEMBER', KEYS[1], member) == 0 then
+            redis.call('SREM', KEYS[3], member)
+        end
+    end
+else
+    local live = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+    for i = 1, #live, 2 do
+        if redis.call('ZSCORE', KEYS[2], live[i]) ~= live[i + 1] then
+            redis.call('ZADD', KEYS[3], live[i + 1], live[i])
+        end
+    end
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+        if not redis.call('ZSCORE', KEYS[1], member) then
+            redis.call('ZREM', KEYS[3], member)
+        end
+    end
+end
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    redis.call('RENAME', KEYS[3], KEYS[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+redis.call('DEL', KEYS[2])
+return 0
+"""
+
+class ApiKeyCache():
+    # bounded LRU cache of decoded api key records, shared by api key validation and usage tracking.
+    # keys which don't exist (or which got archived) are cached too, for a shorter time, so that invalid keys
+    # don't hit redis
+    def __init__(self, max_size=10000, ttl_seconds=60, negative_ttl_seconds=10):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        # bumped by every invalidation, a record loaded while an invalidation happened may be stale
+        self.generation = 0
+
+    def get_generation(self):
+        # to be read before loading a record from redis, then passed to set()
+        with self.lock:
+            return self.generation
+
+    def get(self, api_key):
+        # returns (found, api_key_data), api_key_data is None if the key is known not to exist,
+        # ARCHIVED_API_KEY if it's known to be archived
+        with self.lock:
+            entry = self.entries.get(api_key, None)
+            if entry == None:
+                return False, None
+            expire_time, api_key_data = entry
+            if expire_time < time.monotonic():
+                del self.entries[api_key]
+                return False, None
+            self.entries.move_to_end(api_key)
+        if not isinstance(api_key_data, dict):
+            return True, api_key_data
+        return True, dict(api_key_data)
+
+    def set(self, api_key, api_key_data, generation=None):
+        # the record isn't stored if the cache got invalidated since generation was read
+        if not isinstance(api_key_data, dict):
+            expire_time = time.monotonic() + self.negative_ttl_seconds
+        else:
+            expire_time = time.monotonic() + self.ttl_seconds
+            api_key_data = dict(api_key_data)
+        with self.lock:
+            if generation != None and generation != self.generation:
+                return
+            self.entries[api_key] = (expire_time, api_key_data)
+            self.entries.move_to_end(api_key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, api_key):
+        with self.lock:
+            self.entries.pop(api_key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+class RequestAnalytics():
+    # collects the per request analytics counters (client, client version, request mode, service, audio language)
+    # and writes them in a single non transactional pipeline. write() can be deferred until the response is sent
+    def __init__(self, redis_db, api_key):
+        self.redis_db = redis_db
+        self.api_key = api_key
+        # (key_type, hash field)
+        self.counters = []
+
+    def track_client(self, client_str, version):
+        # raises KeyError if the client is unknown, before anything gets deferred
+        client = cloudlanguagetools.constants.Client[client_str]
+        self.counters.append((KEY_TYPE_USER_CLIENT, client.name))
+        self.counters.append((KEY_TYPE_USER_CLIENT_VERSION, f'{client_str}_{version}'))
+
+    def track_request_mode(self, request_mode):
+        self.counters.append((KEY_TYPE_USER_REQUEST_MODE, request_mode.name))
+
+    def track_service(self, service):
+        self.counters.append((KEY_TYPE_USER_SERVICE, service.name))
+
+    def track_audio_language(self, language_code):
+        self.counters.append((KEY_TYPE_USER_AUDIO_LANGUAGE, language_code.name))
+
+    def write(self):
+        if len(self.counters) == 0:
+            return
+        analytics_queue = self.redis_db.analytics_queue
+        if analytics_queue != None:
+            for key_type, field in self.counters:
+                analytics_queue.hincrby(self.redis_db.build_monthly_user_key(key_type, self.api_key), field)
+            self.counters = []
+            return
+        expire_time_seconds = self.redis_db.get_expire_time_usage()
+        pipe = self.redis_db.r.pipeline(transaction=False)
+        redis_keys = []
+        for key_type, field in self.counters:
+            redis_key = self.redis_db.build_monthly_user_key(key_type, self.api_key)
+            pipe.hincrby(redis_key, field, 1)
+            pipe.expire(redis_key, expire_time_seconds)
+            redis_keys.append(redis_key)
+        self.redis_db.mark_dirty(pipe, redis_keys)
+        pipe.execute()
+        self.counters = []
+
+class AnalyticsQueue():
+    # write-behind buffer for analytics counters and audio log entries. counters are aggregated in memory
+    # (50 identical hincrby calls become a single hincrby ... 50), a background thread writes everything in
+    # one non transactional pipeline every flush_interval_seconds, or as soon as max_pending_events are queued.
+    # redis keys are built when the event is queued, so the monthly hash layout is unchanged.
+    # a batch which couldn't be written is put back, unless more than max_requeued_events are already waiting
+    def __init__(self, redis_db, flush_interval_seconds=5, max_pending_events=1000, max_requeued_events=100000):
+        self.redis_db = redis_db
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending_events = max_pending_events
+        self.max_requeued_events = max_requeued_events
+        self.lock = threading.Lock()
+        # (redis_key, field) -> increment
+        self.counters = collections.Counter()
+        # redis_key -> list of values to rpush
+        self.list_entries = collections.defaultdict(list)
+        self.pending_events = 0
+        self.flush_requested = threading.Event()
+        self.stopped = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def hincrby(self, redis_key, field, amount=1):
+        with self.lock:
+            self.counters[(redis_key, field)] += amount
+            self.add_pending_event()
+
+    def rpush(self, redis_key, value_str):
+        with self.lock:
+            self.list_entries[redis_key].append(value_str)
+            self.add_pending_event()
+
+    def add_pending_event(self):
+        # called with self.lock held
+        self.pending_events += 1
+        if self.pending_events >= self.max_pending_events:
+            self.flush_requested.set()
+
+    def flush(self):
+        # flush_lock makes sure that a batch put back after a failure doesn't get written twice
+        with self.flush_lock:
+            with self.lock:
+                counters = self.counters
+                list_entries = self.list_entries
+                self.counters = collections.Counter()
+                self.list_entries = collections.defaultdict(list)
+                self.pending_events = 0
+            if len(counters) == 0 and len(list_entries) == 0:
+                return
+
+            expire_time_seconds = self.redis_db.get_expire_time_usage()
+            redis_keys = set()
+            # MULTI / EXEC: a batch is applied entirely or not at all, retrying it can't double count
+            pipe = self.redis_db.r.pipeline(transaction=True)
+            for (redis_key, field), amount in counters.items():
+                pipe.hincrby(redis_key, field, amount)
+                redis_keys.add(redis_key)
+            for redis_key, values in list_entries.items():
+                pipe.rpush(redis_key, *values)
+                redis_keys.add(redis_key)
+            for redis_key in redis_keys:
+                pipe.expire(redis_key, expire_time_seconds)
+            self.redis_db.mark_dirty(pipe, redis_keys)
+            event_count = len(counters) + sum([len(values) for values in list_entries.values()])
+            try:
+                pipe.execute()
+            except redis.exceptions.RedisError:
+                logging.exception(f'could not flush analytics, {len(counters)} counters, {len(list_entries)} lists')
+                with self.lock:
+                    if self.pending_events + event_count > self.max_requeued_events:
+                        logging.error(f'dropping {event_count} analytics events, {self.pending_events} events already waiting')
+                        return
+                    # put the batch back, it will be retried on the next flush
+                    self.counters.update(counters)
+                    for redis_key, values in list_entries.items():
+                        self.list_entries[redis_key] = values + self.list_entries[redis_key]
+                    self.pending_events += event_count
+            except Exception:
+                logging.exception(f'dropping {event_count} analytics events')
+                raise
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.flush_requested.wait(self.flush_interval_seconds)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('could not flush analytics')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='analytics_queue', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # stop the background thread and write whatever is still queued, on worker shutdown
+        self.stopped.set()
+        self.flush_requested.set()
+        if self.thread != None:
+            self.thread.join()
+        self.flush()
+
+def incremental_backup_enabled():
+    # read by the web tier, which records dirty keys, and by the scheduled tasks, which drain them
+    return secrets.config.get('scheduled_tasks', {}).get('incremental_backup', False)
 
 class RedisDb():
-    def __init__(self):
+    def __init__(self, api_key_cache=None, track_dirty_keys=None):
+        self.api_key_cache = api_key_cache
+        self.analytics_queue = None
+        # the dirty keys set is only drained by incremental backups, don't fill it up otherwise
+        if track_dirty_keys == None:
+            track_dirty_keys = incremental_backup_enabled()
+        self.track_dirty_keys = track_dirty_keys
         self.connect()
 
+    def enable_analytics_queue(self, flush_interval_seconds=5, max_pending_events=1000, max_requeued_events=100000):
+        # from now on, analytics are written behind by a background thread, see AnalyticsQueue
+        self.analytics_queue = AnalyticsQueue(self, flush_interval_seconds=flush_interval_seconds, max_pending_events=max_pending_events, max_requeued_events=max_requeued_events)
+        self.analytics_queue.start()
+        return self.analytics_queue
+
+    def flush_analytics(self):
+        if self.analytics_queue != None:
+            self.analytics_queue.flush()
+
     def verify_connection(self):
         self.r.ping()
 
@@ -40,6 +409,11 @@ class RedisDb():
         logging.info(f'connecting to redis url: {redis_url}, db_num: {db_num}')
 
         self.r = redis.from_url(redis_url, db=db_num, decode_responses=True)
+        # DUMP payloads are binary, they can't be decoded
+        self.r_binary = redis.from_url(redis_url, db=db_num, decode_responses=False)
+        self.track_usage_script = self.r.register_script(TRACK_USAGE_SCRIPT)
+        self.archive_expired_api_keys_script = self.r.register_script(ARCHIVE_EXPIRED_API_KEYS_SCRIPT)
+        self.merge_rebuilt_index_script = self.r.register_script(MERGE_REBUILT_INDEX_SCRIPT)
 
     def build_key(self, key_type, key):
         return f'{KEY_PREFIX}:{key_type}:{key}'
@@ -47,15 +421,82 @@ class RedisDb():
     def build_global_key(self, key):
         return f'{KEY_PREFIX}:{key}'
 
+    def invalidate_api_key(self, api_key):
+        # must be called whenever the clt:api_key hash of this key gets modified
+        if self.api_key_cache != None:
+            self.api_key_cache.invalidate(api_key)
+        # other web workers / replicas may hold this key in their cache too
+        redis_api_key = self.build_key(KEY_TYPE_API_KEY, api_key)
+        self.mark_dirty(self.r, [redis_api_key])
+        self.r.publish(self.build_global_key(API_KEY_INVALIDATION_CHANNEL), redis_api_key)
+
+    def mark_dirty(self, pipe, redis_keys):
+        # records keys modified (or deleted) since the last backup, for incremental backups. pipe can be
+        # a pipeline or the connection itself. caches, rate limits, daily posthog counters and index sets
+        # aren't tracked, indexes get rebuilt after a restore. does nothing unless incremental backups are enabled
+        if self.track_dirty_keys and len(redis_keys) > 0:
+            pipe.sadd(self.build_global_key(BACKUP_DIRTY_KEYS_KEY), *redis_keys)
+
+    def listen_api_key_invalidations(self):
+        # blocks forever, evicting api keys modified by other processes from the local cache.
+        # meant to run on a background thread
+        channel = self.build_global_key(API_KEY_INVALIDATION_CHANNEL)
+        api_key_prefix = self.build_key(KEY_TYPE_API_KEY, '')
+        retry_delay_seconds = 1
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                logging.info(f'listening for api key invalidations on {channel}')
+                # invalidations may have been missed while we weren't subscribed
+                self.api_key_cache.clear()
+                retry_delay_seconds = 1
+                for message in pubsub.listen():
+                    redis_api_key = message['data']
+                    if redis_api_key.startswith(api_key_prefix):
+                        self.api_key_cache.invalidate(redis_api_key[len(api_key_prefix):])
+            except Exception:
+                # whatever happened, this thread must keep going, or the cache would serve stale keys
+                logging.exception(f'error while listening on {channel}, resubscribing in {retry_delay_seconds}s')
+            finally:
+                if pubsub != None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        logging.exception(f'could not close subscription to {channel}')
+            time.sleep(retry_delay_seconds)
+            retry_delay_seconds = min(retry_delay_seconds * 2, 30)
+
     def store_language_data(self, language_data):
         redis_key = self.build_global_key(LANGUAGE_DATA_KEY)
-        logging.info(f'storing language_data into {redis_key}')
-        self.r.set(redis_key, json.dumps(language_data))
+        version_redis_key = self.build_global_key(LANGUAGE_DATA_VERSION_KEY)
+        language_data_str = json.dumps(language_data)
+        # the version lets the web tier know when to re-fetch the (large) language data
+        version = hashlib.sha256(language_data_str.encode('utf-8')).hexdigest()
+        logging.info(f'storing language_data into {redis_key}, version {version}')
+        pipe = self.r.pipeline()
+        pipe.set(redis_key, language_data_str)
+        pipe.set(version_redis_key, version)
+        self.mark_dirty(pipe, [redis_key, version_redis_key])
+        pipe.execute()
 
     def get_language_data(self):
         redis_key = self.build_global_key(LANGUAGE_DATA_KEY)
         return json.loads(self.r.get(redis_key))
 
+    def get_language_data_version(self):
+        # None if the language data was stored without a version
+        return self.r.get(self.build_global_key(LANGUAGE_DATA_VERSION_KEY))
+
+    def get_language_data_str_versioned(self):
+        # returns (version, serialized language data), read atomically
+        pipe = self.r.pipeline()
+        pipe.get(self.build_global_key(LANGUAGE_DATA_VERSION_KEY))
+        pipe.get(self.build_global_key(LANGUAGE_DATA_KEY))
+        version, language_data_str = pipe.execute()
+        return version, language_data_str
+
 
     def build_monthly_user_key(self, key_type, api_key, prev_month=False):
         if prev_month:
@@ -88,7 +529,11 @@ class RedisDb():
             'expiration': self.get_api_key_expiration_timestamp(),
             'type': cloudlanguagetools.constants.ApiKeyType.test.name
         }
-        self.r.hset(redis_key, mapping=hash_value)
+        pipe = self.r.pipeline()
+        pipe.hset(redis_key, mapping=hash_value)
+        self.index_api_key(pipe, api_key, hash_value['type'], hash_value['expiration'])
+        pipe.execute()
+        self.invalidate_api_key(api_key)
         logging.info(f'added {redis_key}: {hash_value}')
 
     # prod workflow (app.py/patreon_key)
@@ -100,7 +545,11 @@ class RedisDb():
             'expiration': self.get_api_key_expiration_timestamp(),
             'type': cloudlanguagetools.constants.ApiKeyType.patreon.name
         }
-        self.r.hset(redis_key, mapping=hash_value)
+        pipe = self.r.pipeline()
+        pipe.hset(redis_key, mapping=hash_value)
+        self.index_api_key(pipe, api_key, hash_value['type'], hash_value['expiration'])
+        pipe.execute()
+        self.invalidate_api_key(api_key)
         logging.info(f'added {redis_key}: {hash_value}')
 
     def add_trial_api_key(self, api_key, email, character_limit):
@@ -111,7 +560,11 @@ class RedisDb():
             'type': cloudlanguagetools.constants.ApiKeyType.trial.name,
             'character_limit': character_limit
         }
-        self.r.hset(redis_key, mapping=hash_value)
+        pipe = self.r.pipeline()
+        pipe.hset(redis_key, mapping=hash_value)
+        self.index_api_key(pipe, api_key, hash_value['type'], hash_value['expiration'])
+        pipe.execute()
+        self.invalidate_api_key(api_key)
         logging.info(f'added {redis_key}: {hash_value}')        
         
     # prod workflow
@@ -132,8 +585,8 @@ class RedisDb():
             # user already requested a key
             api_key = self.r.get(redis_trial_user_key)
             redis_api_key = self.build_key(KEY_TYPE_API_KEY, api_key)
-            if not self.r.exists(redis_api_key):
-                # add the key back in
+            if not self.r.exists(redis_api_key) and not self.api_key_archived(api_key):
+                # add the key back in (an expired trial key stays expired)
                 self.add_trial_api_key(api_key, email, quotas.TRIAL_USER_CHARACTER_LIMIT)
             return api_key
         
@@ -143,21 +596,34 @@ class RedisDb():
 
         # map to the patreon user
         self.r.set(redis_trial_user_key, api_key)
+        self.mark_dirty(self.r, [redis_trial_user_key])
         logging.info(f'added mapping: trial user: email: {email} ({redis_trial_user_key})')
 
         return api_key
     
+    def set_result_cache_opt_out(self, api_key, opt_out):
+        # when set, translation / transliteration / tokenization results for this key are never cached
+        redis_api_key = self.build_key(KEY_TYPE_API_KEY, api_key)
+        if opt_out:
+            self.r.hset(redis_api_key, 'result_cache_opt_out', 'true')
+        else:
+            self.r.hdel(redis_api_key, 'result_cache_opt_out')
+        self.invalidate_api_key(api_key)
+
     def increase_trial_key_limit(self, email, character_limit):
         redis_trial_user_key = self.build_key(KEY_TYPE_TRIAL_USER, email)
         if self.r.exists(redis_trial_user_key):
             api_key = self.r.get(redis_trial_user_key)
             redis_api_key = self.build_key(KEY_TYPE_API_KEY, api_key)
 
+            # restores the key if it was archived, set it first
+            expiration = self.get_api_key_expiration_timestamp_long()
+            if not self.set_api_key_expiration(api_key, expiration):
+                return
+
             # set character limit
             self.r.hset(redis_api_key, 'character_limit', character_limit)
-
-            expiration = self.get_api_key_expiration_timestamp_long()
-            self.r.hset(redis_api_key, 'expiration', expiration)
+            self.invalidate_api_key(api_key)
 
             logging.info(f'increased character limit to {character_limit} for {email} {api_key} and set expiration to {expiration}')
 
@@ -173,11 +639,11 @@ class RedisDb():
             # user already requested a key
             api_key = self.r.get(redis_patreon_user_key)
             redis_api_key = self.build_key(KEY_TYPE_API_KEY, api_key)
-            if self.r.exists(redis_api_key):
+            if self.r.exists(redis_api_key) or self.restore_archived_api_key(api_key):
                 # update expiry time
                 expiration_timestamp = self.get_api_key_expiration_timestamp()
                 logging.info(f'refreshing expiration date of api key: patreon user: {user_id}, email: {email} updating key removal time ({redis_api_key} / {expiration_timestamp})')
-                self.r.hset(redis_api_key, 'expiration', expiration_timestamp)
+                self.set_api_key_expiration(api_key, expiration_timestamp)
             else:
                 # add the key back in
                 self.add_patreon_api_key(api_key, user_id, email)
@@ -189,6 +655,7 @@ class RedisDb():
 
         # map to the patreon user
         self.r.set(redis_patreon_user_key, api_key)
+        self.mark_dirty(self.r, [redis_patreon_user_key])
         logging.info(f'added mapping: patreon user: {user_id}, email: {email} ({redis_patreon_user_key})')
 
         return api_key
@@ -206,6 +673,7 @@ class RedisDb():
             api_key = self.password_generator()
             logging.info(f'created new api_key {api_key} for {user_code}')
             self.r.set(redis_getcheddar_user_key, api_key)
+            self.mark_dirty(self.r, [redis_getcheddar_user_key])
         else:
             api_key = self.r.get(redis_getcheddar_user_key)
             logging.info(f'api_key is {api_key} for {user_code}')
@@ -214,7 +682,12 @@ class RedisDb():
         redis_key = self.build_key(KEY_TYPE_API_KEY, api_key)
         user_data['type'] = cloudlanguagetools.constants.ApiKeyType.getcheddar.name
         logging.info(f'setting user_data {user_data} on {redis_key}')
-        self.r.hset(redis_key, mapping=user_data)
+        pipe = self.r.pipeline()
+        pipe.hset(redis_key, mapping=user_data)
+        # getcheddar keys don't expire
+        self.index_api_key(pipe, api_key, user_data['type'], None)
+        pipe.execute()
+        self.invalidate_api_key(api_key)
 
         # return api key so it can be used to communicate to the user
         return api_key
@@ -231,12 +704,244 @@ class RedisDb():
         redis_api_key = self.build_key(KEY_TYPE_API_KEY, api_key)
 
         # delete both
-        self.r.delete(redis_getcheddar_user_key)
-        self.r.delete(redis_api_key)
+        pipe = self.r.pipeline()
+        pipe.delete(redis_getcheddar_user_key)
+        pipe.delete(redis_api_key)
+        self.unindex_api_key(pipe, api_key)
+        self.mark_dirty(pipe, [redis_getcheddar_user_key])
+        pipe.execute()
+        self.invalidate_api_key(api_key)
+
+
+
+    # secondary indexes
+    # =================
+    # a set of api keys per ApiKeyType, a sorted set of api keys by expiration, and a set of usage keys per
+    # scope / period / date. they're maintained by the functions which create, update and delete keys, and can
+    # be rebuilt from the keyspace with rebuild_indexes (redis_util.py --action rebuild_indexes). until they
+    # have been built once, the list functions fall back to scanning the keyspace
+
+    def build_api_key_type_index_key(self, key_type_name):
+        return self.build_key(KEY_TYPE_API_KEY_INDEX, f'type:{key_type_name}')
+
+    def build_api_key_expiration_index_key(self):
+        return self.build_key(KEY_TYPE_API_KEY_INDEX, 'expiration')
+
+    def build_usage_index_key(self, index_suffix):
+        return self.build_key(KEY_TYPE_USAGE_INDEX, index_suffix)
+
+    def build_usage_index_list_key(self, index_suffix):
+        # one list per scope:period
+        return self.build_key(KEY_TYPE_USAGE_INDEX_LIST, ':'.join(index_suffix.split(':')[0:2]))
 
+    def api_key_index_built(self):
+        return self.r.exists(self.build_key(KEY_TYPE_API_KEY_INDEX, 'built')) == 1
 
+    def usage_index_built(self):
+        return self.r.exists(self.build_key(KEY_TYPE_USAGE_INDEX, 'built')) == 1
+
+    def usage_index_list_built(self):
+        return self.r.exists(self.build_key(KEY_TYPE_USAGE_INDEX_LIST, 'built')) == 1
+
+    def index_api_key(self, pipe, api_key, key_type_name, expiration):
+        # queues the index updates on pipe. expiration None means the key doesn't expire
+        for key_type in cloudlanguagetools.constants.ApiKeyType:
+            if key_type.name != key_type_name:
+                pipe.srem(self.build_api_key_type_index_key(key_type.name), api_key)
+        pipe.sadd(self.build_api_key_type_index_key(key_type_name), api_key)
+        if expiration == None:
+            pipe.zrem(self.build_api_key_expiration_index_key(), api_key)
+        else:
+            pipe.zadd(self.build_api_key_expiration_index_key(), {api_key: int(expiration)})
+
+    def unindex_api_key(self, pipe, api_key):
+        for key_type in cloudlanguagetools.constants.ApiKeyType:
+            pipe.srem(self.build_api_key_type_index_key(key_type.name), api_key)
+        pipe.zrem(self.build_api_key_expiration_index_key(), api_key)
+
+    def index_usage_key(self, pipe, usage_slice, redis_key):
+        # same as the track_usage script does
+        usage_index_key = self.build_usage_index_key(usage_slice.build_index_suffix())
+        pipe.sadd(usage_index_key, redis_key)
+        pipe.expire(usage_index_key, self.get_expire_time_usage())
+        usage_index_list_key = self.build_usage_index_list_key(usage_slice.build_index_suffix())
+        pipe.sadd(usage_index_list_key, usage_index_key)
+        pipe.expire(usage_index_list_key, self.get_expire_time_usage())
+
+    def set_api_key_expiration(self, api_key, expiration):
+        # an archived key gets restored, its expiration can be extended like any other key.
+        # returns False if the api key doesn't exist
+        self.restore_archived_api_key(api_key)
+        redis_api_key = self.build_key(KEY_TYPE_API_KEY, api_key)
+        if not self.r.exists(redis_api_key):
+            logging.warning(f'not setting expiration of {redis_api_key}, the api key does not exist')
+            return False
+        pipe = self.r.pipeline()
+        pipe.hset(redis_api_key, 'expiration', expiration)
+        pipe.zadd(self.build_api_key_expiration_index_key(), {api_key: int(expiration)})
+        pipe.execute()
+        self.invalidate_api_key(api_key)
+        return True
+
+    def build_expired_api_key_index_key(self):
+        return self.build_key(KEY_TYPE_API_KEY_INDEX, 'expired')
+
+    def api_key_archived(self, api_key):
+        # O(log n), doesn't touch the archived hash
+        return self.r.zscore(self.build_expired_api_key_index_key(), api_key) != None
+
+    def sweep_expired_api_keys(self, grace_period_seconds=0, batch_size=500):
+        # moves clt:api_key hashes expired for more than grace_period_seconds to clt:expired_api_key, in
+        # batches taken from the expiration index. the expired index keeps them listed by expiration
+        if not self.api_key_index_built():
+            logging.warning('api key indexes not built, not sweeping expired api keys')
+            return 0
+        cutoff = int(time.time()) - grace_period_seconds
+        expiration_index_key = self.build_api_key_expiration_index_key()
+        type_index_keys = [self.build_api_key_type_index_key(key_type.name) for key_type in cloudlanguagetools.constants.ApiKeyType]
+        archived_count = 0
+        while True:
+            api_key_list = self.r.zrangebyscore(expiration_index_key, '-inf', cutoff, start=0, num=batch_size)
+            if len(api_key_list) == 0:
+                break
+            keys = [expiration_index_key, self.build_expired_api_key_index_key()] + type_index_keys
+            for api_key in api_key_list:
+                keys.extend([self.build_key(KEY_TYPE_API_KEY, api_key), self.build_key(KEY_TYPE_EXPIRED_API_KEY, api_key)])
+            archived_api_key_list = self.archive_expired_api_keys_script(keys=keys, args=[cutoff, len(type_index_keys)] + api_key_list)
+
+            pipe = self.r.pipeline(transaction=False)
+            for api_key in archived_api_key_list:
+                if self.api_key_cache != None:
+                    self.api_key_cache.invalidate(api_key)
+                pipe.publish(self.build_global_key(API_KEY_INVALIDATION_CHANNEL), self.build_key(KEY_TYPE_API_KEY, api_key))
+                self.mark_dirty(pipe, [self.build_key(KEY_TYPE_API_KEY, api_key), self.build_key(KEY_TYPE_EXPIRED_API_KEY, api_key)])
+            pipe.execute()
+            archived_count += len(archived_api_key_list)
+            logging.info(f'archived {len(archived_api_key_list)} expired api keys')
+        return archived_count
+
+    def restore_archived_api_key(self, api_key):
+        # moves an archived api key back into the hot keyspace, returns False if it wasn't archived
+        if not self.api_key_archived(api_key):
+            return False
+        redis_expired_api_key = self.build_key(KEY_TYPE_EXPIRED_API_KEY, api_key)
+        key_type_name, expiration = self.r.hmget(redis_expired_api_key, 'type', 'expiration')
+        if key_type_name == None:
+            # the archived hash is gone, drop the stale index entry
+            self.r.zrem(self.build_expired_api_key_index_key(), api_key)
+            logging.warning(f'archived api key {api_key} not found, removed from the expired index')
+            return False
+        pipe = self.r.pipeline()
+        pipe.zrem(self.build_expired_api_key_index_key(), api_key)
+        pipe.rename(redis_expired_api_key, self.build_key(KEY_TYPE_API_KEY, api_key))
+        self.index_api_key(pipe, api_key, key_type_name, expiration)
+        self.mark_dirty(pipe, [redis_expired_api_key])
+        pipe.execute()
+        self.invalidate_api_key(api_key)
+        logging.info(f'restored archived api key {api_key}')
+        return True
+
+    def list_expired_api_keys(self, start_timestamp='-inf', end_timestamp='+inf'):
+        # archived api keys, with their expiration timestamp
+        return self.r.zrangebyscore(self.build_expired_api_key_index_key(), start_timestamp, end_timestamp, withscores=True, score_cast_func=int)
+
+    def rebuild_indexes(self):
+        # builds every index from the keyspace into temporary keys, then merges them into the live indexes,
+        # which keep being updated in the meantime. api key indexes are snapshotted first, so that the updates
+        # made during the rebuild can be told apart from stale entries. usage indexes are only ever added to
+        logging.info('rebuilding indexes')
+        api_key_index_types = {self.build_api_key_type_index_key(key_type.name): 'set' for key_type in cloudlanguagetools.constants.ApiKeyType}
+        api_key_index_types[self.build_api_key_expiration_index_key()] = 'zset'
+        api_key_index_types[self.build_expired_api_key_index_key()] = 'zset'
+        pipe = self.r.pipeline(transaction=False)
+        for index_key, index_type in api_key_index_types.items():
+            if index_type == 'set':
+                pipe.sunionstore(f'{index_key}:snapshot', [index_key])
+            else:
+                pipe.zunionstore(f'{index_key}:snapshot', [index_key])
+        pipe.execute()
+
+        api_key_prefix = self.build_key(KEY_TYPE_API_KEY, '')
+        usage_prefix = self.build_key(KEY_TYPE_USAGE, '')
+        expired_api_key_prefix = self.build_key(KEY_TYPE_EXPIRED_API_KEY, '')
+        redis_api_key_list = []
+        usage_key_list = []
+        redis_expired_api_key_list = []
+        for key in self.r.scan_iter(count=1000):
+            if key.startswith(api_key_prefix):
+                redis_api_key_list.append(key)
+            elif key.startswith(usage_prefix):
+                usage_key_list.append(key)
+            elif key.startswith(expired_api_key_prefix):
+                redis_expired_api_key_list.append(key)
+        logging.info(f'found {len(redis_api_key_list)} api keys, {len(usage_key_list)} usage keys, {len(redis_expired_api_key_list)} expired api keys')
+
+        pipe = self.r.pipeline(transaction=False)
+        for redis_api_key in redis_api_key_list:
+            pipe.hmget(redis_api_key, 'type', 'expiration')
+        api_key_fields = pipe.execute()
+
+        type_index = {key_type.name: [] for key_type in cloudlanguagetools.constants.ApiKeyType}
+        expiration_index = {}
+        for redis_api_key, (key_type_name, expiration) in zip(redis_api_key_list, api_key_fields):
+            api_key = redis_api_key[len(api_key_prefix):]
+            if key_type_name in type_index:
+                type_index[key_type_name].append(api_key)
+            if expiration != None and key_type_name != cloudlanguagetools.constants.ApiKeyType.getcheddar.name:
+                expiration_index[api_key] = int(expiration)
+
+        pipe = self.r.pipeline(transaction=False)
+        for redis_expired_api_key in redis_expired_api_key_list:
+            pipe.hget(redis_expired_api_key, 'expiration')
+        expired_index = {}
+        for redis_expired_api_key, expiration in zip(redis_expired_api_key_list, pipe.execute()):
+            expired_index[redis_expired_api_key[len(expired_api_key_prefix):]] = int(expiration or 0)
+
+        usage_index = {}
+        for usage_key in usage_key_list:
+            usage_index.setdefault(quotas.get_usage_index_suffix(usage_key[len(usage_prefix):]), []).append(usage_key)
+
+        index_entries = {self.build_api_key_type_index_key(name): ('set', api_keys) for name, api_keys in type_index.items()}
+        index_entries[self.build_api_key_expiration_index_key()] = ('zset', expiration_index)
+        index_entries[self.build_expired_api_key_index_key()] = ('zset', expired_index)
+        usage_index_lists = {}
+        for index_suffix, usage_keys in usage_index.items():
+            index_entries[self.build_usage_index_key(index_suffix)] = ('usage_set', usage_keys)
+            usage_index_lists.setdefault(self.build_usage_index_list_key(index_suffix), []).append(self.build_usage_index_key(index_suffix))
+        for usage_index_list_key, usage_index_keys in usage_index_lists.items():
+            index_entries[usage_index_list_key] = ('usage_set', usage_index_keys)
+
+        batch_size = 1000
+        for index_key, (index_type, members) in index_entries.items():
+            temp_key = f'{index_key}:rebuild'
+            pipe = self.r.pipeline(transaction=False)
+            pipe.delete(temp_key)
+            if index_type == 'zset':
+                items = list(members.items())
+                for i in range(0, len(items), batch_size):
+                    pipe.zadd(temp_key, dict(items[i:i + batch_size]))
+            else:
+                for i in range(0, len(members), batch_size):
+                    pipe.sadd(temp_key, *members[i:i + batch_size])
+            pipe.execute()
+            if index_type == 'usage_set':
+                pipe = self.r.pipeline()
+                pipe.sunionstore(index_key, [index_key, temp_key])
+                pipe.delete(temp_key)
+                pipe.expire(index_key, self.get_expire_time_usage())
+                pipe.execute()
+            else:
+                self.merge_rebuilt_index_script(keys=[index_key, f'{index_key}:snapshot', temp_key], args=[index_type])
+
+        self.r.set(self.build_key(KEY_TYPE_API_KEY_INDEX, 'built'), int(time.time()))
+        self.r.set(self.build_key(KEY_TYPE_USAGE_INDEX, 'built'), int(time.time()))
+        self.r.set(self.build_key(KEY_TYPE_USAGE_INDEX_LIST, 'built'), int(time.time()))
+        logging.info(f'rebuilt {len(index_entries)} indexes')
 
     def list_getcheddar_api_keys(self):
+        if self.api_key_index_built():
+            return list(self.r.smembers(self.build_api_key_type_index_key(cloudlanguagetools.constants.ApiKeyType.getcheddar.name)))
+
         pattern = self.build_key(KEY_TYPE_GETCHEDDAR_USER, '*')
         customer_api_key_map_list = []
 
@@ -298,10 +1003,40 @@ class RedisDb():
         return api_key_data
 
     def get_api_key_data(self, api_key):
+        api_key_data = self.lookup_api_key_data(api_key)
+        if not isinstance(api_key_data, dict):
+            raise cloudlanguagetools.errors.ApiKeyNotFoundError()
+        return api_key_data
+
+    def lookup_api_key_data(self, api_key):
+        # same as load_api_key_data, through the api key cache
+        if self.api_key_cache == None:
+            return self.load_api_key_data(api_key)
+
+        found, api_key_data = self.api_key_cache.get(api_key)
+        if found:
+            return api_key_data
+        # an invalidation arriving while the record is being loaded must not be lost
+        generation = self.api_key_cache.get_generation()
+        api_key_data = self.load_api_key_data(api_key)
+        self.api_key_cache.set(api_key, api_key_data, generation=generation)
+        return api_key_data
+
+    def load_api_key_data(self, api_key):
+        # retrieve and decode the api key hash from redis, None if the key doesn't exist,
+        # ARCHIVED_API_KEY if it was moved to clt:expired_api_key
         redis_key = self.build_key(KEY_TYPE_API_KEY, api_key)
-        api_key_data = self.r.hgetall(redis_key)
+        if api_key == None:
+            api_key_data = self.r.hgetall(redis_key)
+            archived = False
+        else:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.hgetall(redis_key)
+            pipe.zscore(self.build_expired_api_key_index_key(), api_key)
+            api_key_data, expired_score = pipe.execute()
+            archived = expired_score != None
         if len(api_key_data) == 0:
-            raise cloudlanguagetools.errors.ApiKeyNotFoundError()
+            return ARCHIVED_API_KEY if archived else None
 
         transform_map = {
             cloudlanguagetools.constants.ApiKeyType.test.name: self.transform_api_key_data_test,
@@ -385,22 +1120,19 @@ class RedisDb():
 
 
     def api_key_valid(self, api_key):
-        redis_key = self.build_key(KEY_TYPE_API_KEY, api_key)
-        if self.r.exists(redis_key) == 0:
+        key_data = self.lookup_api_key_data(api_key)
+        if key_data == ARCHIVED_API_KEY:
+            return {'key_valid': False, 'msg':f'API Key expired'}
+        if key_data == None:
             return {'key_valid': False, 'msg': 'API Key not valid'}
-        key_data = self.r.hgetall(redis_key)
 
         if key_data['type'] == cloudlanguagetools.constants.ApiKeyType.getcheddar.name:
             # no expiration
             return {'key_valid': True, 'msg': f'API Key is valid'}
 
-        expiration = self.r.hget(redis_key, 'expiration')
-        expiration_timestamp = int(self.r.hget(redis_key, 'expiration'))
-        current_dt = datetime.datetime.now()
-        current_timestamp = int(current_dt.timestamp())
-        expiration_dt = datetime.datetime.fromtimestamp(expiration_timestamp)
+        expiration_timestamp = key_data['expiration']
+        current_timestamp = int(datetime.datetime.now().timestamp())
         if expiration_timestamp > current_timestamp:
-            expire_time_delta = expiration_dt - current_dt
             return {'key_valid': True, 'msg': f'API Key is valid'}
         return {'key_valid': False, 'msg':f'API Key expired'}
         
@@ -409,12 +1141,16 @@ class RedisDb():
         pattern = self.build_key(KEY_TYPE_API_KEY, '*')
         redis_api_key_list = []
 
-        logging.info('scanning list of API keys from redis')
-        cursor = '0'
-        while cursor != 0:
-            cursor, keys = self.r.scan(cursor=cursor, match=pattern, count=100)
-            for key in keys:
-                redis_api_key_list.append(key)
+        if self.api_key_index_built():
+            type_index_keys = [self.build_api_key_type_index_key(key_type.name) for key_type in cloudlanguagetools.constants.ApiKeyType]
+            redis_api_key_list = [self.build_key(KEY_TYPE_API_KEY, api_key) for api_key in self.r.sunion(type_index_keys)]
+        else:
+            logging.info('scanning list of API keys from redis')
+            cursor = '0'
+            while cursor != 0:
+                cursor, keys = self.r.scan(cursor=cursor, match=pattern, count=100)
+                for key in keys:
+                    redis_api_key_list.append(key)
 
         # get key data for all keys
         logging.info('getting data for all API keys')
@@ -453,30 +1189,31 @@ class RedisDb():
         data['api_key'] = api_key
         data['timestamp'] = int(datetime.datetime.now().timestamp())
         value_str = json.dumps(data)
+        if self.analytics_queue != None:
+            self.analytics_queue.rpush(redis_key, value_str)
+            return
         self.r.rpush(redis_key, value_str)
         self.r.expire(redis_key, self.get_expire_time_usage())
+        self.mark_dirty(self.r, [redis_key])
+
+    def request_analytics(self, api_key):
+        return RequestAnalytics(self, api_key)
 
     def track_audio_language(self, api_key, language_code):
-        redis_key = self.build_monthly_user_key(KEY_TYPE_USER_AUDIO_LANGUAGE, api_key)
-        self.r.hincrby(redis_key, language_code.name, 1)
-        self.r.expire(redis_key, self.get_expire_time_usage())
+        analytics = self.request_analytics(api_key)
+        analytics.track_audio_language(language_code)
+        analytics.write()
 
     def track_service(self, api_key, service):
-        redis_key = self.build_monthly_user_key(KEY_TYPE_USER_SERVICE, api_key)
-        self.r.hincrby(redis_key, service.name, 1)
-        self.r.expire(redis_key, self.get_expire_time_usage())        
+        analytics = self.request_analytics(api_key)
+        analytics.track_service(service)
+        analytics.write()
 
     def track_client(self, api_key, client_str, version):
-        # keep track of the client used
-        client = cloudlanguagetools.constants.Client[client_str]
-        redis_key = self.build_monthly_user_key(KEY_TYPE_USER_CLIENT, api_key)
-        self.r.hincrby(redis_key, client.name, 1)
-        self.r.expire(redis_key, self.get_expire_time_usage())
-        # keep track of version used
-        client_version = f'{client_str}_{version}'
-        redis_key = self.build_monthly_user_key(KEY_TYPE_USER_CLIENT_VERSION, api_key)
-        self.r.hincrby(redis_key, client_version, 1)
-        self.r.expire(redis_key, self.get_expire_time_usage())
+        # keep track of the client and version used
+        analytics = self.request_analytics(api_key)
+        analytics.track_client(client_str, version)
+        analytics.write()
 
     def should_send_posthog_event(self, api_key, daily_limit=2):
         date_str = datetime.datetime.now().strftime('%Y%m%d')
@@ -487,10 +1224,9 @@ class RedisDb():
         return count <= daily_limit
 
     def track_request_mode(self, api_key, request_mode):
-        # keep track of the client used
-        redis_key = self.build_monthly_user_key(KEY_TYPE_USER_REQUEST_MODE, api_key)
-        self.r.hincrby(redis_key, request_mode.name, 1)
-        self.r.expire(redis_key, self.get_expire_time_usage())    
+        analytics = self.request_analytics(api_key)
+        analytics.track_request_mode(request_mode)
+        analytics.write()
 
     def get_usage_slice_data(self, usage_slice):
         key = self.build_key(KEY_TYPE_USAGE, usage_slice.build_key_suffix())
@@ -520,10 +1256,14 @@ class RedisDb():
     def reset_getcheddar_usage_slice(self, api_key):
         usage_slice = self.get_getcheddar_usage_slice(api_key)
         redis_key = self.build_key(KEY_TYPE_USAGE, usage_slice.build_key_suffix())
-        self.r.hset(redis_key, mapping={
+        pipe = self.r.pipeline()
+        pipe.hset(redis_key, mapping={
             'characters': 0,
             'requests': 0
         })
+        self.index_usage_key(pipe, usage_slice, redis_key)
+        self.mark_dirty(pipe, [redis_key])
+        pipe.execute()
 
 
     def track_usage(self, api_key, service, request_type, characters: int, language_code=None):
@@ -533,12 +1273,10 @@ class RedisDb():
             # azure has special character counting based on language
             characters = quotas.adjust_character_count(service, request_type, language_code, characters)
 
-        redis_api_key = self.build_key(KEY_TYPE_API_KEY, api_key)
-        key_type_str = self.r.hget(redis_api_key, 'type')
-        key_type = cloudlanguagetools.constants.ApiKeyType[key_type_str]
-
         api_key_data = self.get_api_key_data(api_key)
-
+        key_type = cloudlanguagetools.constants.ApiKeyType[api_key_data['type']]
+        # shared by all the usage slices of this request
+        date_suffixes = quotas.build_date_suffixes()
 
         usage_slice_list = [
             quotas.UsageSlice(request_type, 
@@ -547,35 +1285,40 @@ class RedisDb():
                               service, 
                               api_key,
                               key_type,
-                              api_key_data),
+                              api_key_data,
+                              date_suffixes),
             quotas.UsageSlice(request_type, 
                               cloudlanguagetools.constants.UsageScope.User, 
                               cloudlanguagetools.constants.UsagePeriod.monthly, 
                               service, 
                               api_key,
                               key_type,
-                              api_key_data),
+                              api_key_data,
+                              date_suffixes),
             quotas.UsageSlice(request_type, 
                               cloudlanguagetools.constants.UsageScope.User, 
                               cloudlanguagetools.constants.UsagePeriod.lifetime, 
                               service, 
                               api_key,
                               key_type,
-                              api_key_data),                              
+                              api_key_data,
+                              date_suffixes),
             quotas.UsageSlice(request_type, 
                               cloudlanguagetools.constants.UsageScope.Global, 
                               cloudlanguagetools.constants.UsagePeriod.daily, 
                               service, 
                               api_key,
                               key_type,
-                              api_key_data),
+                              api_key_data,
+                              date_suffixes),
             quotas.UsageSlice(request_type, 
                               cloudlanguagetools.constants.UsageScope.Global, 
                               cloudlanguagetools.constants.UsagePeriod.monthly, 
                               service, 
                               api_key,
                               key_type,
-                              api_key_data),
+                              api_key_data,
+                              date_suffixes),
         ]
 
         if key_type == cloudlanguagetools.constants.ApiKeyType.getcheddar:
@@ -588,7 +1331,8 @@ class RedisDb():
                                 service, 
                                 api_key,
                                 key_type,
-                                api_key_data))
+                                api_key_data,
+                                date_suffixes))
 
         if key_type == cloudlanguagetools.constants.ApiKeyType.patreon:
             # for now track only, and after 2021/06, this can be blocking
@@ -599,31 +1343,32 @@ class RedisDb():
                                 service, 
                                 api_key,
                                 key_type,
-                                api_key_data))
-
-        def convert_usage(usage_output):
-            if usage_output == None:
-                return 0
-            return int(usage_output)
+                                api_key_data,
+                                date_suffixes))
 
-        # do a pre check to see whether the current request would put us over the quota
+        # check quota and track usage on all slices in a single round trip, so that concurrent
+        # requests can't go over quota between the check and the increment
+        keys = []
+        args = [characters, expire_time_seconds]
         for usage_slice in usage_slice_list:
-            key = self.build_key(KEY_TYPE_USAGE, usage_slice.build_key_suffix())
-            current_quota_characters = convert_usage(self.r.hget(key, 'characters'))
-            current_quota_requests = convert_usage(self.r.hget(key, 'requests'))
-            
-            if usage_slice.over_quota(current_quota_characters + characters, current_quota_requests + 1):
-                error_msg = f'Exceeded {usage_slice.usage_scope.name} {usage_slice.usage_period.name} quota)'
-                if usage_slice.usage_scope == cloudlanguagetools.constants.UsageScope.User and usage_slice.usage_period == cloudlanguagetools.constants.UsagePeriod.lifetime:
-                    error_msg = f'Maxed out trial quota. Please sign up for the paid plan.'
-                raise cloudlanguagetools.errors.OverQuotaError(error_msg)        
-
-        # track usage
-        for usage_slice in usage_slice_list:
-            key = self.build_key(KEY_TYPE_USAGE, usage_slice.build_key_suffix())
-            self.r.hincrby(key, 'characters', characters)
-            self.r.hincrby(key, 'requests', 1)
-            self.r.expire(key, expire_time_seconds)
+            keys.append(self.build_key(KEY_TYPE_USAGE, usage_slice.build_key_suffix()))
+            for limit in [usage_slice.character_limit(), usage_slice.request_limit()]:
+                args.append('' if limit == None else limit)
+        keys.extend([self.build_usage_index_key(usage_slice.build_index_suffix()) for usage_slice in usage_slice_list])
+        keys.extend([self.build_usage_index_list_key(usage_slice.build_index_suffix()) for usage_slice in usage_slice_list])
+        if self.track_dirty_keys:
+            keys.append(self.build_global_key(BACKUP_DIRTY_KEYS_KEY))
+        over_quota_index = self.track_usage_script(keys=keys, args=args)
+
+        if over_quota_index != 0:
+            usage_slice = usage_slice_list[over_quota_index - 1]
+            error_msg = f'Exceeded {usage_slice.usage_scope.name} {usage_slice.usage_period.name} quota)'
+            if usage_slice.usage_scope == cloudlanguagetools.constants.UsageScope.User and usage_slice.usage_period == cloudlanguagetools.constants.UsagePeriod.lifetime:
+                error_msg = f'Maxed out trial quota. Please sign up for the paid plan.'
+            raise cloudlanguagetools.errors.OverQuotaError(error_msg)
+
+        # callers can reuse the key record, for reporting
+        return api_key_data
 
     def reset_trial_usage(self, api_key):
         logging.info(f'resetting trial usage for {api_key}')
@@ -636,9 +1381,14 @@ class RedisDb():
                             cloudlanguagetools.constants.ApiKeyType.trial,
                             {})
         key = self.build_key(KEY_TYPE_USAGE, usage_slice.build_key_suffix())
-        self.r.hset(key, 'characters', 0)
-        self.r.hset(key, 'requests', 0)
-        self.r.expire(key, expire_time_seconds)
+        pipe = self.r.pipeline()
+        pipe.hset(key, 'characters', 0)
+        pipe.hset(key, 'requests', 0)
+        pipe.expire(key, expire_time_seconds)
+        self.index_usage_key(pipe, usage_slice, key)
+        self.mark_dirty(pipe, [key])
+        pipe.execute()
+        self.invalidate_api_key(api_key)
 
     def retrieve_audio_requests_for_key(self, redis_key):
         total_count = self.r.llen(redis_key)
@@ -737,36 +1487,76 @@ class RedisDb():
 
         logging.info(f'listing usage with pattern {pattern}')
         
-        key_list = []
-        cursor = '0'
-        while cursor != 0:
-            cursor, keys = self.r.scan(cursor=cursor, match=pattern, count=100)
-            key_list.extend(keys)
+        usage_prefix = f'{KEY_TYPE_USAGE}:'
+        usage_index_keys = None
+        if scan_pattern != None and scan_pattern.startswith(usage_prefix) and self.usage_index_built():
+            # usage keys are indexed by scope:period[:date], use the index if the pattern is one of those.
+            # a scope:period pattern of a dated period covers the indexes of all its dates
+            index_suffix = scan_pattern[len(usage_prefix):]
+            usage_index_key = self.build_usage_index_key(index_suffix)
+            if self.r.exists(usage_index_key):
+                usage_index_keys = [usage_index_key]
+            elif len(index_suffix.split(':')) == 2 and self.usage_index_list_built():
+                usage_index_keys = self.list_usage_index_keys(index_suffix)
+        if usage_index_keys != None:
+            key_list = list(self.r.sunion(usage_index_keys)) if len(usage_index_keys) > 0 else []
+        else:
+            key_list = []
+            cursor = '0'
+            while cursor != 0:
+                cursor, keys = self.r.scan(cursor=cursor, match=pattern, count=100)
+                key_list.extend(keys)
         pipe = self.r.pipeline()
         for key in key_list:
             pipe.hgetall(key)
         hashes = pipe.execute()
         usage_entries = []
+        expired_keys = []
         for key, hash_data in zip(key_list, hashes):
+            if len(hash_data) == 0:
+                # expired (or deleted) since it was indexed
+                expired_keys.append(key)
+                continue
             usage_entry = {
                 'usage_key': key
             }
             usage_entry.update(hash_data)
             usage_entries.append(usage_entry)
+        if usage_index_keys != None and len(expired_keys) > 0:
+            pipe = self.r.pipeline(transaction=False)
+            for key in expired_keys:
+                pipe.srem(self.build_usage_index_key(quotas.get_usage_index_suffix(key[len(self.build_key(KEY_TYPE_USAGE, '')):])), key)
+            pipe.execute()
         return usage_entries
+
+    def list_usage_index_keys(self, index_suffix):
+        # the existing usage indexes of a scope:period, the ones which expired get removed from the list
+        usage_index_list_key = self.build_usage_index_list_key(index_suffix)
+        usage_index_keys = list(self.r.smembers(usage_index_list_key))
+        pipe = self.r.pipeline(transaction=False)
+        for usage_index_key in usage_index_keys:
+            pipe.exists(usage_index_key)
+        exists_list = pipe.execute()
+        expired_index_keys = [key for key, exists in zip(usage_index_keys, exists_list) if not exists]
+        if len(expired_index_keys) > 0:
+            self.r.srem(usage_index_list_key, *expired_index_keys)
+        return [key for key, exists in zip(usage_index_keys, exists_list) if exists]
         
     def list_trial_users(self):
         pattern = self.build_key(KEY_TYPE_TRIAL_USER, '*')
         api_key_list = []
-        cursor = '0'
-        while cursor != 0:
-            cursor, keys = self.r.scan(cursor=cursor, match=pattern, count=100)
-            pipe = self.r.pipeline()
-            for key in keys:
-                pipe.get(key)
-            key_values = pipe.execute()
-            for key, value in zip(keys, key_values):
-                api_key_list.append(value)
+        if self.api_key_index_built():
+            api_key_list = list(self.r.smembers(self.build_api_key_type_index_key(cloudlanguagetools.constants.ApiKeyType.trial.name)))
+        else:
+            cursor = '0'
+            while cursor != 0:
+                cursor, keys = self.r.scan(cursor=cursor, match=pattern, count=100)
+                pipe = self.r.pipeline()
+                for key in keys:
+                    pipe.get(key)
+                key_values = pipe.execute()
+                for key, value in zip(keys, key_values):
+                    api_key_list.append(value)
 
         # get trial user data
         pipe = self.r.pipeline()
@@ -822,74 +1612,263 @@ class RedisDb():
         logging.warn(f'WARNING about to remove key: {redis_key}')
         if sleep:
             time.sleep(15)
-        self.r.delete(redis_key)
+        api_key_prefix = self.build_key(KEY_TYPE_API_KEY, '')
+        if redis_key.startswith(api_key_prefix):
+            api_key = redis_key[len(api_key_prefix):]
+            pipe = self.r.pipeline()
+            pipe.delete(redis_key)
+            self.unindex_api_key(pipe, api_key)
+            pipe.execute()
+            self.invalidate_api_key(api_key)
+        else:
+            self.r.delete(redis_key)
+            self.mark_dirty(self.r, [redis_key])
+
+    def iter_db_dump(self, batch_size=1000):
+        # yields (key, 'dump', value) for every key, one SCAN batch at a time, so that memory use doesn't grow
+        # with the size of the db. value holds the DUMP payload (base64) and the absolute expiration time in
+        # milliseconds (None for keys without a TTL). covers every key type
+        backup_key_prefix = self.build_global_key(BACKUP_KEY_PREFIX)
+        key_count = 0
+        cursor = '0'
+        while cursor != 0:
+            cursor, keys = self.r.scan(cursor=cursor, count=batch_size)
+            keys = [redis_key for redis_key in keys if not redis_key.startswith(backup_key_prefix)]
+            if len(keys) == 0:
+                continue
+            for record in self.dump_keys(keys):
+                yield record
+                key_count += 1
+            logging.info(f'dumped {key_count} keys')
+
+    def dump_keys(self, keys, include_deleted=False):
+        # yields the iter_db_dump records of keys. keys which don't exist (anymore) are skipped, or
+        # yield (key, 'deleted', None) if include_deleted is set
+        pipe = self.r_binary.pipeline(transaction=False)
+        for redis_key in keys:
+            pipe.dump(redis_key)
+            pipe.pttl(redis_key)
+        results = pipe.execute()
+        now_ms = int(time.time() * 1000)
+
+        for redis_key, payload, pttl in zip(keys, results[0::2], results[1::2]):
+            # the key may have been deleted or may have expired in between
+            if payload == None or pttl == -2:
+                if include_deleted:
+                    yield redis_key, 'deleted', None
+                continue
+            yield redis_key, 'dump', {
+                'payload': base64.b64encode(payload).decode('ascii'),
+                'expire_at_ms': now_ms + pttl if pttl > 0 else None
+            }
 
-    def full_db_dump(self):
+    # incremental backups
+    # ===================
+    # every mutation recorded through mark_dirty adds the key to the dirty keys set. a backup moves that set
+    # aside, then either dumps the whole db (base) or only the keys in the set (delta). base and deltas are
+    # stored as <prefix><base id>/base.ndjson.gz and <prefix><base id>/delta_<n>.ndjson.gz, restoring
+    # means replaying the base, then the deltas in order (restore_incremental_backup)
+
+    def take_dirty_keys(self):
+        # moves the dirty keys aside, keys modified from now on go to the next backup. returns the key of the set
+        # holding them. keys left there by a failed backup are kept, they're picked up by the next one
+        dirty_keys_key = self.build_global_key(BACKUP_DIRTY_KEYS_KEY)
+        processing_key = f'{dirty_keys_key}:processing'
+        pipe = self.r.pipeline()
+        pipe.sunionstore(processing_key, [processing_key, dirty_keys_key])
+        pipe.delete(dirty_keys_key)
+        pipe.execute()
+        return processing_key
+
+    def iter_db_delta(self, dirty_keys_key, batch_size=1000):
+        # yields the records of the keys in the dirty keys set, including deletions
+        key_count = 0
+        batch = []
+        for redis_key in itertools.chain(self.r.sscan_iter(dirty_keys_key, count=batch_size), [None]):
+            if redis_key != None:
+                batch.append(redis_key)
+            if len(batch) == batch_size or (redis_key == None and len(batch) > 0):
+                for record in self.dump_keys(batch, include_deleted=True):
+                    yield record
+                    key_count += 1
+                batch = []
+        logging.info(f'dumped {key_count} modified keys')
+
+    def clear_dirty_keys(self):
+        # a full backup outside of the incremental chain makes any dirty keys left over irrelevant
+        dirty_keys_key = self.build_global_key(BACKUP_DIRTY_KEYS_KEY)
+        self.r.delete(dirty_keys_key, f'{dirty_keys_key}:processing')
+
+    def get_backup_state(self):
+        return self.r.hgetall(self.build_global_key(BACKUP_STATE_KEY))
+
+    def backup_incremental(self, targets, full_backup_interval_seconds, keep_base_count=3, prefix='incremental/'):
+        # targets: (s3 client, bucket name) tuples. writes a delta, or a new base if the last one is older
+        # than full_backup_interval_seconds, then deletes all but the keep_base_count most recent bases with
+        # their deltas. returns the object name written
+        backup_state = self.get_backup_state()
+        now = int(time.time())
+        full_backup = len(backup_state) == 0 or now - int(backup_state['base_timestamp']) >= full_backup_interval_seconds
+
+        dirty_keys_key = self.take_dirty_keys()
+        if full_backup:
+            base_id = datetime.datetime.fromtimestamp(now).strftime('%Y%m%d-%H%M%S')
+            object_name = f'{prefix}{base_id}/base.ndjson.gz'
+            records = self.iter_db_dump()
+            delta_count = 0
+        else:
+            base_id = backup_state['base_id']
+            delta_count = int(backup_state['delta_count']) + 1
+            object_name = f'{prefix}{base_id}/delta_{delta_count:05d}.ndjson.gz'
+            records = self.iter_db_delta(dirty_keys_key)
 
-        hash_key_list = []
-        string_key_list = []
+        # if the upload fails, the dirty keys stay in the processing set and the state is unchanged
+        key_count = db_backup.upload_ndjson_dump(records, [(client, bucket_name, object_name) for client, bucket_name in targets])
+        pipe = self.r.pipeline()
+        pipe.delete(dirty_keys_key)
+        pipe.hset(self.build_global_key(BACKUP_STATE_KEY), mapping={
+            'base_id': base_id,
+            'base_timestamp': now if full_backup else backup_state['base_timestamp'],
+            'delta_count': delta_count
+        })
+        pipe.execute()
+        logging.info(f'wrote {object_name}, {key_count} keys')
 
-        key_list = []
+        if full_backup:
+            for client, bucket_name in targets:
+                db_backup.prune_backups(client, bucket_name, prefix, keep_base_count)
+        return object_name
 
-        logging.info('obtaining full list of keys')
+    def iter_db_values(self, batch_size=1000):
+        # yields (key, type, value) for every hash and string key, one SCAN batch at a time
         cursor = '0'
         while cursor != 0:
-            cursor, keys = self.r.scan(cursor=cursor, count=1000)
-            key_list.extend(keys)
-            logging.info(f'collected {len(key_list)} keys')
-        logging.info('finished getting full list of keys')
-
-        logging.info('getting key types')
-        pipe = self.r.pipeline(transaction=False)
-        for redis_key in key_list:
-            pipe.type(redis_key)
-        key_types = pipe.execute()
-        for redis_key, key_type in zip(key_list, key_types):
-            if key_type == 'hash':
-                hash_key_list.append(redis_key)
-            elif key_type == 'string':
-                string_key_list.append(redis_key)
-        logging.info('finished getting key types')
-
-        logging.info(f'getting full key dump')
+            cursor, keys = self.r.scan(cursor=cursor, count=batch_size)
+            if len(keys) == 0:
+                continue
+
+            pipe = self.r.pipeline(transaction=False)
+            for redis_key in keys:
+                pipe.type(redis_key)
+            key_types = pipe.execute()
+
+            dump_keys = []
+            pipe = self.r.pipeline(transaction=False)
+            for redis_key, key_type in zip(keys, key_types):
+                if key_type == 'hash':
+                    pipe.hgetall(redis_key)
+                elif key_type == 'string':
+                    pipe.get(redis_key)
+                else:
+                    continue
+                dump_keys.append((redis_key, key_type))
+            values = pipe.execute()
+
+            for (redis_key, key_type), value in zip(dump_keys, values):
+                if value == None or value == {}:
+                    continue
+                yield redis_key, key_type, value
 
+    def full_db_dump(self):
+        # hash and string keys as a dict, only suitable for small dbs. backups use iter_db_dump
         full_key_map = {}
-
-        # get hash keys
-        logging.info('getting hash data')
-        pipe = self.r.pipeline(transaction=False)
-        for hash_key in hash_key_list:
-            pipe.hgetall(hash_key)
-        hash_values = pipe.execute()
-        for hash_key, hash_value in zip(hash_key_list, hash_values):            
-            full_key_map.update({hash_key: hash_value})
-
-        logging.info('getting string data')
-        pipe = self.r.pipeline(transaction=False)
-        for string_key in string_key_list:
-            pipe.get(string_key)
-        string_values = pipe.execute()
-        for string_key, string_value in zip(string_key_list, string_values):
-            full_key_map.update({string_key: string_value})
-
+        for redis_key, key_type, value in self.iter_db_values():
+            full_key_map[redis_key] = value
         logging.info(f'finished getting full key dump')
         return full_key_map
 
-    def restore_db_backup(self, json_file_path):
+    def restore_db_backup(self, json_file_path, workers=8):
         if os.environ['ENV'] != 'local':
             raise Exception(f'only supported on ENV=local')
         logging.warn(f'WARNING! going to restore redis DB from file {json_file_path} in 10s')
         time.sleep(10)
+        if os.path.isdir(json_file_path):
+            self.restore_incremental_backup(json_file_path, workers=workers)
+            return
+        if json_file_path.endswith('.ndjson.gz'):
+            with open(json_file_path, 'rb') as f:
+                key_count = self.restore_ndjson_dump(db_backup.read_ndjson_dump(f), workers=workers)
+            logging.info(f'number of keys: {key_count}')
+            return
+        # legacy backups: one json object with all hash and string keys
         f = open (json_file_path, "r")
         data = json.loads(f.read())
         logging.info(f'number of keys: {len(data)}')
-        for key, value in data.items():
-            if isinstance(value, str):
-                self.r.set(key, value)
-            elif isinstance(value, dict):
-                self.r.hset(key, mapping=value)
-            else:
-                raise Exception(f'value type not supported: {type(value)}')
+        records = ((key, 'string' if isinstance(value, str) else 'hash', value) for key, value in data.items())
+        self.restore_ndjson_dump(records, workers=workers, total_count=len(data))
+
+    def restore_incremental_backup(self, directory, workers=8):
+        # directory holds a base and its deltas, as written by backup_incremental (a copy of <prefix><base id>/)
+        file_names = ['base.ndjson.gz'] + sorted([file_name for file_name in os.listdir(directory) if file_name.startswith('delta_')])
+        key_count = 0
+        for file_name in file_names:
+            logging.info(f'restoring {file_name}')
+            with open(os.path.join(directory, file_name), 'rb') as f:
+                key_count += self.restore_ndjson_dump(db_backup.read_ndjson_dump(f), workers=workers)
+        # index sets aren't part of the deltas
+        self.rebuild_indexes()
+        logging.info(f'restored {len(file_names)} files, {key_count} keys')
+        return key_count
+
+    def restore_ndjson_dump(self, records, batch_size=1000, workers=8, total_count=None, progress_interval_seconds=10):
+        # records: (key, type, value) tuples as yielded by iter_db_dump / db_backup.read_ndjson_dump.
+        # batches of records are restored through pipelines, by several workers in parallel.
+        # returns the number of keys restored
+        def restore_batch(batch):
+            now_ms = int(time.time() * 1000)
+            restored_count = 0
+            pipe = self.r.pipeline(transaction=False)
+            for key, key_type, value in batch:
+                if key_type == 'dump':
+                    expire_at_ms = value['expire_at_ms']
+                    if expire_at_ms != None and expire_at_ms <= now_ms:
+                        # expired since the backup was taken
+                        continue
+                    pipe.restore(key, expire_at_ms or 0, base64.b64decode(value['payload']), replace=True, absttl=expire_at_ms != None)
+                elif key_type == 'deleted':
+                    pipe.delete(key)
+                elif key_type == 'string':
+                    pipe.set(key, value)
+                elif key_type == 'hash':
+                    pipe.delete(key)
+                    pipe.hset(key, mapping=value)
+                else:
+                    raise Exception(f'value type not supported: {key_type}')
+                restored_count += 1
+            pipe.execute()
+            return restored_count
+
+        start_time = time.time()
+        last_progress_time = start_time
+        key_count = 0
+        pending = set()
+
+        def collect(return_when):
+            nonlocal pending, key_count
+            done, pending = concurrent.futures.wait(pending, return_when=return_when)
+            for future in done:
+                key_count += future.result()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='restore') as executor:
+            batch = []
+            for record in itertools.chain(records, [None]):
+                if record != None:
+                    batch.append(record)
+                if len(batch) == batch_size or (record == None and len(batch) > 0):
+                    pending.add(executor.submit(restore_batch, batch))
+                    batch = []
+                # bounds the number of batches held in memory
+                if len(pending) >= workers * 2:
+                    collect(concurrent.futures.FIRST_COMPLETED)
+                if time.time() - last_progress_time >= progress_interval_seconds:
+                    last_progress_time = time.time()
+                    elapsed = last_progress_time - start_time
+                    total_str = f'/{total_count}' if total_count != None else ''
+                    logging.info(f'restored {key_count}{total_str} keys, {int(key_count / elapsed)} keys/s')
+            collect(concurrent.futures.ALL_COMPLETED)
+
+        logging.info(f'restored {key_count} keys in {time.time() - start_time:.1f}s')
+        return key_count
 
     def clear_db(self, wait=True):
         if wait:
@@ -0,0 +1,143 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+import collections
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCAL_MAX_ENTRIES = 100000
+DEFAULT_REDIS_MAX_ENTRIES = 1000000
+DEFAULT_REDIS_TTL_SECONDS = 7 * 24 * 3600
+# only short texts (vocabulary items, tokens) are cached, this also bounds the size of every entry
+DEFAULT_MAX_TEXT_LENGTH = 200
+
+# store an entry and register it in the index, then remove the least recently stored entries over the cap.
+# KEYS[1]: index (sorted set of entry keys, scored by time), KEYS[2]: entry key
+# ARGV: value, ttl, current time, max entries
+PUT_SCRIPT = """
+redis.call('SET', KEYS[2], ARGV[1], 'EX', tonumber(ARGV[2]))
+redis.call('ZADD', KEYS[1], tonumber(ARGV[3]), KEYS[2])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[4])
+if excess > 0 then
+    local removed = redis.call('ZPOPMIN', KEYS[1], excess)
+    for i = 1, #removed, 2 do
+        redis.call('DEL', removed[i])
+    end
+end
+return 0
+"""
+
+def build_cache_key(kind, service, options, text):
+    # kind: translation, transliteration, tokenization. options holds the language / transliteration keys.
+    # unicode normalization only, anything else could change the result
+    request_str = json.dumps({
+        'kind': kind,
+        'service': service,
+        'options': options,
+        'text': unicodedata.normalize('NFC', text)
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(request_str.encode('utf-8')).hexdigest()
+
+class LocalResultCache():
+    # in process LRU, bounded by number of entries
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, cache_key):
+        # returns (found, result)
+        with self.lock:
+            if cache_key not in self.entries:
+                return False, None
+            self.entries.move_to_end(cache_key)
+            return True, self.entries[cache_key]
+
+    def put(self, cache_key, result):
+        with self.lock:
+            self.entries[cache_key] = result
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class RedisResultCache():
+    # shared tier, entries expire after ttl_seconds and at most max_entries are kept
+    def __init__(self, redis_client, key_prefix='clt:result_cache', ttl_seconds=DEFAULT_REDIS_TTL_SECONDS, max_entries=DEFAULT_REDIS_MAX_ENTRIES):
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.index_key = f'{key_prefix}:index'
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.put_script = self.redis_client.register_script(PUT_SCRIPT)
+
+    def get(self, cache_key):
+        result_str = self.redis_client.get(f'{self.key_prefix}:{cache_key}')
+        if result_str == None:
+            return False, None
+        return True, json.loads(result_str)
+
+    def put(self, cache_key, result):
+        self.put_script(keys=[self.index_key, f'{self.key_prefix}:{cache_key}'],
+                        args=[json.dumps(result), self.ttl_seconds, time.time(), self.max_entries])
+
+class ResultCache():
+    # translation / transliteration / tokenization results, a local tier, optionally backed by redis.
+    # failures of the redis tier are logged, they never fail the request
+    def __init__(self, local_cache, redis_cache=None, max_text_length=DEFAULT_MAX_TEXT_LENGTH):
+        self.local_cache = local_cache
+        self.redis_cache = redis_cache
+        self.max_text_length = max_text_length
+
+    def get(self, cache_key, promote=True):
+        # returns (found, result), entries found in redis are copied to the local tier if promote is set
+        found, result = self.local_cache.get(cache_key)
+        if found or self.redis_cache == None:
+            return found, result
+        try:
+            found, result = self.redis_cache.get(cache_key)
+        except Exception:
+            logger.exception(f'could not retrieve {cache_key} from redis result cache')
+            return False, None
+        if found and promote:
+            self.local_cache.put(cache_key, result)
+        return found, result
+
+    def put(self, cache_key, result):
+        self.local_cache.put(cache_key, result)
+        if self.redis_cache != None:
+            try:
+                self.redis_cache.put(cache_key, result)
+            except Exception:
+                logger.exception(f'could not store {cache_key} in redis result cache')
+
+    def get_result(self, kind, service, options, text, fn, store_result=True):
+        # returns the cached result, or calls fn. with store_result=False (the user opted out), a cached
+        # result can still be returned, but nothing about this request gets stored
+        if len(text) > self.max_text_length:
+            return fn()
+        cache_key = build_cache_key(kind, service, options, text)
+        found, result = self.get(cache_key, promote=store_result)
+        if found:
+            return result
+        result = fn()
+        if store_result:
+            self.put(cache_key, result)
+        return result
+
+def build_result_cache(config, redis_client):
+    # config is the 'result_cache' section of the secrets config, returns None if disabled
+    if not config.get('enable', True):
+        return None
+
+    local_cache = LocalResultCache(config.get('local_max_entries', DEFAULT_LOCAL_MAX_ENTRIES))
+
+    redis_cache = None
+    if config.get('redis', False):
+        redis_cache = RedisResultCache(redis_client,
+                                       ttl_seconds=config.get('redis_ttl_seconds', DEFAULT_REDIS_TTL_SECONDS),
+                                       max_entries=config.get('redis_max_entries', DEFAULT_REDIS_MAX_ENTRIES))
+
+    return ResultCache(local_cache, redis_cache, config.get('max_text_length', DEFAULT_MAX_TEXT_LENGTH))
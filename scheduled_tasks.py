@@ -7,6 +7,7 @@ import json
 import os
 import requests
 import redisdb
+import db_backup
 import user_utils
 import clt_secrets as secrets
 import sentry_sdk
@@ -29,6 +30,29 @@ def signal_healthcheck_end(url):
         except requests.RequestException as e:
             logger.exception(f'could not ping url {url}')
 
+def get_backup_targets():
+    # (s3 client, bucket name) for each backup target
+    # Digital ocean spaces
+    # ====================
+    session = boto3.session.Session()
+    spaces_client = session.client('s3',
+                            region_name=os.environ['SPACE_REGION'],
+                            endpoint_url=os.environ['SPACE_ENDPOINT_URL'],
+                            aws_access_key_id=os.environ['SPACE_KEY'],
+                            aws_secret_access_key=os.environ['SPACE_SECRET'])    
+    spaces_bucket_name = 'cloud-language-tools-redis-backups'
+
+    # Wasabi
+    # ======
+    session = boto3.session.Session()
+    wasabi_client = session.client('s3',
+                            endpoint_url=secrets.config['wasabi']['endpoint_url'],
+                            aws_access_key_id=secrets.config['wasabi']['access_key'],
+                            aws_secret_access_key=secrets.config['wasabi']['secret_key'])
+    wasabi_bucket_name = secrets.config['wasabi']['bucket_name']
+
+    return [(spaces_client, spaces_bucket_name), (wasabi_client, wasabi_bucket_name)]
+
 @sentry_sdk.crons.monitor(monitor_slug='backup_redis_db')
 def backup_redis_db():
     try:
@@ -38,35 +62,21 @@ def backup_redis_db():
         start_time = time.time()
         connection = redisdb.RedisDb()
 
-        # Digital ocean spaces
-        # ====================
-        session = boto3.session.Session()
-        client = session.client('s3',
-                                region_name=os.environ['SPACE_REGION'],
-                                endpoint_url=os.environ['SPACE_ENDPOINT_URL'],
-                                aws_access_key_id=os.environ['SPACE_KEY'],
-                                aws_secret_access_key=os.environ['SPACE_SECRET'])    
-        bucket_name = 'cloud-language-tools-redis-backups'
-
-        full_db_dump = connection.full_db_dump()
+        (spaces_client, spaces_bucket_name), (wasabi_client, wasabi_bucket_name) = get_backup_targets()
         time_str = datetime.datetime.now().strftime('%H')
-        file_name = f'redis_backup_{time_str}.json'
-        data_str = str(json.dumps(full_db_dump))
-        client.put_object(Body=data_str, Bucket=bucket_name, Key=file_name)
-        logging.info(f'wrote {file_name} to {bucket_name}')
-
-        # Wasabi
-        # ======
-        logging.info('starting backup to wasabi')
-        session = boto3.session.Session()
-        client = session.client('s3',
-                                endpoint_url=secrets.config['wasabi']['endpoint_url'],
-                                aws_access_key_id=secrets.config['wasabi']['access_key'],
-                                aws_secret_access_key=secrets.config['wasabi']['secret_key'])
-        bucket_name = secrets.config['wasabi']['bucket_name']
-        file_name = f'redis_backup.json'
-        client.put_object(Body=data_str, Bucket=bucket_name, Key=file_name)
-        logging.info('finished backup to wasabi')
+        spaces_file_name = f'redis_backup_{time_str}.ndjson.gz'
+        wasabi_file_name = f'redis_backup.ndjson.gz'
+
+        # the dump is streamed, compressed once and uploaded to both targets in the same pass
+        logging.info(f'starting backup to {spaces_bucket_name}/{spaces_file_name} and wasabi {wasabi_bucket_name}/{wasabi_file_name}')
+        key_count = db_backup.upload_ndjson_dump(connection.iter_db_dump(), [
+            (spaces_client, spaces_bucket_name, spaces_file_name),
+            (wasabi_client, wasabi_bucket_name, wasabi_file_name)
+        ])
+        logging.info(f'finished backup of {key_count} keys')
+        if not redisdb.incremental_backup_enabled():
+            # left over from when incremental backups were enabled
+            connection.clear_dirty_keys()
 
         end_time = time.time()
         logging.info(f'END TASK backing up redis db, time elapsed: {end_time - start_time}')
@@ -74,6 +84,38 @@ def backup_redis_db():
     except:
         logging.exception(f'could not backup redis db')
 
+@sentry_sdk.crons.monitor(monitor_slug='backup_redis_db')
+def backup_redis_db_incremental():
+    # a delta with the keys modified since the previous backup, and periodically a new full base
+    try:
+        logging.info('START TASK backing up redis db (incremental)')
+        healthcheck_url = 'https://healthchecks-v4.ipv6n.net/ping/6792d0b5-bd20-4a5f-b601-72a899770275'
+        signal_healthcheck_start(healthcheck_url)
+        start_time = time.time()
+        connection = redisdb.RedisDb()
+        scheduled_tasks_config = secrets.config['scheduled_tasks']
+        object_name = connection.backup_incremental(get_backup_targets(),
+            scheduled_tasks_config.get('full_backup_interval_hours', 24) * 3600,
+            keep_base_count=scheduled_tasks_config.get('keep_full_backups', 3))
+        end_time = time.time()
+        logging.info(f'END TASK backing up redis db (incremental), wrote {object_name}, time elapsed: {end_time - start_time}')
+        signal_healthcheck_end(healthcheck_url)
+    except:
+        logging.exception(f'could not backup redis db')
+
+
+@sentry_sdk.crons.monitor(monitor_slug='sweep_expired_api_keys')
+def sweep_expired_api_keys():
+    try:
+        logging.info('START TASK sweeping expired api keys')
+        start_time = time.time()
+        connection = redisdb.RedisDb()
+        grace_period_days = secrets.config['scheduled_tasks'].get('expired_api_key_grace_period_days', 30)
+        archived_count = connection.sweep_expired_api_keys(grace_period_seconds=grace_period_days * 24 * 3600)
+        end_time = time.time()
+        logging.info(f'END TASK sweeping expired api keys, archived {archived_count} keys, time elapsed: {end_time - start_time}')
+    except:
+        logging.exception(f'could not sweep expired api keys')
 
 @sentry_sdk.crons.monitor(monitor_slug='update_airtable')
 def update_airtable():
@@ -123,15 +165,24 @@ def update_language_data():
 def setup_tasks():
     logging.info('running tasks once')
     if secrets.config['scheduled_tasks']['backup_redis']:
-        logging.info('setting up redis_backup')
-        backup_redis_db()
-        schedule.every(2).hours.do(backup_redis_db)
+        if redisdb.incremental_backup_enabled():
+            logging.info('setting up incremental redis_backup')
+            backup_redis_db_incremental()
+            schedule.every(2).hours.do(backup_redis_db_incremental)
+        else:
+            logging.info('setting up redis_backup')
+            backup_redis_db()
+            schedule.every(2).hours.do(backup_redis_db)
     if secrets.config['scheduled_tasks']['user_data']:
         logging.info('setting up user_data tasks')
         report_getcheddar_usage()
         # update_airtable()
         # schedule.every(30).minutes.do(update_airtable)
         schedule.every(6).hours.do(report_getcheddar_usage)
+    if secrets.config['scheduled_tasks'].get('expired_api_keys', False):
+        logging.info('setting up expired api key sweeper')
+        sweep_expired_api_keys()
+        schedule.every(6).hours.do(sweep_expired_api_keys)
     if secrets.config['scheduled_tasks']['language_data']:
         logging.info('setting up language_data')
         update_language_data()
@@ -0,0 +1,142 @@
+import json
+import time
+import uuid
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# only delete the lock if it's still the one we acquired
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class Call():
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+class SingleFlight():
+    # coalesces concurrent identical calls within a process: the first caller runs the function,
+    # callers arriving while it's running wait for it and share its result (or exception)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key, None)
+            leader = call == None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.exception != None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+class RequestCoalescer():
+    # coalesces identical upstream requests (TTS, translation). within a process, identical requests always
+    # share a single call. if a redis client is passed, a short lived redis lock also coalesces requests
+    # across workers: workers which don't get the lock wait for it to be released, then pick up the result
+    # through lookup(), or through a result shared in redis if no lookup function is given. callers pass
+    # across_workers=False when lookup() couldn't see a result produced by another worker.
+    # redis problems never fail the request, the result gets computed locally instead
+    def __init__(self, redis_client=None, key_prefix='clt:coalesce', lock_timeout_seconds=30, poll_interval_seconds=0.05, max_poll_interval_seconds=1):
+        self.single_flight = SingleFlight()
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.lock_timeout_seconds = lock_timeout_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.max_poll_interval_seconds = max_poll_interval_seconds
+        if self.redis_client != None:
+            self.release_lock_script = self.redis_client.register_script(RELEASE_LOCK_SCRIPT)
+
+    def do(self, key, fn, lookup=None, across_workers=True):
+        if self.redis_client == None or not across_workers:
+            return self.single_flight.do(key, fn)
+        return self.single_flight.do(key, lambda: self.do_across_workers(key, fn, lookup))
+
+    def do_across_workers(self, key, fn, lookup):
+        lock_key = f'{self.key_prefix}:lock:{key}'
+        result_key = f'{self.key_prefix}:result:{key}'
+        token = uuid.uuid4().hex
+
+        try:
+            acquired = self.redis_client.set(lock_key, token, nx=True, ex=self.lock_timeout_seconds)
+        except Exception:
+            # coalescing across workers is an optimization, never fail the request because of it
+            logger.exception(f'could not acquire coalescing lock {lock_key}')
+            return fn()
+
+        if acquired:
+            try:
+                result = fn()
+                if lookup == None:
+                    self.share_result(result_key, result)
+                return result
+            finally:
+                self.release_lock(lock_key, token)
+
+        # another worker is processing the same request, wait for it, polling less and less often
+        deadline = time.monotonic() + self.lock_timeout_seconds
+        poll_interval = self.poll_interval_seconds
+        while True:
+            try:
+                locked = self.redis_client.exists(lock_key)
+            except Exception:
+                logger.exception(f'could not check coalescing lock {lock_key}')
+                return fn()
+            remaining = deadline - time.monotonic()
+            if not locked or remaining <= 0:
+                break
+            time.sleep(min(poll_interval, remaining))
+            poll_interval = min(poll_interval * 2, self.max_poll_interval_seconds)
+
+        if lookup != None:
+            result = lookup()
+        else:
+            result = self.get_shared_result(result_key)
+        if result != None:
+            return result
+
+        # the other worker failed or timed out
+        return fn()
+
+    def share_result(self, result_key, result):
+        try:
+            self.redis_client.set(result_key, json.dumps(result), ex=self.lock_timeout_seconds)
+        except Exception:
+            logger.exception(f'could not share coalesced result {result_key}')
+
+    def get_shared_result(self, result_key):
+        try:
+            result_str = self.redis_client.get(result_key)
+        except Exception:
+            logger.exception(f'could not retrieve coalesced result {result_key}')
+            return None
+        return None if result_str == None else json.loads(result_str)
+
+    def release_lock(self, lock_key, token):
+        # if this fails, the lock expires after lock_timeout_seconds
+        try:
+            self.release_lock_script(keys=[lock_key], args=[token])
+        except Exception:
+            logger.exception(f'could not release coalescing lock {lock_key}')
@@ -1,6 +1,8 @@
 from cloudlanguagetools import tokenization
 import unittest
 import json
+import gzip
+import brotli
 import tempfile
 import magic
 import datetime
@@ -10,7 +12,7 @@ import quotas
 import redisdb
 import urllib.parse
 import pprint
-from app import app, redis_connection, manager
+from app import app, redis_connection, manager, voice_list_catalog
 import cloudlanguagetools.constants
 
 class ApiTests(unittest.TestCase):
@@ -164,6 +166,45 @@ class ApiTests(unittest.TestCase):
         self.assertTrue(len(language1['service']) > 0)
         self.assertTrue(len(language1['transliteration_name']) > 0)
 
+    def test_catalog_etag_compression(self):
+        # pytest test_api.py -rPP -k 'test_catalog_etag_compression'
+        for url in ['/language_data_v1', '/voice_list', '/language_list', '/translation_language_list', '/transliteration_language_list']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            uncompressed_data = json.loads(response.data)
+
+            # gzip
+            response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(response.data)), uncompressed_data)
+
+            # brotli is preferred
+            response = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate, br'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'br')
+            self.assertEqual(json.loads(brotli.decompress(response.data)), uncompressed_data)
+
+            # client already has the catalog
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etag)
+
+            response = self.client.get(url, headers={'If-None-Match': '"outdated"'})
+            self.assertEqual(response.status_code, 200)
+
+    def test_catalog_refresh(self):
+        # pytest test_api.py -rPP -k 'test_catalog_refresh'
+        response = self.client.get('/voice_list')
+        etag = response.headers['ETag']
+
+        # rebuilding the catalog from unchanged data yields the same version
+        voice_list_catalog.refresh()
+        response = self.client.get('/voice_list', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
 
     def test_translate(self):
         source_text = 'Je ne suis pas intéressé.'
@@ -520,6 +561,10 @@ class ApiTests(unittest.TestCase):
 
         self.assertTrue(expected_filetype in filetype)
 
+        # analytics are queued once the response is closed, then written behind
+        response.close()
+        redis_connection.flush_analytics()
+
         # verify usage tracking
         # =====================
 
@@ -552,6 +597,7 @@ class ApiTests(unittest.TestCase):
             'options': {}
         }, headers={'api_key': self.api_key_v2, 'client': 'test', 'client_version': self.client_version})
         self.assertEqual(response.status_code, 200)
+        response.close()
 
         service = 'Azure'
         japanese_voices = [x for x in self.voice_list if x['language_code'] == 'ja' and x['service'] == service]
@@ -566,10 +612,13 @@ class ApiTests(unittest.TestCase):
             'options': {}
         }, headers={'api_key': self.api_key_v2, 'client': 'test', 'client_version': self.client_version})
         self.assertEqual(response.status_code, 200)
+        response.close()
 
         # assert usage logging
         # ====================
 
+        redis_connection.flush_analytics()
+
         # client
         self.assertEqual(3, int(redis_connection.r.hget(tracking_client_redis_key, 'test')))
         # service
@@ -623,6 +672,30 @@ class ApiTests(unittest.TestCase):
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response.headers['Content-Length']), len(response.data))
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+
+        # range request
+        range_response = self.client.get(url, headers={'Range': 'bytes=0-99'})
+        self.assertEqual(range_response.status_code, 206)
+        self.assertEqual(range_response.data, response.data[0:100])
+        self.assertEqual(range_response.headers['Content-Range'], f'bytes 0-99/{len(response.data)}')
+
+        # cache headers, the etag doesn't depend on the api key or on how the url is encoded
+        self.assertIn('public', response.headers['Cache-Control'])
+        self.assertIn('must-revalidate', response.headers['Cache-Control'])
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+        canonical_url = response.headers['Content-Location']
+        canonical_response = self.client.get(canonical_url)
+        self.assertEqual(canonical_response.status_code, 200)
+        self.assertEqual(canonical_response.headers['ETag'], etag)
+        self.assertEqual(canonical_response.headers['Content-Location'], canonical_url)
+
+        # revalidation
+        not_modified_response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(not_modified_response.status_code, 304)
+        self.assertEqual(not_modified_response.headers['ETag'], etag)
 
         output_temp_file = tempfile.NamedTemporaryFile()
         with open(output_temp_file.name, 'wb') as f:
@@ -0,0 +1,76 @@
+import unittest
+import os
+import tempfile
+
+import audio_cache
+
+class TestAudioCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.local_directory = os.path.join(self.temp_dir.name, 'local')
+        self.shared_directory = os.path.join(self.temp_dir.name, 'shared')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_build_cache_key(self):
+        key_1 = audio_cache.build_cache_key('bonjour', 'Azure', {'name': 'fr-FR-DeniseNeural', 'language': 'fr-FR'}, {'rate': 1.0, 'pitch': 0})
+        key_2 = audio_cache.build_cache_key('bonjour', 'Azure', {'language': 'fr-FR', 'name': 'fr-FR-DeniseNeural'}, {'pitch': 0, 'rate': 1.0})
+        self.assertEqual(key_1, key_2)
+
+        key_3 = audio_cache.build_cache_key('bonsoir', 'Azure', {'name': 'fr-FR-DeniseNeural', 'language': 'fr-FR'}, {'rate': 1.0, 'pitch': 0})
+        self.assertNotEqual(key_1, key_3)
+        key_4 = audio_cache.build_cache_key('bonjour', 'Google', {'name': 'fr-FR-DeniseNeural', 'language': 'fr-FR'}, {'rate': 1.0, 'pitch': 0})
+        self.assertNotEqual(key_1, key_4)
+
+    def test_local_cache_eviction(self):
+        local_cache = audio_cache.LocalAudioCache(self.local_directory, 100)
+        self.assertEqual(local_cache.get('key_1'), None)
+
+        local_cache.put('key_1', b'1' * 40)
+        local_cache.put('key_2', b'2' * 40)
+        self.assertEqual(local_cache.get('key_1'), b'1' * 40)
+
+        # key_2 is now the least recently used
+        local_cache.put('key_3', b'3' * 40)
+        self.assertEqual(local_cache.get('key_2'), None)
+        self.assertFalse(os.path.exists(os.path.join(self.local_directory, 'key_2')))
+        self.assertEqual(local_cache.get('key_1'), b'1' * 40)
+        self.assertEqual(local_cache.get('key_3'), b'3' * 40)
+        self.assertEqual(local_cache.total_size, 80)
+
+        # a new process picks up the existing files
+        local_cache_2 = audio_cache.LocalAudioCache(self.local_directory, 100)
+        self.assertEqual(local_cache_2.total_size, 80)
+        self.assertEqual(local_cache_2.get('key_3'), b'3' * 40)
+
+    def test_shared_tier(self):
+        shared_store = audio_cache.DirectoryAudioStore(self.shared_directory)
+        cache_1 = audio_cache.AudioCache(audio_cache.LocalAudioCache(os.path.join(self.local_directory, '1'), 1000), shared_store)
+        cache_2 = audio_cache.AudioCache(audio_cache.LocalAudioCache(os.path.join(self.local_directory, '2'), 1000), shared_store)
+
+        cache_1.put('key_1', b'audio data')
+        # found in the shared tier, then copied into the local tier
+        self.assertEqual(cache_2.get('key_1'), b'audio data')
+        self.assertEqual(cache_2.local_cache.get('key_1'), b'audio data')
+        self.assertEqual(cache_2.get('key_2'), None)
+
+        # the local tier can't be written, the audio is still returned
+        cache_3 = audio_cache.AudioCache(audio_cache.LocalAudioCache(os.path.join(self.local_directory, '3'), 1000), shared_store)
+        os.rmdir(cache_3.local_cache.directory)
+        self.assertEqual(cache_3.get('key_1'), b'audio data')
+
+    def test_build_audio_cache(self):
+        self.assertEqual(audio_cache.build_audio_cache({}), None)
+        self.assertEqual(audio_cache.build_audio_cache({'enable': False}), None)
+        cache = audio_cache.build_audio_cache({
+            'enable': True,
+            'directory': self.local_directory,
+            'max_size_mb': 1,
+            'shared': {
+                'type': 'directory',
+                'directory': self.shared_directory
+            }
+        })
+        self.assertEqual(cache.local_cache.max_size_bytes, 1024 * 1024)
+        self.assertTrue(isinstance(cache.shared_store, audio_cache.DirectoryAudioStore))
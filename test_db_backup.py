@@ -0,0 +1,103 @@
+import io
+import unittest
+
+import db_backup
+
+class InMemoryS3Client():
+    # records multipart uploads, implements the subset of the boto3 s3 client used by MultipartUploadWriter
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f'upload_{len(self.uploads)}'
+        self.uploads[upload_id] = []
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId].append(Body)
+        return {'ETag': f'etag_{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.objects[(Bucket, Key)] = b''.join(self.uploads.pop(UploadId))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        # a single page
+        keys = sorted([key for bucket_name, key in self.objects.keys() if bucket_name == Bucket and key.startswith(Prefix)])
+        if Delimiter == None:
+            yield {'Contents': [{'Key': key} for key in keys]}
+            return
+        prefixes = sorted(set([Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter for key in keys if Delimiter in key[len(Prefix):]]))
+        yield {'CommonPrefixes': [{'Prefix': prefix} for prefix in prefixes]}
+
+    def delete_objects(self, Bucket, Delete):
+        for entry in Delete['Objects']:
+            del self.objects[(Bucket, entry['Key'])]
+
+class TestDbBackup(unittest.TestCase):
+    def test_multipart_upload_writer(self):
+        client = InMemoryS3Client()
+        writer = db_backup.MultipartUploadWriter(client, 'bucket', 'backup', part_size=10)
+        writer.write(b'0123456789abc')
+        writer.write(b'defghij')
+        writer.complete()
+        self.assertEqual(client.objects[('bucket', 'backup')], b'0123456789abcdefghij')
+        self.assertEqual(len(writer.parts), 2)
+
+        # empty upload
+        writer = db_backup.MultipartUploadWriter(client, 'bucket', 'empty', part_size=10)
+        writer.complete()
+        self.assertEqual(client.objects[('bucket', 'empty')], b'')
+
+        # closed without being completed, nothing gets stored
+        writer = db_backup.MultipartUploadWriter(client, 'bucket', 'truncated', part_size=10)
+        writer.write(b'0123456789abc')
+        writer.close()
+        self.assertNotIn(('bucket', 'truncated'), client.objects)
+        self.assertEqual(client.uploads, {})
+
+    def test_upload_ndjson_dump(self):
+        records = [(f'clt:key_{i}', 'string', f'value_{i}') for i in range(1000)]
+        records.append(('clt:hash', 'hash', {'field': 'value', 'unicode': '日本語'}))
+        client_1 = InMemoryS3Client()
+        client_2 = InMemoryS3Client()
+        record_count = db_backup.upload_ndjson_dump(iter(records),
+            [(client_1, 'bucket_1', 'backup.ndjson.gz'), (client_2, 'bucket_2', 'backup.ndjson.gz')],
+            part_size=1024)
+        self.assertEqual(record_count, len(records))
+
+        data = client_1.objects[('bucket_1', 'backup.ndjson.gz')]
+        self.assertEqual(data, client_2.objects[('bucket_2', 'backup.ndjson.gz')])
+        self.assertEqual(list(db_backup.read_ndjson_dump(io.BytesIO(data))), records)
+
+    def test_upload_ndjson_dump_failure(self):
+        def failing_records():
+            yield 'clt:key', 'string', 'value'
+            raise Exception('connection lost')
+        client = InMemoryS3Client()
+        with self.assertRaises(Exception):
+            db_backup.upload_ndjson_dump(failing_records(), [(client, 'bucket', 'backup.ndjson.gz')])
+        # nothing gets stored, the upload is aborted
+        self.assertEqual(client.objects, {})
+        self.assertEqual(client.uploads, {})
+
+    def test_prune_backups(self):
+        client = InMemoryS3Client()
+        for backup_id in ['20261016-000000', '20261017-000000', '20261018-000000']:
+            for file_name in ['base.ndjson.gz', 'delta_00001.ndjson.gz']:
+                client.objects[('bucket', f'incremental/{backup_id}/{file_name}')] = b''
+        client.objects[('bucket', 'redis_backup.ndjson.gz')] = b''
+
+        db_backup.prune_backups(client, 'bucket', 'incremental/', 2)
+        self.assertEqual(sorted([key for bucket_name, key in client.objects.keys()]), [
+            'incremental/20261017-000000/base.ndjson.gz',
+            'incremental/20261017-000000/delta_00001.ndjson.gz',
+            'incremental/20261018-000000/base.ndjson.gz',
+            'incremental/20261018-000000/delta_00001.ndjson.gz',
+            'redis_backup.ndjson.gz'])
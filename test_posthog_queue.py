@@ -0,0 +1,62 @@
+import unittest
+import threading
+
+import posthog_queue
+
+class PosthogClient():
+    def __init__(self, block_event=None):
+        self.block_event = block_event
+        self.events = []
+
+    def capture(self, event, distinct_id, properties):
+        if self.block_event != None:
+            self.block_event.wait()
+        self.events.append((event, distinct_id, properties))
+
+class DailyLimit():
+    # same contract as RedisDb.should_send_posthog_event
+    def __init__(self, daily_limit):
+        self.daily_limit = daily_limit
+        self.counts = {}
+
+    def should_send_posthog_event(self, api_key):
+        self.counts[api_key] = self.counts.get(api_key, 0) + 1
+        return self.counts[api_key] <= self.daily_limit
+
+class TestPosthogEventQueue(unittest.TestCase):
+    def test_daily_limit(self):
+        client = PosthogClient()
+        event_queue = posthog_queue.PosthogEventQueue(client, DailyLimit(2))
+        event_queue.start()
+        for i in range(3):
+            self.assertTrue(event_queue.submit('key_1', 'usage', 'user1@gmail.com', {'i': i}))
+        event_queue.submit('key_2', 'usage', 'user2@gmail.com', {'i': 0})
+        event_queue.stop()
+
+        self.assertEqual([(x[1], x[2]['i']) for x in client.events],
+            [('user1@gmail.com', 0), ('user1@gmail.com', 1), ('user2@gmail.com', 0)])
+
+    def test_drop_when_full(self):
+        block_event = threading.Event()
+        client = PosthogClient(block_event)
+        event_queue = posthog_queue.PosthogEventQueue(client, DailyLimit(100), max_size=2)
+        event_queue.start()
+
+        # the worker is stuck on the first event, two more fit in the queue, the rest gets dropped
+        results = [event_queue.submit('key_1', 'usage', 'user1@gmail.com', {'i': i}) for i in range(10)]
+        self.assertEqual(results.count(False), event_queue.dropped_events)
+        self.assertGreaterEqual(event_queue.dropped_events, 7)
+
+        block_event.set()
+        event_queue.stop()
+        self.assertEqual(len(client.events), 10 - event_queue.dropped_events)
+
+    def test_capture_error(self):
+        class FailingClient():
+            def capture(self, event, distinct_id, properties):
+                raise Exception('posthog unavailable')
+        event_queue = posthog_queue.PosthogEventQueue(FailingClient(), DailyLimit(100))
+        event_queue.start()
+        event_queue.submit('key_1', 'usage', 'user1@gmail.com', {})
+        event_queue.stop()
+        self.assertEqual(event_queue.failed_events, 1)
@@ -1,6 +1,7 @@
 import unittest
 import quotas
 import datetime
+import math
 
 import cloudlanguagetools.constants
 import cloudlanguagetools.languages
@@ -295,4 +296,30 @@ class TestQuotas(unittest.TestCase):
             cloudlanguagetools.constants.ApiKeyType.getcheddar,
             {})
 
-        self.assertEqual(usage_slice_recurring_user.build_key_suffix(), f'user:recurring:zrrVDK3svzDOLzI6')        
\ No newline at end of file
+        self.assertEqual(usage_slice_recurring_user.build_key_suffix(), f'user:recurring:zrrVDK3svzDOLzI6')
+
+    def test_date_suffixes(self):
+        date = datetime.datetime(2026, 10, 18)
+        date_suffixes = quotas.build_date_suffixes(date)
+        usage_slice = quotas.UsageSlice(
+            cloudlanguagetools.constants.RequestType.audio,
+            cloudlanguagetools.constants.UsageScope.Global, 
+            cloudlanguagetools.constants.UsagePeriod.daily, 
+            cloudlanguagetools.constants.Service.Azure,
+            'api_key_1',
+            cloudlanguagetools.constants.ApiKeyType.patreon,
+            {},
+            date_suffixes)
+        self.assertEqual(usage_slice.build_key_suffix(), 'global:daily:20261018:Azure:audio')
+        usage_slice.usage_period = cloudlanguagetools.constants.UsagePeriod.monthly
+        self.assertEqual(usage_slice.build_key_suffix(), 'global:monthly:202610:Azure:audio')
+
+    def test_usage_index_suffix(self):
+        self.assertEqual(quotas.get_usage_index_suffix('user:daily:20261018:Naver:audio:zrrVDK3svzDOLzI6'), 'user:daily:20261018')
+        self.assertEqual(quotas.get_usage_index_suffix('global:monthly:202610:Naver:audio'), 'global:monthly:202610')
+        self.assertEqual(quotas.get_usage_index_suffix('user:patreon_monthly:202610:zrrVDK3svzDOLzI6'), 'user:patreon_monthly:202610')
+        self.assertEqual(quotas.get_usage_index_suffix('user:lifetime:zrrVDK3svzDOLzI6'), 'user:lifetime')
+
+    def test_character_cost(self):
+        self.assertEqual(quotas.get_character_cost('DeepL', 'translation'), (1.0/1000000) * 24.22)
+        self.assertTrue(math.isnan(quotas.get_character_cost('Forvo', 'audio')))
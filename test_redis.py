@@ -1,9 +1,20 @@
 import unittest
 import quotas
 import datetime
+import json
+import time
+import threading
+import io
+import os
+import tempfile
 
 import redisdb
+import result_cache
+import rate_limiter
+import db_backup
+import test_db_backup
 import cloudlanguagetools.constants
+import cloudlanguagetools.errors
 
 class TestApiKeys(unittest.TestCase):
     def setUp(self):
@@ -110,7 +121,464 @@ class TestApiKeys(unittest.TestCase):
         # this request should go through
         self.redis_connection.track_usage(api_key, service, request_type, 5200)
 
-        
+    def test_track_usage_over_quota_not_recorded(self):
+        email = 'trial_user_43@gmail.com'
+        api_key = self.redis_connection.get_trial_user_key(email)
+
+        service = cloudlanguagetools.constants.Service.Azure
+        request_type = cloudlanguagetools.constants.RequestType.audio
+
+        self.redis_connection.track_usage(api_key, service, request_type, quotas.TRIAL_USER_CHARACTER_LIMIT - 100)
+        self.assertRaises(cloudlanguagetools.errors.OverQuotaError, self.redis_connection.track_usage, api_key, service, request_type, 150)
+
+        # the rejected request must not have been recorded on any slice
+        for usage_period in [cloudlanguagetools.constants.UsagePeriod.daily, cloudlanguagetools.constants.UsagePeriod.lifetime]:
+            usage_slice = quotas.UsageSlice(request_type,
+                                cloudlanguagetools.constants.UsageScope.User,
+                                usage_period,
+                                service,
+                                api_key,
+                                cloudlanguagetools.constants.ApiKeyType.trial,
+                                {})
+            usage_data = self.redis_connection.get_usage_slice_data(usage_slice)
+            self.assertEqual(usage_data, {'characters': quotas.TRIAL_USER_CHARACTER_LIMIT - 100, 'requests': 1})
+
+        # a request which fits in the remaining quota still goes through
+        self.redis_connection.track_usage(api_key, service, request_type, 100)
+
+    def test_api_key_cache(self):
+        cached_connection = redisdb.RedisDb(api_key_cache=redisdb.ApiKeyCache())
+        api_key = cached_connection.password_generator()
+
+        # unknown keys are cached as invalid
+        result = cached_connection.api_key_valid(api_key)
+        self.assertEqual(result['key_valid'], False)
+        self.assertEqual(cached_connection.api_key_cache.get(api_key), (True, None))
+
+        # adding the key invalidates the cached entry
+        cached_connection.add_trial_api_key(api_key, 'trialuser_cache@gmail.com', 10000)
+        result = cached_connection.api_key_valid(api_key)
+        self.assertEqual(result['key_valid'], True)
+        found, api_key_data = cached_connection.api_key_cache.get(api_key)
+        self.assertEqual(found, True)
+        self.assertEqual(api_key_data['character_limit'], 10000)
+
+        # modify the key directly, then invalidate
+        redis_api_key = cached_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key)
+        cached_connection.r.hset(redis_api_key, 'expiration', cached_connection.get_specific_api_key_expiration_timestamp(-2))
+        cached_connection.invalidate_api_key(api_key)
+        result = cached_connection.api_key_valid(api_key)
+        self.assertEqual(result['key_valid'], False)
+        self.assertEqual(result['msg'], 'API Key expired')
+
+        # archived keys are cached as such, no redis round trip is needed to report them as expired
+        cached_connection.rebuild_indexes()
+        cached_connection.sweep_expired_api_keys()
+        self.assertEqual(cached_connection.api_key_valid(api_key), {'key_valid': False, 'msg': 'API Key expired'})
+        self.assertEqual(cached_connection.api_key_cache.get(api_key), (True, redisdb.ARCHIVED_API_KEY))
+        with self.assertRaises(cloudlanguagetools.errors.ApiKeyNotFoundError):
+            cached_connection.get_api_key_data(api_key)
+
+    def test_api_key_cache_invalidated_during_load(self):
+        api_key_cache = redisdb.ApiKeyCache()
+        generation = api_key_cache.get_generation()
+        # invalidated by another thread / process while the record was being loaded from redis
+        api_key_cache.invalidate('api_key_1')
+        api_key_cache.set('api_key_1', {'type': 'trial', 'character_limit': 10000}, generation=generation)
+        self.assertEqual(api_key_cache.get('api_key_1'), (False, None))
+
+        generation = api_key_cache.get_generation()
+        api_key_cache.set('api_key_1', {'type': 'trial', 'character_limit': 20000}, generation=generation)
+        self.assertEqual(api_key_cache.get('api_key_1'), (True, {'type': 'trial', 'character_limit': 20000}))
+
+    def test_api_key_invalidation_across_processes(self):
+        # pytest test_redis.py -k test_api_key_invalidation_across_processes
+        cached_connection = redisdb.RedisDb(api_key_cache=redisdb.ApiKeyCache())
+        listener_thread = threading.Thread(target=cached_connection.listen_api_key_invalidations, daemon=True)
+        listener_thread.start()
+        time.sleep(0.5)
+
+        email = 'user57@gmail.com'
+        api_key = cached_connection.get_trial_user_key(email)
+        result = cached_connection.api_key_valid(api_key)
+        self.assertEqual(result['key_valid'], True)
+        found, api_key_data = cached_connection.api_key_cache.get(api_key)
+        self.assertEqual(api_key_data['character_limit'], quotas.TRIAL_USER_CHARACTER_LIMIT)
+
+        # modify the key from another connection, which doesn't share the cache
+        self.redis_connection.increase_trial_key_limit(email, quotas.TRIAL_EXTENDED_USER_CHARACTER_LIMIT)
+        time.sleep(0.5)
+
+        self.assertEqual(cached_connection.api_key_cache.get(api_key), (False, None))
+        api_key_data = cached_connection.get_api_key_data(api_key)
+        self.assertEqual(api_key_data['character_limit'], quotas.TRIAL_EXTENDED_USER_CHARACTER_LIMIT)
+
+    def test_language_data_version(self):
+        self.assertEqual(self.redis_connection.get_language_data_version(), None)
+
+        self.redis_connection.store_language_data({'language_list': {'fr': 'French'}})
+        version_1 = self.redis_connection.get_language_data_version()
+        self.assertNotEqual(version_1, None)
+        self.assertEqual(self.redis_connection.get_language_data(), {'language_list': {'fr': 'French'}})
 
+        # same data, same version
+        self.redis_connection.store_language_data({'language_list': {'fr': 'French'}})
+        self.assertEqual(self.redis_connection.get_language_data_version(), version_1)
 
+        self.redis_connection.store_language_data({'language_list': {'fr': 'French', 'ja': 'Japanese'}})
+        version_2, language_data_str = self.redis_connection.get_language_data_str_versioned()
+        self.assertNotEqual(version_2, version_1)
+        self.assertEqual(json.loads(language_data_str), {'language_list': {'fr': 'French', 'ja': 'Japanese'}})
 
+    def test_request_analytics(self):
+        api_key = self.redis_connection.password_generator()
+
+        analytics = self.redis_connection.request_analytics(api_key)
+        analytics.track_client('test', '1.0')
+        analytics.track_request_mode(cloudlanguagetools.constants.RequestMode.batch)
+        analytics.track_service(cloudlanguagetools.constants.Service.Azure)
+
+        # nothing is written until write() is called
+        client_redis_key = self.redis_connection.build_monthly_user_key(redisdb.KEY_TYPE_USER_CLIENT, api_key)
+        self.assertEqual(self.redis_connection.r.hget(client_redis_key, 'test'), None)
+
+        analytics.write()
+        self.redis_connection.track_service(api_key, cloudlanguagetools.constants.Service.Azure)
+
+        self.assertEqual(int(self.redis_connection.r.hget(client_redis_key, 'test')), 1)
+        client_version_redis_key = self.redis_connection.build_monthly_user_key(redisdb.KEY_TYPE_USER_CLIENT_VERSION, api_key)
+        self.assertEqual(int(self.redis_connection.r.hget(client_version_redis_key, 'test_1.0')), 1)
+        request_mode_redis_key = self.redis_connection.build_monthly_user_key(redisdb.KEY_TYPE_USER_REQUEST_MODE, api_key)
+        self.assertEqual(int(self.redis_connection.r.hget(request_mode_redis_key, 'batch')), 1)
+        service_redis_key = self.redis_connection.build_monthly_user_key(redisdb.KEY_TYPE_USER_SERVICE, api_key)
+        self.assertEqual(int(self.redis_connection.r.hget(service_redis_key, 'Azure')), 2)
+        self.assertGreater(self.redis_connection.r.ttl(service_redis_key), 0)
+
+        # unknown clients are rejected right away
+        with self.assertRaises(KeyError):
+            self.redis_connection.request_analytics(api_key).track_client('unknown_client', '1.0')
+
+    def test_analytics_queue(self):
+        api_key = self.redis_connection.password_generator()
+        analytics_queue = self.redis_connection.enable_analytics_queue(flush_interval_seconds=3600, max_pending_events=100)
+
+        for i in range(50):
+            self.redis_connection.track_service(api_key, cloudlanguagetools.constants.Service.Azure)
+        self.redis_connection.log_audio_request(api_key, {'service': 'Azure'})
+        self.redis_connection.log_audio_request(api_key, {'service': 'Google'})
+
+        # aggregated in memory, not written yet
+        self.assertEqual(analytics_queue.counters[(self.redis_connection.build_monthly_user_key(redisdb.KEY_TYPE_USER_SERVICE, api_key), 'Azure')], 50)
+        service_redis_key = self.redis_connection.build_monthly_user_key(redisdb.KEY_TYPE_USER_SERVICE, api_key)
+        self.assertEqual(self.redis_connection.r.hget(service_redis_key, 'Azure'), None)
+
+        self.redis_connection.flush_analytics()
+        self.assertEqual(int(self.redis_connection.r.hget(service_redis_key, 'Azure')), 50)
+        self.assertGreater(self.redis_connection.r.ttl(service_redis_key), 0)
+        audio_log_redis_key = self.redis_connection.build_key(redisdb.KEY_TYPE_AUDIO_LOG, datetime.datetime.today().strftime('%Y%m'))
+        audio_log_entries = [json.loads(x) for x in self.redis_connection.r.lrange(audio_log_redis_key, 0, -1)]
+        self.assertEqual([x['service'] for x in audio_log_entries], ['Azure', 'Google'])
+
+        # reaching max_pending_events wakes up the background thread
+        for i in range(100):
+            self.redis_connection.track_service(api_key, cloudlanguagetools.constants.Service.Google)
+        deadline = time.time() + 5
+        while self.redis_connection.r.hget(service_redis_key, 'Google') == None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(int(self.redis_connection.r.hget(service_redis_key, 'Google')), 100)
+
+        # stopping writes whatever is left
+        self.redis_connection.track_service(api_key, cloudlanguagetools.constants.Service.Azure)
+        analytics_queue.stop()
+        self.assertEqual(int(self.redis_connection.r.hget(service_redis_key, 'Azure')), 51)
+
+    def test_redis_result_cache(self):
+        redis_cache = result_cache.RedisResultCache(self.redis_connection.r, key_prefix='clt:test_result_cache', ttl_seconds=60, max_entries=3)
+        for i in range(5):
+            redis_cache.put(f'key_{i}', {'translation': f'result {i}'})
+
+        # only the 3 most recent entries are kept
+        self.assertEqual(redis_cache.get('key_0'), (False, None))
+        self.assertEqual(redis_cache.get('key_1'), (False, None))
+        self.assertEqual(redis_cache.get('key_4'), (True, {'translation': 'result 4'}))
+        self.assertEqual(self.redis_connection.r.zcard('clt:test_result_cache:index'), 3)
+        self.assertGreater(self.redis_connection.r.ttl('clt:test_result_cache:key_4'), 0)
+
+    def test_rate_limiter(self):
+        api_key = self.redis_connection.password_generator()
+        limiter = rate_limiter.TokenBucketRateLimiter(self.redis_connection.r, (1, 10),
+            {cloudlanguagetools.constants.Service.Forvo: (1, 3)}, key_prefix='clt:test_rate_limit')
+
+        # forvo has its own, smaller bucket
+        for i in range(3):
+            self.assertEqual(limiter.check(api_key, cloudlanguagetools.constants.Service.Forvo), None)
+        retry_after = limiter.check(api_key, cloudlanguagetools.constants.Service.Forvo)
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 1)
+        # the local fast path answers until the bucket has a token again
+        self.assertIn((f'clt:test_rate_limit:{api_key}', f'clt:test_rate_limit:{api_key}:Forvo'), limiter.blocked_until)
+
+        # the rejected forvo request didn't take a token from the api key bucket
+        for i in range(7):
+            self.assertEqual(limiter.check(api_key, cloudlanguagetools.constants.Service.Azure), None)
+        self.assertNotEqual(limiter.check(api_key, cloudlanguagetools.constants.Service.Azure), None)
+        self.assertEqual(rate_limiter.get_retry_after_header(0.01), '1')
+
+        # the bucket refills
+        time.sleep(1.1)
+        self.assertEqual(limiter.check(api_key, cloudlanguagetools.constants.Service.Forvo), None)
+
+    def test_api_key_indexes(self):
+        trial_api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_trial_api_key(trial_api_key, 'trialuser@gmail.com', 10000)
+        patreon_api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_patreon_api_key(patreon_api_key, 42, 'patreonuser@gmail.com')
+        getcheddar_api_key = self.redis_connection.get_update_getcheddar_user_key({
+            'code': 'getcheddar_user_1',
+            'email': 'cheddar@gmail.com',
+            'thousand_char_quota': 250,
+            'thousand_char_overage_allowed': 0,
+            'thousand_char_used': 0})
+        self.redis_connection.track_usage(trial_api_key, cloudlanguagetools.constants.Service.Azure, cloudlanguagetools.constants.RequestType.audio, 10)
+
+        # not built yet: scanning
+        self.assertFalse(self.redis_connection.api_key_index_built())
+        scanned_api_keys = sorted([x['api_key'] for x in self.redis_connection.list_api_keys()])
+        date_str = datetime.datetime.today().strftime('%Y%m%d')
+        scanned_usage_keys = sorted([x['usage_key'] for x in self.redis_connection.list_usage(f'usage:user:daily:{date_str}')])
+        self.assertTrue(len(scanned_usage_keys) > 0)
+
+        self.redis_connection.rebuild_indexes()
+        self.assertTrue(self.redis_connection.api_key_index_built())
+        self.assertEqual(sorted([x['api_key'] for x in self.redis_connection.list_api_keys()]), scanned_api_keys)
+        self.assertEqual(self.redis_connection.list_getcheddar_api_keys(), [getcheddar_api_key])
+        expiration_index_key = self.redis_connection.build_api_key_expiration_index_key()
+        self.assertEqual(sorted(self.redis_connection.r.zrange(expiration_index_key, 0, -1)), sorted([trial_api_key, patreon_api_key]))
+
+        # indexes are maintained from then on
+        test_api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_test_api_key(test_api_key)
+        self.assertIn(test_api_key, [x['api_key'] for x in self.redis_connection.list_api_keys()])
+        self.redis_connection.set_api_key_expiration(trial_api_key, 1000)
+        self.assertEqual(self.redis_connection.r.zscore(expiration_index_key, trial_api_key), 1000)
+        self.redis_connection.delete_getcheddar_user('getcheddar_user_1')
+        self.assertEqual(self.redis_connection.list_getcheddar_api_keys(), [])
+        self.redis_connection.remove_key(self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, test_api_key), sleep=False)
+        self.assertNotIn(test_api_key, [x['api_key'] for x in self.redis_connection.list_api_keys()])
+
+        # usage keys, now listed from the index
+        self.assertTrue(self.redis_connection.usage_index_built())
+        usage_entries = self.redis_connection.list_usage(f'usage:user:daily:{date_str}')
+        self.assertEqual(sorted([x['usage_key'] for x in usage_entries]), scanned_usage_keys)
+
+    def test_sweep_expired_api_keys(self):
+        self.redis_connection.rebuild_indexes()
+
+        expired_api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_patreon_api_key(expired_api_key, 60, 'expireduser@gmail.com')
+        valid_api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_test_api_key(valid_api_key)
+        expiration = int(time.time()) - 3600
+        self.redis_connection.set_api_key_expiration(expired_api_key, expiration)
+        self.assertEqual(self.redis_connection.api_key_valid(expired_api_key)['msg'], 'API Key expired')
+
+        self.assertEqual(self.redis_connection.sweep_expired_api_keys(), 1)
+        self.assertFalse(self.redis_connection.r.exists(self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, expired_api_key)))
+        self.assertEqual(self.redis_connection.list_expired_api_keys(), [(expired_api_key, expiration)])
+        self.assertNotIn(expired_api_key, [x['api_key'] for x in self.redis_connection.list_api_keys()])
+        # still reported as expired, not as unknown
+        result = self.redis_connection.api_key_valid(expired_api_key)
+        self.assertEqual(result, {'key_valid': False, 'msg': 'API Key expired'})
+        self.assertEqual(self.redis_connection.api_key_valid(valid_api_key)['key_valid'], True)
+        # nothing left to sweep
+        self.assertEqual(self.redis_connection.sweep_expired_api_keys(), 0)
+
+        # extending the expiration restores the key
+        self.redis_connection.set_api_key_expiration(expired_api_key, self.redis_connection.get_api_key_expiration_timestamp())
+        self.assertEqual(self.redis_connection.api_key_valid(expired_api_key)['key_valid'], True)
+        self.assertEqual(self.redis_connection.get_api_key_data(expired_api_key)['email'], 'expireduser@gmail.com')
+        self.assertEqual(self.redis_connection.list_expired_api_keys(), [])
+        self.assertIn(expired_api_key, [x['api_key'] for x in self.redis_connection.list_api_keys()])
+
+    def test_sweep_expired_api_keys_missing_hash(self):
+        self.redis_connection.rebuild_indexes()
+
+        api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_test_api_key(api_key)
+        self.redis_connection.set_api_key_expiration(api_key, int(time.time()) - 3600)
+        # removed without going through the indexes
+        self.redis_connection.r.delete(self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key))
+
+        # only the stale index entries are removed, nothing is archived
+        self.assertEqual(self.redis_connection.sweep_expired_api_keys(), 0)
+        self.assertEqual(self.redis_connection.list_expired_api_keys(), [])
+        self.assertEqual(self.redis_connection.r.zscore(self.redis_connection.build_api_key_expiration_index_key(), api_key), None)
+
+        # a stale expired index entry doesn't create an api key without a type
+        self.redis_connection.r.zadd(self.redis_connection.build_expired_api_key_index_key(), {api_key: 1000})
+        self.assertFalse(self.redis_connection.set_api_key_expiration(api_key, self.redis_connection.get_api_key_expiration_timestamp()))
+        self.assertFalse(self.redis_connection.r.exists(self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key)))
+        self.assertEqual(self.redis_connection.list_expired_api_keys(), [])
+
+    def test_ndjson_dump(self):
+        api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_trial_api_key(api_key, 'trialuser@gmail.com', 10000)
+        self.redis_connection.r.set(self.redis_connection.build_key(redisdb.KEY_TYPE_TRIAL_USER, 'trialuser@gmail.com'), api_key)
+        for i in range(2500):
+            self.redis_connection.r.set(f'clt:test_string_{i}', f'value_{i}')
+        audio_log_key = self.redis_connection.build_key(redisdb.KEY_TYPE_AUDIO_LOG, '202610')
+        self.redis_connection.r.rpush(audio_log_key, 'request_1', 'request_2')
+        usage_key = self.redis_connection.build_key(redisdb.KEY_TYPE_USAGE, f'user:daily:20261018:{api_key}')
+        self.redis_connection.r.hset(usage_key, 'characters', 10)
+        self.redis_connection.r.expire(usage_key, 3600)
+        full_db_dump = self.redis_connection.full_db_dump()
+        all_keys = set(self.redis_connection.r.scan_iter(count=1000))
+        # besides hashes and strings: the list, and the api key index set / sorted set
+        self.assertIn(audio_log_key, all_keys)
+        self.assertIn(self.redis_connection.build_api_key_expiration_index_key(), all_keys)
+
+        f = io.BytesIO()
+        records = list(self.redis_connection.iter_db_dump(batch_size=100))
+        self.assertEqual(set([key for key, key_type, value in records]), all_keys)
+        record_count = db_backup.write_ndjson_dump(iter(records), f)
+        self.assertEqual(record_count, len(all_keys))
+
+        self.redis_connection.clear_db(wait=False)
+        f.seek(0)
+        self.assertEqual(self.redis_connection.restore_ndjson_dump(db_backup.read_ndjson_dump(f), batch_size=100, workers=4), record_count)
+        self.assertEqual(self.redis_connection.full_db_dump(), full_db_dump)
+        self.assertEqual(set(self.redis_connection.r.scan_iter(count=1000)), all_keys)
+        self.assertEqual(self.redis_connection.r.lrange(audio_log_key, 0, -1), ['request_1', 'request_2'])
+        # TTLs are kept, keys without one don't get one
+        usage_key_ttl = self.redis_connection.r.ttl(usage_key)
+        self.assertTrue(usage_key_ttl > 3500 and usage_key_ttl <= 3600)
+        self.assertEqual(self.redis_connection.r.ttl(self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key)), -1)
+        self.assertEqual(self.redis_connection.api_key_valid(api_key)['key_valid'], True)
+
+    def test_incremental_backup(self):
+        # dirty keys are only recorded with incremental backups enabled
+        self.redis_connection.add_test_api_key(self.redis_connection.password_generator())
+        self.assertEqual(self.redis_connection.r.exists(self.redis_connection.build_global_key(redisdb.BACKUP_DIRTY_KEYS_KEY)), 0)
+        self.redis_connection = redisdb.RedisDb(track_dirty_keys=True)
+
+        client = test_db_backup.InMemoryS3Client()
+        targets = [(client, 'bucket')]
+        api_key_1 = self.redis_connection.password_generator()
+        self.redis_connection.add_trial_api_key(api_key_1, 'trialuser1@gmail.com', 10000)
+        api_key_2 = self.redis_connection.password_generator()
+        self.redis_connection.add_test_api_key(api_key_2)
+
+        # first backup is a base
+        base_name = self.redis_connection.backup_incremental(targets, 24 * 3600)
+        self.assertTrue(base_name.endswith('/base.ndjson.gz'))
+
+        # modifications are recorded
+        self.redis_connection.track_usage(api_key_1, cloudlanguagetools.constants.Service.Azure, cloudlanguagetools.constants.RequestType.audio, 10)
+        self.redis_connection.set_api_key_expiration(api_key_1, self.redis_connection.get_api_key_expiration_timestamp_long())
+        self.redis_connection.remove_key(self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key_2), sleep=False)
+        dirty_keys = self.redis_connection.r.smembers(self.redis_connection.build_global_key(redisdb.BACKUP_DIRTY_KEYS_KEY))
+        self.assertIn(self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key_1), dirty_keys)
+        self.assertIn(self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key_2), dirty_keys)
+
+        delta_name = self.redis_connection.backup_incremental(targets, 24 * 3600)
+        self.assertTrue(delta_name.endswith('/delta_00001.ndjson.gz'))
+        delta_records = list(db_backup.read_ndjson_dump(io.BytesIO(client.objects[('bucket', delta_name)])))
+        # only the modified keys
+        self.assertEqual(len(delta_records), len(dirty_keys))
+        self.assertIn((self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key_2), 'deleted', None), delta_records)
+        self.assertEqual(self.redis_connection.r.scard(self.redis_connection.build_global_key(redisdb.BACKUP_DIRTY_KEYS_KEY)), 0)
+
+        full_db_dump = self.redis_connection.full_db_dump()
+
+        # replay base and delta
+        with tempfile.TemporaryDirectory() as directory:
+            for object_name in [base_name, delta_name]:
+                with open(os.path.join(directory, object_name.split('/')[-1]), 'wb') as f:
+                    f.write(client.objects[('bucket', object_name)])
+            self.redis_connection.clear_db(wait=False)
+            self.redis_connection.restore_incremental_backup(directory)
+
+        # backup state isn't backed up, indexes get rebuilt
+        skipped_prefixes = (self.redis_connection.build_global_key(redisdb.BACKUP_KEY_PREFIX),
+                            self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY_INDEX, ''),
+                            self.redis_connection.build_key(redisdb.KEY_TYPE_USAGE_INDEX, ''),
+                            self.redis_connection.build_key(redisdb.KEY_TYPE_USAGE_INDEX_LIST, ''))
+        restored_db_dump = self.redis_connection.full_db_dump()
+        for key, value in full_db_dump.items():
+            if not key.startswith(skipped_prefixes):
+                self.assertEqual(restored_db_dump[key], value)
+        self.assertEqual(self.redis_connection.api_key_valid(api_key_1)['key_valid'], True)
+        self.assertEqual(self.redis_connection.api_key_valid(api_key_2)['key_valid'], False)
+        restored_api_keys = [x['api_key'] for x in self.redis_connection.list_api_keys()]
+        self.assertIn(api_key_1, restored_api_keys)
+        self.assertNotIn(api_key_2, restored_api_keys)
+
+    def test_rebuild_indexes_concurrent_updates(self):
+        # stale entries are dropped by a rebuild
+        trial_index_key = self.redis_connection.build_api_key_type_index_key(cloudlanguagetools.constants.ApiKeyType.trial.name)
+        self.redis_connection.r.sadd(trial_index_key, 'deleted_api_key')
+        self.redis_connection.rebuild_indexes()
+        self.assertEqual(self.redis_connection.r.smembers(trial_index_key), set())
+
+        # updates made to the live index while the rebuild scanned the keyspace are kept
+        r = self.redis_connection.r
+        r.sadd('clt:test_index', 'api_key_1', 'api_key_3')
+        r.sadd('clt:test_index:snapshot', 'api_key_1', 'api_key_2')
+        r.sadd('clt:test_index:rebuild', 'api_key_1', 'api_key_2')
+        self.redis_connection.merge_rebuilt_index_script(keys=['clt:test_index', 'clt:test_index:snapshot', 'clt:test_index:rebuild'], args=['set'])
+        self.assertEqual(r.smembers('clt:test_index'), set(['api_key_1', 'api_key_3']))
+        self.assertEqual(r.exists('clt:test_index:snapshot', 'clt:test_index:rebuild'), 0)
+
+        r.zadd('clt:test_zindex', {'api_key_1': 100, 'api_key_3': 300})
+        r.zadd('clt:test_zindex:snapshot', {'api_key_1': 50, 'api_key_2': 200})
+        r.zadd('clt:test_zindex:rebuild', {'api_key_1': 50, 'api_key_2': 200})
+        self.redis_connection.merge_rebuilt_index_script(keys=['clt:test_zindex', 'clt:test_zindex:snapshot', 'clt:test_zindex:rebuild'], args=['zset'])
+        self.assertEqual(r.zrange('clt:test_zindex', 0, -1, withscores=True), [('api_key_1', 100.0), ('api_key_3', 300.0)])
+
+    def test_list_usage_expired_keys(self):
+        api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_trial_api_key(api_key, 'trialuser@gmail.com', 10000)
+        self.redis_connection.track_usage(api_key, cloudlanguagetools.constants.Service.Azure, cloudlanguagetools.constants.RequestType.audio, 10)
+        self.redis_connection.rebuild_indexes()
+
+        # the usage hash expires, the index entry stays behind
+        usage_key = self.redis_connection.build_key(redisdb.KEY_TYPE_USAGE, f'user:lifetime:{api_key}')
+        self.assertEqual(len(self.redis_connection.list_usage('usage:user:lifetime')), 1)
+        self.redis_connection.r.delete(usage_key)
+        self.assertEqual(self.redis_connection.list_usage('usage:user:lifetime'), [])
+        usage_index_key = self.redis_connection.build_usage_index_key('user:lifetime')
+        self.assertFalse(self.redis_connection.r.sismember(usage_index_key, usage_key))
+
+    def test_list_usage_all_dates(self):
+        api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_trial_api_key(api_key, 'trialuser@gmail.com', 10000)
+        self.redis_connection.track_usage(api_key, cloudlanguagetools.constants.Service.Azure, cloudlanguagetools.constants.RequestType.audio, 10)
+        # usage from a previous month, indexed by the rebuild
+        previous_usage_key = self.redis_connection.build_key(redisdb.KEY_TYPE_USAGE, 'global:monthly:202001')
+        self.redis_connection.r.hset(previous_usage_key, mapping={'characters': 5, 'requests': 1})
+        self.redis_connection.rebuild_indexes()
+        # indexed by track_usage, once the index lists are built
+        self.redis_connection.track_usage(api_key, cloudlanguagetools.constants.Service.Azure, cloudlanguagetools.constants.RequestType.audio, 10)
+
+        for pattern in ['usage:global:monthly', 'usage:global:daily']:
+            scanned_usage_keys = sorted(self.redis_connection.r.scan_iter(match=self.redis_connection.build_key(pattern, '*')))
+            self.assertGreater(len(scanned_usage_keys), 0)
+            usage_index_keys = self.redis_connection.list_usage_index_keys(pattern[len('usage:'):])
+            self.assertGreater(len(usage_index_keys), 0)
+            usage_entries = self.redis_connection.list_usage(pattern)
+            self.assertEqual(sorted([x['usage_key'] for x in usage_entries]), scanned_usage_keys)
+        self.assertIn(previous_usage_key, [x['usage_key'] for x in self.redis_connection.list_usage('usage:global:monthly')])
+
+        # an index which expired is dropped from the list
+        previous_index_key = self.redis_connection.build_usage_index_key('global:monthly:202001')
+        self.redis_connection.r.delete(previous_index_key, previous_usage_key)
+        self.assertNotIn(previous_index_key, self.redis_connection.list_usage_index_keys('global:monthly'))
+        self.assertFalse(self.redis_connection.r.sismember(self.redis_connection.build_usage_index_list_key('global:monthly'), previous_index_key))
+
+    def test_reset_usage_indexed(self):
+        self.redis_connection.rebuild_indexes()
+        api_key = self.redis_connection.password_generator()
+        self.redis_connection.add_trial_api_key(api_key, 'trialuser@gmail.com', 10000)
+        self.redis_connection.reset_trial_usage(api_key)
+        usage_entries = self.redis_connection.list_usage('usage:user:lifetime')
+        self.assertEqual([x['usage_key'] for x in usage_entries], [self.redis_connection.build_key(redisdb.KEY_TYPE_USAGE, f'user:lifetime:{api_key}')])
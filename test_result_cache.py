@@ -0,0 +1,53 @@
+import unittest
+
+import result_cache
+
+class TestResultCache(unittest.TestCase):
+    def test_build_cache_key(self):
+        # unicode normalization doesn't matter, options key order doesn't either
+        key_1 = result_cache.build_cache_key('transliteration', 'Epitran', {'language': 'fr', 'mode': 'ipa'}, 'café')
+        key_2 = result_cache.build_cache_key('transliteration', 'Epitran', {'mode': 'ipa', 'language': 'fr'}, 'café')
+        self.assertEqual(key_1, key_2)
+        self.assertNotEqual(key_1, result_cache.build_cache_key('translation', 'Epitran', {'language': 'fr', 'mode': 'ipa'}, 'café'))
+        self.assertNotEqual(key_1, result_cache.build_cache_key('transliteration', 'Epitran', {'language': 'fr', 'mode': 'ipa'}, 'cafe'))
+
+    def test_lru(self):
+        local_cache = result_cache.LocalResultCache(2)
+        local_cache.put('a', 'result a')
+        local_cache.put('b', 'result b')
+        self.assertEqual(local_cache.get('a'), (True, 'result a'))
+        local_cache.put('c', 'result c')
+        # b was the least recently used
+        self.assertEqual(local_cache.get('b'), (False, None))
+        self.assertEqual(local_cache.get('a'), (True, 'result a'))
+        self.assertEqual(local_cache.get('c'), (True, 'result c'))
+
+    def test_get_result(self):
+        cache = result_cache.ResultCache(result_cache.LocalResultCache(100), max_text_length=10)
+        calls = []
+        def translate(text):
+            calls.append(text)
+            return text.upper()
+
+        self.assertEqual(cache.get_result('translation', 'Azure', ['fr', 'en'], 'chat', lambda: translate('chat')), 'CHAT')
+        self.assertEqual(cache.get_result('translation', 'Azure', ['fr', 'en'], 'chat', lambda: translate('chat')), 'CHAT')
+        self.assertEqual(calls, ['chat'])
+
+        # long texts are not cached
+        long_text = 'le chat est noir'
+        cache.get_result('translation', 'Azure', ['fr', 'en'], long_text, lambda: translate(long_text))
+        cache.get_result('translation', 'Azure', ['fr', 'en'], long_text, lambda: translate(long_text))
+        self.assertEqual(calls, ['chat', long_text, long_text])
+
+    def test_opt_out(self):
+        cache = result_cache.ResultCache(result_cache.LocalResultCache(100))
+        calls = []
+        def translate():
+            calls.append(1)
+            return 'dog'
+
+        # nothing gets stored for users who opted out
+        cache.get_result('translation', 'Azure', ['fr', 'en'], 'chien', translate, store_result=False)
+        self.assertEqual(len(cache.local_cache.entries), 0)
+        cache.get_result('translation', 'Azure', ['fr', 'en'], 'chien', translate, store_result=False)
+        self.assertEqual(len(calls), 2)
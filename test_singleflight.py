@@ -0,0 +1,122 @@
+import unittest
+import time
+import threading
+
+import singleflight
+
+class UnreliableRedisClient():
+    # acquires locks as told, every other call fails
+    def __init__(self, acquire_lock):
+        self.acquire_lock = acquire_lock
+
+    def register_script(self, script):
+        def run_script(keys, args):
+            raise Exception('connection lost')
+        return run_script
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx:
+            return self.acquire_lock
+        raise Exception('connection lost')
+
+    def exists(self, key):
+        raise Exception('connection lost')
+
+    def get(self, key):
+        raise Exception('connection lost')
+
+class RecordingRedisClient():
+    # the lock is always held by another worker, records the calls made
+    def __init__(self):
+        self.calls = []
+
+    def register_script(self, script):
+        return None
+
+    def set(self, key, value, nx=False, ex=None):
+        self.calls.append(('set', key))
+        return None
+
+    def exists(self, key):
+        self.calls.append(('exists', key))
+        return 1
+
+class TestSingleFlight(unittest.TestCase):
+    def run_concurrently(self, thread_count, fn):
+        results = [None] * thread_count
+        def run(i):
+            try:
+                results[i] = fn()
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce_identical_calls(self):
+        coalescer = singleflight.RequestCoalescer()
+        call_count = []
+        def translate():
+            call_count.append(1)
+            time.sleep(0.2)
+            return 'bonjour'
+
+        results = self.run_concurrently(5, lambda: coalescer.do('translation:hello', translate))
+        self.assertEqual(results, ['bonjour'] * 5)
+        self.assertEqual(len(call_count), 1)
+
+        # once finished, a new call runs the function again
+        self.assertEqual(coalescer.do('translation:hello', translate), 'bonjour')
+        self.assertEqual(len(call_count), 2)
+
+    def test_different_keys(self):
+        coalescer = singleflight.RequestCoalescer()
+        call_count = []
+        def translate():
+            call_count.append(1)
+            time.sleep(0.1)
+            return 'result'
+
+        self.run_concurrently(2, lambda: coalescer.do(f'translation:{threading.get_ident()}', translate))
+        self.assertEqual(len(call_count), 2)
+
+    def test_exception_shared(self):
+        coalescer = singleflight.RequestCoalescer()
+        def translate():
+            time.sleep(0.2)
+            raise Exception('service unavailable')
+
+        results = self.run_concurrently(3, lambda: coalescer.do('translation:error', translate))
+        for result in results:
+            self.assertTrue(isinstance(result, Exception))
+            self.assertEqual(str(result), 'service unavailable')
+        self.assertEqual(coalescer.single_flight.calls, {})
+
+    def test_redis_errors(self):
+        # the lock holder can't share its result or release the lock, the result is still returned
+        coalescer = singleflight.RequestCoalescer(redis_client=UnreliableRedisClient(True))
+        self.assertEqual(coalescer.do('translation:hello', lambda: 'bonjour'), 'bonjour')
+
+        # a worker waiting for the lock computes the result itself
+        coalescer = singleflight.RequestCoalescer(redis_client=UnreliableRedisClient(None))
+        self.assertEqual(coalescer.do('translation:hello', lambda: 'bonjour'), 'bonjour')
+
+    def test_in_process_only(self):
+        # the result couldn't be looked up across workers, identical calls are only coalesced within the process
+        redis_client = RecordingRedisClient()
+        coalescer = singleflight.RequestCoalescer(redis_client=redis_client)
+        call_count = []
+        def generate_audio():
+            call_count.append(1)
+            time.sleep(0.2)
+            return b'audio'
+
+        start_time = time.time()
+        results = self.run_concurrently(3, lambda: coalescer.do('audio:hello', generate_audio, lambda: None, across_workers=False))
+        self.assertEqual(results, [b'audio'] * 3)
+        self.assertEqual(len(call_count), 1)
+        self.assertEqual(redis_client.calls, [])
+        self.assertLess(time.time() - start_time, 1)
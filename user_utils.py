@@ -117,11 +117,11 @@ class UserUtils():
             api_key = components[-1]
             service = components[5]
             request_type = components[6]
+            characters = int(entry['characters'])
             records.append({
                 'api_key': api_key,
-                'service': service,
-                'request_type': request_type,
-                'characters': int(entry['characters'])
+                cost_field_name: quotas.get_character_cost(service, request_type) * characters,
+                characters_field_name: characters
             })
 
         if len(records) == 0:
@@ -129,13 +129,7 @@ class UserUtils():
 
         records_df = pandas.DataFrame(records)
 
-        cost_table_df = pandas.DataFrame(quotas.COST_TABLE)
-
-        combined_df = pandas.merge(records_df, cost_table_df, how='left', on=['service', 'request_type'])
-        combined_df[cost_field_name] = combined_df['character_cost'] * combined_df['characters']
-        combined_df = combined_df.rename(columns={'characters': characters_field_name})
-
-        grouped_df = combined_df.groupby('api_key').agg({cost_field_name: 'sum', characters_field_name: 'sum'}).reset_index()
+        grouped_df = records_df.groupby('api_key').agg({cost_field_name: 'sum', characters_field_name: 'sum'}).reset_index()
         return grouped_df
 
     def get_global_usage_data(self, usage_key_pattern):
@@ -149,26 +143,17 @@ class UserUtils():
             period = components[4]
             service = components[5]
             request_type = components[6]
+            characters = int(entry['characters'])
             records.append({
                 'period': period,
                 'service': service,
                 'request_type': request_type,
-                'characters': int(entry['characters']),
+                'cost': quotas.get_character_cost(service, request_type) * characters,
+                'characters': characters,
                 'requests': int(entry['requests'])
             })
 
-        records_df = pandas.DataFrame(records)
-        # print(records_df)
-
-        cost_table_df = pandas.DataFrame(quotas.COST_TABLE)
-
-        combined_df = pandas.merge(records_df, cost_table_df, how='left', on=['service', 'request_type'])
-        combined_df['cost'] = combined_df['character_cost'] * combined_df['characters']
-
-        # retain certain columns
-        combined_df = combined_df[['period', 'service', 'request_type', 'cost', 'characters',  'requests']]
-
-        return combined_df
+        return pandas.DataFrame(records, columns=['period', 'service', 'request_type', 'cost', 'characters',  'requests'])
 
     def get_user_tracking_data(self, api_key_list):
         logger.info('getting user tracking data')
@@ -861,12 +846,13 @@ class UserUtils():
     def extend_trial_expiration(self, api_key):
         expiration = self.redis_connection.get_api_key_expiration_timestamp_long()
         redis_api_key = self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key)
-        self.redis_connection.r.hset(redis_api_key, 'expiration', expiration)
+        self.redis_connection.set_api_key_expiration(api_key, expiration)
         logger.info(f'{redis_api_key}: setting expiration to {expiration}')
 
     def increase_trial_character_limit(self, api_key, character_limit):
         redis_api_key = self.redis_connection.build_key(redisdb.KEY_TYPE_API_KEY, api_key)
         self.redis_connection.r.hset(redis_api_key, 'character_limit', character_limit)
+        self.redis_connection.invalidate_api_key(api_key)
         logger.info(f'{redis_api_key}: setting character_limit to {character_limit}')
 
     def report_getcheddar_usage_all_users(self):